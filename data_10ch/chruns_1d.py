@@ -10,6 +10,10 @@ parser.add_argument('--repeat', default=25, help='Number of repeats to calculate
 parser.add_argument('--ntotal', type=int, default=150, help='ntotal pts. (default=150)')
 parser.add_argument('--nrnd', default=[5,75,10])
 parser.add_argument('--jobid', type=str, default='', help='sbatch jobid. Used to ask info about job.')
+parser.add_argument('--incremental', action='store_true', help='keep hyperparameters fixed after the first fit and only update the cholesky factor after each query')
+parser.add_argument('--backend', type=str, default='gpy', choices=('gpy','numpy'), help='GP implementation: gpy or numpy (see gp_numpy, default: gpy)')
+parser.add_argument('--workers', type=int, default=1, help='number of processes to run the runs on (default=1)')
+parser.add_argument('--seed', type=int, default=None, help='seed of all runs (default: random, saved in the results)')
 
 if __name__ == "__main__":
     args = parser.parse_args()
@@ -19,4 +23,4 @@ if __name__ == "__main__":
     print("nrnd: {}".format(args.nrnd))
     print("k={}".format(args.k))
     trainsC = Trains(emg=0)
-    D = run_ch_stats_exps(trainsC, emgs=[0,4], repeat=args.repeat, uid=args.uid, jobid=args.jobid, continue_opt=True, k=args.k, ntotal=args.ntotal, nrnd=args.nrnd, ARD=args.ARD)
+    D = run_ch_stats_exps(trainsC, emgs=[0,4], repeat=args.repeat, uid=args.uid, jobid=args.jobid, continue_opt=not args.incremental, k=args.k, ntotal=args.ntotal, nrnd=args.nrnd, ARD=args.ARD, incremental=args.incremental, backend=args.backend, workers=args.workers, seed=args.seed)
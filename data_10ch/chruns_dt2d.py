@@ -1,6 +1,7 @@
 from load_matlab import Trains
-from gp_full_dt2d import run_ch_stats_exps
+from gp_full_dt2d import run_ch_stats_exps, get_exppath, exp_config, RESULTS_FILE
 import argparse
+import os
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--uid', type=str, default='', help='alphanumerical uid for job number (default: '' will sample randint)')
@@ -20,9 +21,44 @@ parser.add_argument('--test', action='store_true')
 parser.add_argument('--constrain', action='store_true')
 parser.add_argument('--n_prior_queries', type=int, default=3, help='number of initial queries driven by prior (instead of being random)')
 parser.add_argument('--k', type=float, default=2, help='k param in UCB (default=2)')
+parser.add_argument('--incremental', action='store_true', help='keep hyperparameters fixed after the first fit and only update the cholesky factor after each query')
+parser.add_argument('--refit', type=str, default=None, help='hyperparameter re-optimization schedule: always, never, every:k, geometric:r or grad:tol (default: every query, with restarts)')
+parser.add_argument('--backend', type=str, default='gpy', choices=('gpy','numpy'), help='GP implementation: gpy or numpy (see gp_numpy, default: gpy)')
+parser.add_argument('--workers', type=int, default=1, help='number of processes to run the runs on (default=1)')
+parser.add_argument('--seed', type=int, default=None, help='seed of all runs (default: random, saved in the results)')
+parser.add_argument('--batch_size', type=int, default=1, help='number of queries per round (model update)')
+parser.add_argument('--batch_strategy', type=str, default='kb', choices=('kb','cl','lp'), help='batch acquisition: kriging believer, constant liar or local penalization (see gp_batch, default: kb)')
+parser.add_argument('--thompson', action='store_true', help='Thompson sampling (argmax of joint posterior draws) instead of UCB')
 
-if __name__ == "__main__":
-    args = parser.parse_args()
+def run_kwargs(args):
+    # arguments of run_ch_stats_exps for the experiment of args
+    if args.test:
+        # We just want to test the whole setup, so run with minimal
+        # configs to end quickly
+        return dict(syn=args.syn, dts=args.dts, uid=args.uid, jobid=args.jobid, repeat=1, ntotal=50, nrnd=[25,45,10], sa=args.sa, symkern=args.symkern, multkern=args.multkern, ARD=args.ardkern, T=args.T, constrain=args.constrain, n_prior_queries=args.n_prior_queries, k=args.k, continue_opt=not args.incremental, incremental=args.incremental, refit=args.refit, backend=args.backend, batch_size=args.batch_size, batch_strategy=args.batch_strategy, thompson=args.thompson, workers=args.workers, seed=args.seed)
+    # Run the real things
+    return dict(syn=args.syn, dts=args.dts, uid=args.uid,
+                jobid=args.jobid, repeat=args.repeat, dtprior=args.dtprior,
+                ntotal=args.ntotal, nrnd=args.nrnd, sa=args.sa, T=args.T,
+                symkern=args.symkern, multkern=args.multkern, ARD=args.ardkern,
+                constrain=args.constrain, n_prior_queries=args.n_prior_queries,
+                k=args.k, continue_opt=not args.incremental,
+                incremental=args.incremental, refit=args.refit, backend=args.backend, batch_size=args.batch_size, batch_strategy=args.batch_strategy, thompson=args.thompson, workers=args.workers, seed=args.seed)
+
+def results_path(args):
+    # file of the results of the experiment of args
+    c = exp_config(**run_kwargs(args))
+    return os.path.join(get_exppath(c['uid'], c['emg'], c['syn'], c['dts'], c['sa'], c['multkern'], c['ARD'], c['constrain'], c['k'], config=c), RESULTS_FILE)
+
+def check_args(args):
+    # (build_prior's dtprior mean has no dt2d version)
+    if args.dtprior:
+        parser.error("--dtprior isn't implemented for dt2d")
+
+def main(args, trainsC=None):
+    # runs the experiment of args (parsed by parser), on trainsC if given
+    # (eg. by sweep.py, which loads it once for many experiments)
+    check_args(args)
     print("Starting job with uid = {}".format(args.uid))
     print("syn = {}".format(args.syn))
     print("dts = {}".format(args.dts))
@@ -33,16 +69,10 @@ if __name__ == "__main__":
     print("Use simulated annealing: {}".format(args.sa))
     print("Constrained: {}".format(args.constrain))
     print("k={}".format(args.k))
-    trainsC = Trains()
-    if args.test:
-        # We just want to test the whole setup, so run with minimal
-        # configs to end quickly
-        D = run_ch_stats_exps(trainsC, syn=args.syn, dts=args.dts, uid=args.uid, jobid=args.jobid, repeat=1, ntotal=50, nrnd=[25,45,10], sa=args.sa, symkern=args.symkern, multkern=args.multkern, ARD=args.ardkern, T=args.T, constrain=args.constrain, n_prior_queries=args.n_prior_queries, k=args.k)
-    else:
-        # Run the real things
-        D = run_ch_stats_exps(trainsC, syn=args.syn, dts=args.dts, uid=args.uid,
-                              jobid=args.jobid, repeat=args.repeat, dtprior=args.dtprior,
-                              ntotal=args.ntotal, nrnd=args.nrnd, sa=args.sa, T=args.T,
-                              symkern=args.symkern, multkern=args.multkern, ARD=args.ardkern,
-                              constrain=args.constrain, n_prior_queries=args.n_prior_queries,
-                              k=args.k)
+    if trainsC is None:
+        trainsC = Trains()
+    D = run_ch_stats_exps(trainsC, **run_kwargs(args))
+    return D
+
+if __name__ == "__main__":
+    main(parser.parse_args())
@@ -0,0 +1,75 @@
+"""
+Batch (q-point) acquisition: batch_idx picks q distinct candidates from
+one grid posterior, with kriging believer, constant liar, local
+penalization or Thompson sampling.
+"""
+
+import numpy as np
+from scipy.stats import norm
+from scipy.spatial.distance import pdist, cdist
+from gp_grid import grid_predict, grid_posterior_cov, grid_samples, noise_var
+
+STRATEGIES = ('kb', 'cl', 'lp', 'ts')
+
+def batch_idx(m, grid, q, pick, k=2, strategy='kb', cands=None):
+    # q distinct indices of grid to query next. pick(acq) chooses one
+    # index of acq (the acquisition on cands, with the candidates picked
+    # already at -inf), eg. argmax or the softmax sampling of
+    # get_next_x. cands are the indices of grid we may query (default
+    # all of them)
+    assert strategy in STRATEGIES, "strategy must be one of {}".format(STRATEGIES)
+    if cands is None:
+        cands = np.arange(len(grid))
+    assert q <= len(cands), "can't pick {} distinct candidates out of {}".format(q, len(cands))
+    picked = []
+    if strategy == 'ts':
+        for draw in grid_samples(m, grid, q):
+            draw[picked] = -np.inf
+            picked.append(cands[pick(draw[cands])])
+        return picked
+    mean,var = grid_predict(m, grid)
+    mean = mean[:,0].copy()
+    var = var[:,0].copy()
+    acq = mean + k*np.sqrt(var)
+    idx = cands[pick(acq[cands])]
+    picked.append(idx)
+    if q == 1:
+        return picked
+    C = grid_posterior_cov(m, grid)
+    s2 = noise_var(m)
+    Ymodel = np.asarray(m.Y)
+    if strategy == 'lp':
+        # Lipschitz constant of the mean, from all pairs of candidates
+        dists = pdist(grid[cands].astype(float))
+        diffs = pdist(mean[cands][:,None])
+        ok = dists > 0
+        L = max((diffs[ok] / dists[ok]).max(), 1e-12)
+        M = Ymodel.max()
+        base = acq - acq[cands].min()
+        penalty = np.ones(len(grid))
+    while len(picked) < q:
+        if strategy == 'lp':
+            d = cdist(grid.astype(float), grid[idx][None].astype(float))[:,0]
+            std = max(np.sqrt(C[idx,idx]), 1e-12)
+            penalty *= norm.cdf((L*d - M + mean[idx]) / std)
+            acq = base * penalty
+        else:
+            # condition on a fantasy observation at idx (noise s2)
+            c = C[:,idx] / (C[idx,idx] + s2)
+            if strategy == 'cl':
+                mean += c * (Ymodel.min() - mean[idx])
+            C -= np.outer(c, C[idx])
+            acq = mean + k*np.sqrt(np.clip(np.diag(C), 0, None) + s2)
+        acq[picked] = -np.inf
+        idx = cands[pick(acq[cands])]
+        picked.append(idx)
+    return picked
+
+def query_steps(models, ntotal):
+    # Yields (queries, round, model) for the models of a sequential run
+    # (eg. a SeqModels), where queries is the slice of (0-based) queries
+    # for which model is the latest one. With batch_size=1 every slice
+    # is a single query, and query n-1 has the model with n points
+    ns = [len(m.X) for m in models] + [ntotal+1]
+    for rnd,m in enumerate(models):
+        yield slice(ns[rnd]-1, ns[rnd+1]-1), rnd, m
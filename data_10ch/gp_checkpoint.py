@@ -0,0 +1,85 @@
+"""
+Checkpoints of the runs of run_ch_stats_exps: TaskStore saves every
+run as soon as it is done, so a relaunched experiment (same uid, seed
+and arguments) only runs the missing ones.
+"""
+
+import os
+import pickle
+import hashlib
+import tempfile
+import numpy as np
+from gp_pool import as_completed
+
+def atomic_dump(obj, filename):
+    # pickles obj to filename, which has either its old content or obj,
+    # never a partial file
+    dirname = os.path.dirname(filename) or '.'
+    fd,tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(obj, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+def _plain(config):
+    # (so that eg. dts=(40,60) and dts=[40,60] are the same experiment)
+    return {k: list(v) if isinstance(v, (tuple, range, np.ndarray)) else v for k,v in config.items()}
+
+def config_hash(config):
+    # short hash of a config (compared like TaskStore's), eg. to name the
+    # directory of an experiment
+    return hashlib.sha1(repr(sorted(_plain(config).items())).encode()).hexdigest()[:8]
+
+class TaskStore:
+    """Completed tasks of an experiment, keyed by tuples of ints (eg.
+    (model, repeat, nrnd) of run_ch_stats_exps)."""
+
+    def __init__(self, path, config, seed=None):
+        # config: the arguments of the experiment (picklable, comparable
+        # with ==). seed: None to reuse the seed of the store (or draw a
+        # new one if the store is new)
+        self.path = path
+        config = _plain(config)
+        os.makedirs(path, exist_ok=True)
+        metafile = os.path.join(path, 'meta.pkl')
+        if os.path.exists(metafile):
+            with open(metafile, 'rb') as f:
+                meta = pickle.load(f)
+            assert meta['config'] == config, "{} holds the runs of another experiment (use another uid): {}".format(path, meta['config'])
+            assert seed is None or seed == meta['seed'], "{} was run with seed {}".format(path, meta['seed'])
+            self.seed = meta['seed']
+        else:
+            self.seed = np.random.SeedSequence(seed).entropy
+            atomic_dump({'config': config, 'seed': self.seed}, metafile)
+
+    def _filename(self, key):
+        return os.path.join(self.path, 'task_{}.pkl'.format('_'.join(str(k) for k in key)))
+
+    def done(self, key):
+        return os.path.exists(self._filename(key))
+
+    def save(self, key, res):
+        atomic_dump(res, self._filename(key))
+
+    def load(self, key):
+        with open(self._filename(key), 'rb') as f:
+            return pickle.load(f)
+
+def run_tasks(store, fn, keys, tasks, workers=1, shared=None):
+    # Yields (key, fn(task)) for every task (keys[i] is the key of
+    # tasks[i]): first those already in store, then the others as they
+    # are done (see gp_pool.as_completed), saving each one first
+    todo = [t for t,key in enumerate(keys) if not store.done(key)]
+    if len(todo) < len(keys):
+        print("Resuming from {}: {} of {} runs already done".format(store.path, len(keys) - len(todo), len(keys)))
+    for t in sorted(set(range(len(keys))) - set(todo)):
+        yield keys[t], store.load(keys[t])
+    for t,res in as_completed(fn, [tasks[t] for t in todo], workers=workers, shared=shared):
+        key = keys[todo[t]]
+        store.save(key, res)
+        yield key, res
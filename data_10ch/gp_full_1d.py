@@ -7,6 +7,13 @@ We fit GPs to the full dataset, testing different models and kernels
 import matplotlib as mpl
 mpl.rcParams['pdf.fonttype'] = 42
 from load_matlab import *
+from gp_incremental import IncrementalGP
+from gp_numpy import get_backend
+from gp_grid import grid_predict, GRID_1D, GRID_CHS
+from gp_pool import task_seeds, seed_task, shared
+from gp_checkpoint import TaskStore, run_tasks
+from gp_results import ResultsStore
+from gp_modelcache import fit_cached
 import numpy as np
 import GPy
 import matplotlib.pyplot as plt
@@ -27,10 +34,16 @@ parser.add_argument('--emg', type=int, default=2, choices=range(7), help='emg. b
 # DEFAULT
 # there is no dt in 1d. But we need this to access the trains dct
 dt=0
+# seed of the trials sampled for the reference 1d models (the same in
+# every experiment, so that they come from the model cache, see
+# gp_modelcache)
+REF_SEED=0
 
-def make_dataset_1d(trainsC, emg=2, mean=False, n=20):
+def make_dataset_1d(trainsC, emg=2, mean=False, n=20, f='max', seed=None):
     # n means number of datapt per channel
+    # seed: of the sampled datapts (default: the global random state)
     # Used to test/debug certain models
+    rng = random.Random(seed) if seed is not None else random
     trains = trainsC.get_emgdct(emg=emg)
     X = []
     Y = []
@@ -38,7 +51,7 @@ def make_dataset_1d(trainsC, emg=2, mean=False, n=20):
     Ymean = []
     Yvars = []
     for ch in CHS:
-        ys = random.sample(trains[ch][ch][0]['data'].max(axis=1).tolist(),n)
+        ys = rng.sample(trainsC.cell_feature(ch,ch,0,emg=emg,f=f).tolist(),n)
         Y.extend(ys)
         var = trains[ch][ch][0]['stdmax'] ** 2
         Yvars.extend([var] * len(ys))
@@ -54,13 +67,15 @@ def make_dataset_1d(trainsC, emg=2, mean=False, n=20):
     Y = np.array(Y).reshape((-1,1))
     return X,Y
 
-def train_model_1d(X,Y, num_restarts=3, ARD=True, constrain=[0.3,3.0], verbose=True):
-
-    matk = GPy.kern.Matern52(input_dim=2, ARD=ARD)
+def train_model_1d(X,Y, num_restarts=3, ARD=True, constrain=[0.3,3.0], verbose=True, optimize=True, backend='gpy'):
+    # backend: 'gpy' or 'numpy' (see gp_numpy)
+    lib = get_backend(backend)
+    matk = lib.kern.Matern52(input_dim=2, ARD=ARD)
     if constrain:
         matk.lengthscale.constrain_bounded(*constrain, warning=verbose)
-    m = GPy.models.GPRegression(X,Y,matk)
-    m.optimize_restarts(num_restarts=num_restarts, verbose=verbose)
+    m = lib.models.GPRegression(X,Y,matk)
+    if optimize:
+        m.optimize_restarts(num_restarts=num_restarts, verbose=verbose)
 
     return m
 
@@ -114,35 +129,45 @@ def plot_mo_model(m, plot_data=True):
 
 ##### end of co-kriging section ######
 
-def train_model_seq(trainsC, emg=0, n_random_pts=10, n_total_pts=25, ARD=True, num_restarts=3, continue_opt=False, k=2, constrain=[0.3,3.0], verbose=True):
-    X = []
-    Y = []
-    for _ in range(n_random_pts):
-        ch = random.choice(CHS)
-        X.append(ch2xy[ch])
-        resp = random.choice(trainsC.emgdct[emg][ch][ch][dt]['data'].max(axis=1))
-        Y.append(resp)
-    matk = GPy.kern.Matern52(input_dim=2, ARD=ARD)
+def train_model_seq(trainsC, emg=0, n_random_pts=10, n_total_pts=25, ARD=True, num_restarts=3, continue_opt=False, k=2, constrain=[0.3,3.0], verbose=True, f='max', sampler=None, seed=None, incremental=False, backend='gpy'):
+    # sampler simulates the stimulator (see ResponseSampler)
+    # If incremental (and not continue_opt), each new query only extends
+    # the cholesky factor of the previous model (see IncrementalGP)
+    if sampler is None:
+        sampler = ResponseSampler(trainsC, emg=emg, f=f, seed=seed)
+    chs,_,_ = sampler.random_cells(n_random_pts)
+    X = [ch2xy[ch] for ch in chs]
+    Y = sampler.sample(chs, chs, dt).tolist()
+    # backend: 'gpy' or 'numpy' (see gp_numpy)
+    lib = get_backend(backend)
+    matk = lib.kern.Matern52(input_dim=2, ARD=ARD)
     if constrain:
         matk.lengthscale.constrain_bounded(*constrain, warning=verbose)
     #Make model
     models = []
-    m = GPy.models.GPRegression(np.array(X),np.array(Y)[:,None],matk)
+    m = lib.models.GPRegression(np.array(X),np.array(Y)[:,None],matk)
     m.optimize_restarts(num_restarts=num_restarts, verbose=verbose)
     # We optimize this kernel once and then use it for all future models
     optim_params = m[:]
     models.append(m)
+    incremental = incremental and not continue_opt
+    if incremental:
+        gp = IncrementalGP.from_gpy(m)
     for _ in range(n_total_pts-n_random_pts):
         nextx = get_next_x(m, k=k)
         X.append(nextx)
         ch = xy2ch[nextx[0]][nextx[1]]
-        resp = random.choice(trainsC.emgdct[emg][ch][ch][dt]['data'].max(axis=1))
+        resp = float(sampler.sample(ch,ch,dt))
         Y.append(resp)
-        m = GPy.models.GPRegression(np.array(X), np.array(Y)[:,None],matk.copy())
-        m[:] = optim_params
-        ## TODO: also set gp's noise variance to be same as previous!
-        if continue_opt:
-            m.optimize_restarts(num_restarts=num_restarts, verbose=verbose)
+        if incremental:
+            gp.add(nextx, resp)
+            m = gp.snapshot()
+        else:
+            m = lib.models.GPRegression(np.array(X), np.array(Y)[:,None],matk.copy())
+            m[:] = optim_params
+            ## TODO: also set gp's noise variance to be same as previous!
+            if continue_opt:
+                m.optimize_restarts(num_restarts=num_restarts, verbose=verbose)
         models.append(m)
     return models
 
@@ -219,7 +244,7 @@ def plot_seq_stats(m, n_random_pts, trainsC=None, title=None, plot_acq=False, pl
 
 def get_acq_map(m, k=2):
     # We use UCB, k is the "exploration" parameter
-    mean,var = m.predict(np.array(list(ch2xy.values())))
+    mean,var = grid_predict(m, GRID_CHS)
     std = np.sqrt(var)
     acq = mean + k*std
     return acq
@@ -295,14 +320,14 @@ def plot_model_surface(m, ax=None, plot_data=True, zlim=None, extra_xlim=1, plot
 
 
 def l2dist(m1, m2):
-    X = np.array(list(itertools.product(range(2), range(5))))
-    pred1 = m1.predict(X)[0]
-    pred2 = m2.predict(X)[0]
+    X = GRID_1D
+    pred1 = grid_predict(m1, X)[0]
+    pred2 = grid_predict(m2, X)[0]
     return LA.norm(pred1-pred2)
 def linfdist(m1, m2):
-    X = np.array(list(itertools.product(range(2), range(5))))
-    pred1 = m1.predict(X)[0]
-    pred2 = m2.predict(X)[0]
+    X = GRID_1D
+    pred1 = grid_predict(m1, X)[0]
+    pred2 = grid_predict(m2, X)[0]
     return abs((pred1.max() - pred2.max())/pred2.max())
 
 def run_dist_exps(args):
@@ -315,8 +340,8 @@ def run_dist_exps(args):
     # We train all models with n rnd start pts and m sequential pts
     # And compare them to the model trained with all datapts
     # Then compute statistics and plot them
-    X,Y = make_dataset_1d(trainsC, emg=args.emg)
-    mfull = train_model_1d(X,Y, ARD=False)
+    X,Y = make_dataset_1d(trainsC, emg=args.emg, seed=REF_SEED)
+    mfull = fit_cached(train_model_1d, X,Y, ARD=False)
     nrnd = range(5,50,5)
     nseq = range(0,50,5)
     N = 50
@@ -360,8 +385,8 @@ def get_ch(xy):
     return xy2ch[x][y]
 
 def get_maxch(m):
-    X = np.array(list(itertools.product(range(2),range(5))))
-    means,_ = m.predict(X)
+    X = GRID_1D
+    means,_ = grid_predict(m, X)
     maxidx = means.argmax()
     maxxy = np.unravel_index(maxidx, (2,5))
     maxch = get_ch(maxxy)
@@ -370,16 +395,31 @@ def get_maxch(m):
 def get_nmaxch(m, n=3):
     if n==0:
         return []
-    X = np.array(list(itertools.product(range(2),range(5))))
-    means,_ = m.predict(X)
+    X = GRID_1D
+    means,_ = grid_predict(m, X)
     indexed = list(zip(X.tolist(), means.flatten()))
     top_3 = sorted(indexed, key=operator.itemgetter(1))[-n:]
     xys = list(reversed([xy for xy, v in top_3]))
     return xys
 
-def run_ch_stats_exps(trainsC, emgs=[0,2,4], repeat=25, uid=None, jobid=None, continue_opt=True, k=2, ntotal=100, nrnd=[5,75,10], ARD=True):
+def _run_task_1d(task):
+    # One run of run_ch_stats_exps (a task of run_tasks): the arguments
+    # of train_model_seq and its seed
+    kwargs, ss = task
+    ntotal, n1 = kwargs['n_total_pts'], kwargs['n_random_pts']
+    sampler_seed = seed_task(ss)
+    models = train_model_seq(shared('trainsC'), seed=sampler_seed, **kwargs)
+    maxchs = np.zeros(ntotal)
+    vals = np.zeros((ntotal, 10))
+    for midx,m in enumerate(models,n1-1):
+        maxchs[midx] = get_maxch(m)
+    vals[n1-1:] = np.hstack([grid_predict(m, GRID_1D)[0] for m in models]).T
+    return {'queriedchs': [get_ch(xy) for xy in models[-1].X], 'maxchs': maxchs, 'vals': vals}
+
+def run_ch_stats_exps(trainsC, emgs=[0,2,4], repeat=25, uid=None, jobid=None, continue_opt=True, k=2, ntotal=100, nrnd=[5,75,10], ARD=True, incremental=False, backend='gpy', workers=1, seed=None):
     # here we run a bunch of runs, gather all statistics and save as
     # npy array, to later plot in jupyter notebook
+    # The runs are run on <workers> processes, seeded from seed (see gp_pool)
     if uid is None:
         uid = random.randrange(99999)
     exppath = path.join('exps', '1d', 'exp{}'.format(uid), 'k{}'.format(k), 'ARD{}'.format(ARD))
@@ -393,38 +433,46 @@ def run_ch_stats_exps(trainsC, emgs=[0,2,4], repeat=25, uid=None, jobid=None, co
         with open(filename, 'w') as f:
             f.write('sbatcjobid = {}'.format(jobid))
     nrnd = range(*nrnd)
-    dct = {}
-    for emg in emgs:
-        print("Starting emg {}".format(emg))
-        queriedchs = np.zeros((repeat, len(nrnd), ntotal))
-        maxchs = np.zeros((repeat, len(nrnd), ntotal))
+    # One task per (emg, repeat, nrnd) run
+    runs = [(emg,r,i) for emg in emgs for r in range(repeat) for i in range(len(nrnd))]
+    kwargs = dict(n_total_pts=ntotal, ARD=ARD, continue_opt=continue_opt, num_restarts=1, k=k,
+                  incremental=incremental, backend=backend)
+    # checkpoints of the runs (see gp_checkpoint)
+    store = TaskStore(path.join(exppath, 'tasks'), dict(kwargs, emgs=emgs, repeat=repeat, nrnd=nrnd), seed)
+    seed, seeds = task_seeds(store.seed, len(runs))
+    tasks = [(dict(kwargs, emg=emg, n_random_pts=nrnd[i]), ss) for (emg,r,i),ss in zip(runs, seeds)]
+    # The arrays of all emgs are stacked (and written to chruns.h5, run
+    # by run, see gp_results), dct[emg] has views of its slices
+    arrays = {
+        'queriedchs': np.zeros((len(emgs), repeat, len(nrnd), ntotal)),
+        'maxchs': np.zeros((len(emgs), repeat, len(nrnd), ntotal)),
         # we save all values the model predicted (for 10 chs)
         # from this we can compute l2 and linf distances later
-        vals = np.zeros((repeat, len(nrnd), ntotal, 10))
-        for r in range(repeat):
-            print("Repeat", r)
-            for i,n1 in enumerate(nrnd):
-                print("nrnd: {}".format(n1))
-                models = train_model_seq(trainsC, emg=emg, n_random_pts=n1,
-                                         n_total_pts=ntotal, ARD=ARD,
-                                         continue_opt=continue_opt, num_restarts=1, k=k)
-                queriedchs[r][i] = [get_ch(xy) for xy in models[-1].X]
-                for midx,m in enumerate(models,n1-1):
-                    maxchs[r][i][midx] = get_maxch(m)
-                X = np.array(list(itertools.product(range(2),range(5))))
-                vals[r,i,n1-1:] = np.hstack([m.predict(X)[0] for m in models]).T
+        'vals': np.zeros((len(emgs), repeat, len(nrnd), ntotal, 10))
+    }
+    results = ResultsStore(os.path.join(exppath, 'chruns.h5'), arrays,
+                           config=dict(kwargs, emgs=emgs, repeat=repeat, nrnd=nrnd, seed=seed))
+    dct = {}
+    for e,emg in enumerate(emgs):
         dct[emg] = {
-            'queriedchs': queriedchs,
-            'maxchs': maxchs,
-            'vals': vals,
+            'queriedchs': arrays['queriedchs'][e],
+            'maxchs': arrays['maxchs'][e],
+            'vals': arrays['vals'][e],
             'nrnd': nrnd,
             'ntotal': ntotal,
             'true_ch': trainsC.max_ch_1d(emg=emg),
-            'k': k
+            'k': k,
+            # the seed of all runs
+            'seed': seed
         }
-    with open(os.path.join(exppath, 'chruns_dct.pkl'), 'wb') as f:
-        print("Saving in path", exppath)
-        pickle.dump(dct, f)
+    for (emg,r,i),res in run_tasks(store, _run_task_1d, runs, tasks, workers=workers, shared={'trainsC': trainsC}):
+        print("emg {}, repeat {}, nrnd {}: done".format(emg, r, nrnd[i]))
+        for key in ('queriedchs', 'maxchs', 'vals'):
+            dct[emg][key][r][i] = res[key]
+        results.write((list(emgs).index(emg),r,i))
+    print("Saving in path", exppath)
+    results.close({'emgs': emgs, 'nrnd': nrnd, 'ntotal': ntotal, 'true_chs': [dct[emg]['true_ch'] for emg in emgs],
+                   'k': k, 'seed': seed})
     return dct
 
 if __name__ == '__main__':
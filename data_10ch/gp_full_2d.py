@@ -4,15 +4,27 @@ We fit GPs to the full dataset, testing different models and kernels
 
 from load_matlab import *
 from gp_full_1d import *
+from gp_incremental import IncrementalGP, RefitSchedule, CONST_JITTER
+from gp_kron import KronGPRegression
+from gp_batch import batch_idx, query_steps
+from gp_lockstep import LockstepGP, lockstep_runs
+from gp_pool import task_seeds, seed_task, shared
+from gp_checkpoint import TaskStore, run_tasks, config_hash
+from gp_results import ResultsStore
+from gp_modelcache import fit_cached
+from gp_numpy import get_backend
+from gp_grid import grid_predict, grid_samples, argmax_probs, GRID_1D, GRID_2D, SYM_IDX, canonical_pairs
+from gp_snapshots import SeqModels
 import numpy as np
 import GPy
 import matplotlib.pyplot as plt
 import pickle
 import os, os.path as path
-import h5py
 import itertools
+import inspect
 import argparse
 import copy
+import time
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--uid', type=str, default=1, help='uid for job number')
@@ -23,7 +35,16 @@ parser.add_argument('--emg', type=int, default=4, choices=range(7), help='emg. b
 dt=40
 emg=4
 
-def make_dataset_2d(trainsC, emg=emg, syn=None, dt=dt, means=False, n=None):
+def make_dataset_2d(trainsC, emg=emg, syn=None, dt=dt, means=False, n=None, f='max', collapse=False, symmetric=False, canonical=False):
+    # If collapse, repeated trials of a cell are collapsed into their mean
+    # (see collapse_dataset), and we return X,Y,counts,scatter to be
+    # fit with CollapsedGPRegression.
+    # If symmetric, every trial of (ch1,ch2) is also added as a trial of
+    # (ch2,ch1) (only makes sense for dt=0)
+    # If canonical, the trials of (ch1,ch2) and (ch2,ch1) are both put on
+    # their canonical pair (see canonical_pairs, also only for dt=0), so
+    # there are only 55 distinct inputs. With a symmetric kernel this is
+    # the same posterior as with symmetric, with half the data
     if syn is not None:
         assert type(syn) is tuple, "syn should be a tuple of 2 emgs. (eg. (0,4))"
     else:
@@ -44,12 +65,14 @@ def make_dataset_2d(trainsC, emg=emg, syn=None, dt=dt, means=False, n=None):
             # don't include them for now (this is prob bad though)
             # train time: 4000 pts = 10 mins
             #             2000 pts = 2 mins
-            emg1,emg2 = syn
-            ys = trainsC.synergy(emg1,emg2,ch1,ch2,dt).max(axis=1)
+            ys = trainsC.cell_feature(ch1,ch2,dt,syn=syn,f=f)
             if n:
-                ys = random.sample(trains[ch1][ch2][dt]['data'].max(axis=1).tolist(),n)
+                ys = random.sample(trainsC.cell_feature(ch1,ch2,dt,emg=emg,f=f,filldiag=False).tolist(),n)
             Y.extend(ys)
             X.extend([xych1 + xych2]*len(ys))
+            if symmetric:
+                Y.extend(ys)
+                X.extend([xych2 + xych1]*len(ys))
             # we also make a small dataset with means
             Ymean.append(ys.mean())
             Xmean.extend([xych1 + xych2])
@@ -59,8 +82,111 @@ def make_dataset_2d(trainsC, emg=emg, syn=None, dt=dt, means=False, n=None):
         return Xmean, Ymean
     X = np.array(X)
     Y = np.array(Y).reshape((-1,1))
+    if canonical:
+        X = canonical_pairs(X)
+    if collapse:
+        return collapse_dataset(X,Y)
     return X,Y
 
+def collapse_dataset(X, Y):
+    # Our inputs live on a grid, so the full datasets have ~20 repeated
+    # rows per cell. We collapse them into one row per distinct input with
+    # the mean of its Ys, which has noise variance noise/counts. counts and
+    # scatter (sum of squares of Y around the cell means) are all that
+    # CollapsedGPRegression needs to have exactly the likelihood of
+    # a GPRegression on the full X,Y. The GP then scales with the number of
+    # cells (100 per dt) instead of the number of trials
+    Xc, inv, counts = np.unique(X, axis=0, return_inverse=True, return_counts=True)
+    inv = inv.reshape(-1)
+    Yc = np.bincount(inv, weights=Y[:,0]) / counts
+    scatter = ((Y[:,0] - Yc[inv])**2).sum()
+    return Xc, Yc[:,None], counts[:,None], scatter
+
+class CellMeanGaussian(GPy.likelihoods.Gaussian):
+    # Gaussian noise of a mean of counts trials: the variance parameter is
+    # still the variance of a single trial (which is what predict adds),
+    # but row i of the data has variance variance/counts[i]
+    def __init__(self, counts, variance=1., name='Gaussian_noise'):
+        super(CellMeanGaussian, self).__init__(variance=variance, name=name)
+        self.counts = np.asarray(counts, dtype=float).reshape(-1)
+
+    def gaussian_variance(self, Y_metadata=None):
+        # GPy's exact inference adds CONST_JITTER to every row. On the full
+        # data that's CONST_JITTER per trial, so we compensate to keep the
+        # two likelihoods identical
+        return (self.variance + CONST_JITTER) / self.counts - CONST_JITTER
+
+    def exact_inference_gradients(self, dL_dKdiag, Y_metadata=None):
+        return (dL_dKdiag / self.counts).sum()
+
+class CollapsedGPRegression(GPy.core.GP):
+    # GPRegression on the output of collapse_dataset. The log likelihood
+    # of the full data is that of the cell means (with noise
+    # variance/counts) plus a term that only depends on the noise:
+    #   -scatter/(2v) - (ntot-ncells)/2 log(2 pi v) - 1/2 sum(log counts)
+    # We add it (and its gradient), so that optimizing this model gives the
+    # same hyperparameters as optimizing a GPRegression on all the trials
+    def __init__(self, X, Y, counts, scatter=0., kernel=None, noise_var=1., mean_function=None):
+        if kernel is None:
+            kernel = GPy.kern.RBF(X.shape[1])
+        self.counts = np.asarray(counts, dtype=float).reshape(-1)
+        self.scatter = scatter
+        likelihood = CellMeanGaussian(self.counts, variance=noise_var)
+        super(CollapsedGPRegression, self).__init__(X, Y, kernel, likelihood, name='GP regression', mean_function=mean_function)
+
+    def parameters_changed(self):
+        super(CollapsedGPRegression, self).parameters_changed()
+        v = self.likelihood.variance[0] + CONST_JITTER
+        nextra = self.counts.sum() - len(self.counts)
+        self._log_marginal_likelihood += (-0.5*self.scatter/v - 0.5*nextra*np.log(2*np.pi*v)
+                                          - 0.5*np.log(self.counts).sum())
+        self.likelihood.variance.gradient += 0.5*self.scatter/v**2 - 0.5*nextra/v
+
+class PairSymmetric(GPy.kern.Symmetric):
+    # GPy.kern.Symmetric (even), ie. k(x,x') + k(Ax,x') + k(x,Ax') + k(Ax,Ax')
+    # with A the swap of the 2 electrodes. When the base kernel is
+    # invariant to A (a stationary kernel with the same lengthscales on
+    # both electrodes, eg. ARD=False), k(Ax,Ax') = k(x,x') and
+    # k(Ax,x') = k(x,Ax'), so we only need 2 evaluations of the base
+    # kernel instead of 4. K and the gradients are then the same as
+    # GPy.kern.Symmetric's up to rounding (allclose, not bit for bit, the
+    # terms are summed in another order). Otherwise this is
+    # GPy.kern.Symmetric
+    def __init__(self, base_kernel, transform):
+        super(PairSymmetric, self).__init__(base_kernel, transform, symmetry_type='even')
+        dims = list(base_kernel.active_dims)
+        # (X.dot(transform))[:,j] == X[:,perm[j]] on the base kernel's dims
+        self.perm = transform[np.ix_(dims,dims)].argmax(axis=0)
+
+    def invariant(self):
+        base = self.base_kernel
+        if not isinstance(base, GPy.kern.src.stationary.Stationary):
+            return False
+        l = base.lengthscale.values
+        return not base.ARD or np.array_equal(l, l[self.perm])
+
+    def K(self, X, X2=None):
+        if not self.invariant():
+            return super(PairSymmetric, self).K(X, X2)
+        X2_sym = (X if X2 is None else X2).dot(self.transform)
+        return 2*(self.base_kernel.K(X, X2) + self.base_kernel.K(X, X2_sym))
+
+    def update_gradients_full(self, dL_dK, X, X2=None):
+        if not self.invariant():
+            return super(PairSymmetric, self).update_gradients_full(dL_dK, X, X2)
+        base = self.base_kernel
+        X2_sym = (X if X2 is None else X2).dot(self.transform)
+        base.update_gradients_full(dL_dK, X, X2)
+        dvar = base.variance.gradient.copy()
+        dl = base.lengthscale.gradient.copy()
+        base.update_gradients_full(dL_dK, X, X2_sym)
+        dvar += base.variance.gradient
+        dl += base.lengthscale.gradient
+        # the terms in Ax are the same with the lengthscales of the 2
+        # electrodes swapped
+        base.variance.gradient = 2*dvar
+        base.lengthscale.gradient = dl + dl[self.perm] if base.ARD else 2*dl
+
 class Abs(GPy.core.Mapping):
     def __init__(self, mapping):
         input_dim, output_dim = mapping.input_dim, mapping.output_dim
@@ -82,21 +208,32 @@ class Abs(GPy.core.Mapping):
         else:
             return -dL_dF
 
+class Prior1dTable(GPy.core.Mapping):
+    # Posterior mean of a 1d model at the 10 electrode positions (computed
+    # once, see grid_predict), looked up with the xy in cols of X (eg.
+    # [0,1] for ch1, [2,3] for ch2) instead of predicting with the 1d GP
+    # at every evaluation. It has no parameters
+    def __init__(self, m1d, cols, input_dim=4):
+        super(Prior1dTable, self).__init__(input_dim, 1)
+        self.table = grid_predict(m1d, GRID_1D)[0].reshape((2,5))
+        self.cols = list(cols)
+
+    def f(self, X):
+        return self.table[X[:,self.cols[0]].astype(int), X[:,self.cols[1]].astype(int)][:,None]
+
+    def update_gradients(self, dL_dF, X):
+        pass
+
+    def gradients_X(self, dL_dF, X):
+        return np.zeros(X.shape)
 
 def build_prior(m1d1, m1d2=None, dtprior=False, input_dim=4):
+    # f1, f2 are the 1d models' means of ch1 and ch2 (see Prior1dTable),
+    # and the Linear mappings on top of them are learnt with the GP
     if m1d2 is None:
         m1d2 = m1d1
-    f1 = GPy.core.Mapping(input_dim,1)
-    def f_1(x):
-        return m1d1.predict(x[:,0:2])[0]
-    f1.f = f_1
-    f1.update_gradients = lambda a,b: None
-    
-    f2 = GPy.core.Mapping(input_dim,1)
-    def f_2(x):
-        return m1d2.predict(x[:,2:4])[0]
-    f2.f = f_2
-    f2.update_gradients = lambda a,b: None
+    f1 = Prior1dTable(m1d1, [0,1], input_dim)
+    f2 = Prior1dTable(m1d2, [2,3], input_dim)
 
     if not dtprior:
         # prior = a*f1 + b*f2
@@ -123,11 +260,19 @@ def build_prior(m1d1, m1d2=None, dtprior=False, input_dim=4):
                                    GPy.mappings.Compound(mfsub, GPy.mappings.Linear(1,1)))
     return mf
 
-def train_models_2d(X,Y, kerneltype='add', symkern=False, num_restarts=1, prior1d=None, optimize=True, ARD=False, dtprior=False, constrain=False):
+def train_models_2d(X,Y, kerneltype='add', symkern=False, num_restarts=1, prior1d=None, optimize=True, ARD=False, dtprior=False, constrain=False, counts=None, scatter=0., kron=False, backend='gpy'):
+    # counts/scatter: X,Y are collapsed cell means (make_dataset_2d(collapse=True))
+    # kron: use KronGPRegression on GRID_2D (see gp_kron, needs a
+    # separable kernel, eg. kerneltype='prod', and no symkern)
+    # backend: 'gpy' or 'numpy' (see gp_numpy, which has no symkern,
+    # counts or kron)
+    lib = get_backend(backend)
+    if backend != 'gpy' and (symkern or kron or counts is not None):
+        raise Exception("symkern, kron and counts need backend='gpy'")
     # Additive kernel
     if kerneltype == 'add':
-        k1 = GPy.kern.Matern52(input_dim=2, active_dims=[0,1], ARD=ARD)
-        k2 = GPy.kern.Matern52(input_dim=2, active_dims=[2,3], ARD=ARD)
+        k1 = lib.kern.Matern52(input_dim=2, active_dims=[0,1], ARD=ARD)
+        k2 = lib.kern.Matern52(input_dim=2, active_dims=[2,3], ARD=ARD)
         k = k1 + k2
         if prior1d:
             k.Mat52.lengthscale = k.Mat52_1.lengthscale = prior1d.Mat52.lengthscale
@@ -139,7 +284,7 @@ def train_models_2d(X,Y, kerneltype='add', symkern=False, num_restarts=1, prior1
             k.Mat52_1.variance.constrain_bounded(5e-4, 1e-3)
     # Full SE
     elif kerneltype == 'mult':
-        k = GPy.kern.Matern52(input_dim=4, ARD=ARD)
+        k = lib.kern.Matern52(input_dim=4, ARD=ARD)
         if prior1d:
             # We do these two differently in case prior1d has an ARD kernel
             k.lengthscale[:2] = prior1d.Mat52.lengthscale
@@ -148,26 +293,45 @@ def train_models_2d(X,Y, kerneltype='add', symkern=False, num_restarts=1, prior1
         if constrain:
             k.lengthscale.constrain_bounded(0.3,3)
             k.variance.constrain_bounded(5e-4, 1e-3)
+    # Product of one kernel per electrode (separable, unlike 'mult')
+    elif kerneltype == 'prod':
+        k1 = lib.kern.Matern52(input_dim=2, active_dims=[0,1], ARD=ARD)
+        k2 = lib.kern.Matern52(input_dim=2, active_dims=[2,3], ARD=ARD)
+        if prior1d:
+            k1.lengthscale = k2.lengthscale = prior1d.Mat52.lengthscale
+            # so that the product has the variance of prior1d
+            k1.variance = k2.variance = np.sqrt(prior1d.Mat52.variance)
+        if constrain:
+            k1.lengthscale.constrain_bounded(0.3,3)
+            k2.lengthscale.constrain_bounded(0.3,3)
+        k = k1 * k2
     else:
-        raise Exception("kerneltype should be add or mult")
+        raise Exception("kerneltype should be add, mult or prod")
     # Symmetric SE
     if symkern:
         symM = np.block([[np.zeros((2,2)),np.eye(2)],[np.eye(2),np.zeros((2,2))]])
-        k = GPy.kern.Symmetric(k, symM)
+        k = PairSymmetric(k, symM)
 
+    mf = build_prior(prior1d, dtprior=dtprior) if prior1d else None
+    if kron:
+        if symkern:
+            raise Exception("kron doesn't work with symkern (the kernel isn't separable)")
+        m = KronGPRegression(X,Y,k, GRID_2D, counts=counts, scatter=scatter, mean_function=mf)
+    elif counts is not None:
+        m = CollapsedGPRegression(X,Y,counts,scatter,k, mean_function=mf)
+    else:
+        m = lib.models.GPRegression(X,Y,k, mean_function=mf)
     if prior1d:
-        m = GPy.models.GPRegression(X,Y,k, mean_function= build_prior(prior1d, dtprior=dtprior))
         m.Gaussian_noise.variance = prior1d.Gaussian_noise.variance
-    else:
-        m = GPy.models.GPRegression(X,Y,k)
     if optimize:
         m.optimize_restarts(num_restarts=num_restarts)
 
     return m
 
-def make_add_model(X,Y,prior1d=None, prevmodel=None, ARD=False, dtprior=False, constrain=True):
-    k1 = GPy.kern.Matern52(input_dim=2, active_dims=[0,1], ARD=ARD)
-    k2 = GPy.kern.Matern52(input_dim=2, active_dims=[2,3], ARD=ARD)
+def make_add_model(X,Y,prior1d=None, prevmodel=None, ARD=False, dtprior=False, constrain=True, backend='gpy'):
+    lib = get_backend(backend)
+    k1 = lib.kern.Matern52(input_dim=2, active_dims=[0,1], ARD=ARD)
+    k2 = lib.kern.Matern52(input_dim=2, active_dims=[2,3], ARD=ARD)
     k = k1 + k2
     if constrain:
             k.Mat52.lengthscale.constrain_bounded(0.3,3)
@@ -181,101 +345,224 @@ def make_add_model(X,Y,prior1d=None, prevmodel=None, ARD=False, dtprior=False, c
         # previous model's hyperparameters and need to reoptimize for
         # kernel/mapping parameters each seq optimization (make sure continue_opt=True)
         if prevmodel:
-            m = GPy.models.GPRegression(X,Y,kernel=prevmodel.sum.copy(), mean_function= build_prior(prior1d, dtprior=dtprior))
+            m = lib.models.GPRegression(X,Y,kernel=prevmodel.sum.copy(), mean_function= build_prior(prior1d, dtprior=dtprior))
         else:
-            m = GPy.models.GPRegression(X,Y,k, mean_function= build_prior(prior1d, dtprior=dtprior))
+            m = lib.models.GPRegression(X,Y,k, mean_function= build_prior(prior1d, dtprior=dtprior))
         return m
     if prevmodel and prior1d:
-        m = GPy.models.GPRegression(X,Y,kernel=prevmodel.sum.copy(), mean_function=prevmodel.mapping.copy())
+        m = lib.models.GPRegression(X,Y,kernel=prevmodel.sum.copy(), mean_function=prevmodel.mapping.copy())
         m[:] = prevmodel[:]
     elif prevmodel:
         #There is a previous model but it doesn't use prior (so no
         #mean mapping)
-        m = GPy.models.GPRegression(X,Y,kernel=prevmodel.sum.copy())
+        m = lib.models.GPRegression(X,Y,kernel=prevmodel.sum.copy())
         m.Gaussian_noise.variance = prevmodel.Gaussian_noise.variance
     elif prior1d:
         #We are building a model for first time, but with a 1d prior
-        m = GPy.models.GPRegression(X,Y,k, mean_function=build_prior(prior1d, dtprior=dtprior))
+        m = lib.models.GPRegression(X,Y,k, mean_function=build_prior(prior1d, dtprior=dtprior))
         m.sum.Mat52.lengthscale = m.sum.Mat52_1.lengthscale = prior1d.Mat52.lengthscale
         m.sum.Mat52.variance = m.sum.Mat52_1.variance = prior1d.Mat52.variance
         m.Gaussian_noise.variance = prior1d.Gaussian_noise.variance
     else:
-        m = GPy.models.GPRegression(X,Y,k)
+        m = lib.models.GPRegression(X,Y,k)
     return m
 
-def train_model_seq_2d(trainsC, n_random_pts=10, n_total_pts=15, n_prior_queries=3, num_restarts=1, ARD=False, prior1d=None, fix=False, continue_opt=True, emg=emg, syn=None, dt=dt, dtprior=False, sa=True, symkern=False, multkern=False, T=0.001, constrain=True, k=2):
-    trains = trainsC.get_emgdct(emg)
+def train_model_seq_2d(trainsC, n_random_pts=10, n_total_pts=15, n_prior_queries=3, num_restarts=1, ARD=False, prior1d=None, fix=False, continue_opt=True, emg=emg, syn=None, dt=dt, dtprior=False, sa=True, symkern=False, multkern=False, T=0.001, constrain=True, k=2, f='max', sampler=None, seed=None, incremental=False, refit=None, save_preds=True, canonical=False, backend='gpy', batch_size=1, batch_strategy='kb', thompson=False):
+    # backend: 'gpy' or 'numpy' (see gp_numpy)
+    # thompson: query the argmax of joint posterior draws on the grid
+    # (Thompson sampling) instead of UCB (sa, T and k are then ignored)
+    # batch_size: number of queries per round (picked with
+    # batch_strategy, see gp_batch), the model is only updated once all
+    # of them are in. Refits (and the models returned) are per round
+    # If incremental (and not continue_opt), the hyperparameters are kept
+    # fixed after the first fit (for all kernels) and each new query only
+    # extends the cholesky factor of the previous model (see IncrementalGP).
+    # refit is a RefitSchedule spec (eg. 'every:5'), and replaces continue_opt:
+    # hyperparameters are only re-optimized at the scheduled steps
+    # sampler simulates the stimulator (see ResponseSampler). By
+    # default we draw (with replacement) from the f feature of emg/syn
+    # The models of all steps are returned as a SeqModels (with their
+    # posterior on GRID_2D if save_preds)
+    # If canonical (dt=0 with symkern), we only query the 55 canonical
+    # pairs (see canonical_pairs), and a query of (ch1,ch2) gets a
+    # trial of either (ch1,ch2) or (ch2,ch1)
+    if canonical:
+        assert dt == 0 and symkern, "canonical only makes sense for dt=0 with symkern"
+    if sampler is None:
+        sampler = ResponseSampler(trainsC, emg=emg, syn=syn, f=f, seed=seed, symmetric=canonical)
     if dtprior:
         assert(continue_opt), "if dtprior is True, must set continue_opt to true"
         assert(prior1d is not None), "if dtprior is True, must give prior1d"
     X = []
     Y = []
+    kerneltype = 'mult' if multkern else 'add'
+    def build(X, Y, params, kerneltype):
+        # GPy model for data X,Y with hyperparameters params (not optimized)
+        if symkern or multkern:
+            m = train_models_2d(X, Y, prior1d=prior1d, ARD=ARD, kerneltype=kerneltype, symkern=symkern, constrain=constrain, optimize=False, backend=backend)
+        else:
+            m = make_add_model(X, Y, prior1d=prior1d, ARD=ARD, dtprior=dtprior, constrain=constrain, backend=backend)
+        m[:] = params
+        return m
     if prior1d:
         # query pts around n_prior_queries max chs of prior1d
         nmaxchs = get_nmaxch(prior1d, n=n_prior_queries)
         for xych1 in nmaxchs:
-            ch1 = xy2ch[xych1[0]][xych1[1]]
             for xych2 in nmaxchs:
-                ch2 = xy2ch[xych2[0]][xych2[1]]
                 X.append(xych1+xych2)
-                if syn is None:
-                    resp = random.choice(trainsC.get_resp(emg,dt,ch1,ch2).max(axis=1))
-                else:
-                    resp = random.choice(trainsC.synergy(syn[0], syn[1], ch1, ch2, dt).max(axis=1))
-                Y.append(resp)
+        chs1 = [get_ch(x[0:2]) for x in X]
+        chs2 = [get_ch(x[2:4]) for x in X]
+        Y.extend(sampler.sample(chs1, chs2, dt).tolist())
     else:
         # we need this so as to query the right total # of pts
         # (for loop below has - n_prior_queries**2)
         n_prior_queries = 0
 
-    for _ in range(n_random_pts - n_prior_queries**2):
-        ch1 = random.choice(CHS)
-        ch2 = random.choice(CHS)
-        X.append(ch2xy[ch1] + ch2xy[ch2])
-        if syn is None:
-            resp = random.choice(trainsC.get_resp(emg,dt,ch1,ch2).max(axis=1))
-        else:
-            resp = random.choice(trainsC.synergy(syn[0], syn[1], ch1, ch2, dt).max(axis=1))
-        Y.append(resp)
+    chs1,chs2,_ = sampler.random_cells(max(n_random_pts - n_prior_queries**2, 0))
+    X.extend([ch2xy[ch1] + ch2xy[ch2] for ch1,ch2 in zip(chs1,chs2)])
+    Y.extend(sampler.sample(chs1, chs2, dt).tolist())
+    if canonical:
+        X = canonical_pairs(X).tolist()
     #We save every model after each query
-    models = []
+    models = SeqModels(build, GRID_2D if save_preds else None)
 
     if symkern:
-        m = train_models_2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, kerneltype='mult' if multkern else 'add',symkern=True, constrain=constrain)
+        m = train_models_2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, kerneltype=kerneltype,symkern=True, constrain=constrain, backend=backend)
     elif multkern:
-        m = train_models_2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, kerneltype='mult', constrain=constrain)
+        m = train_models_2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, kerneltype='mult', constrain=constrain, backend=backend)
     else:
-        m = make_add_model(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, dtprior=dtprior, constrain=constrain)
+        m = make_add_model(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, dtprior=dtprior, constrain=constrain, backend=backend)
         if fix:
             # fix all kernel parameters and only optimize for mean (prior) mapping
             m.kern.fix()
             m.Gaussian_noise.fix()
         m.optimize_restarts(num_restarts=num_restarts)
-    models.append(m)
-    for _ in range(n_total_pts-n_random_pts):
-        nextx = get_next_x(m, sa=sa, T=T, k=k)
-        X.append(nextx)
-        ch1 = xy2ch[nextx[0]][nextx[1]]
-        ch2 = xy2ch[nextx[2]][nextx[3]]
-        if syn is None:
-            resp = random.choice(trainsC.get_resp(emg,dt,ch1,ch2).max(axis=1))
-        else:
-            resp = random.choice(trainsC.synergy(syn[0], syn[1], ch1, ch2, dt).max(axis=1))
-        Y.append(resp)
-        if symkern:
-            m = train_models_2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, kerneltype='mult',symkern=True, constrain=constrain)
+    models.append(m, kerneltype)
+    if refit is not None:
+        refit = RefitSchedule(refit)
+        incremental = incremental and refit.name != 'always'
+    else:
+        incremental = incremental and not continue_opt
+    if incremental:
+        gp = IncrementalGP.from_gpy(m)
+    # fitted is the last GPy model, whose hyperparameters we use
+    fitted = m
+    refits = []
+    refit_times = []
+    t0 = time.time()
+    nseq = n_total_pts - n_random_pts
+    for step in range(1, -(-nseq // batch_size) + 1):
+        # the last round may have less than batch_size queries
+        nextxs = get_next_xs(m, min(batch_size, nseq - (step-1)*batch_size), sa=sa, T=T, k=k, canonical=canonical, strategy=batch_strategy, thompson=thompson)
+        resps = []
+        for nextx in nextxs:
+            X.append(nextx)
+            ch1 = xy2ch[nextx[0]][nextx[1]]
+            ch2 = xy2ch[nextx[2]][nextx[3]]
+            resps.append(float(sampler.sample(ch1, ch2, dt)))
+        Y.extend(resps)
+        if symkern and kerneltype != 'mult' and (refit is not None or incremental):
+            # As without refit/incremental (below), symkern switches to
+            # the mult kernel after the first query, whose hyperparameters
+            # have to be fit (the schedule still counts the step)
+            kerneltype = 'mult'
+            t = time.time()
+            m = train_models_2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, kerneltype='mult',symkern=True, constrain=constrain, backend=backend)
+            if refit is not None:
+                refit(step, m)
+                refits.append(step)
+                refit_times.append(time.time() - t)
+            fitted = m
+            if incremental:
+                gp = IncrementalGP.from_gpy(m)
+        elif refit is not None:
+            # Only re-optimize when the schedule says so, warm started
+            # from the last hyperparameters and without random restarts
+            if refit.needs_model or not incremental:
+                m = build(np.array(X), np.array(Y)[:,None], fitted[:], kerneltype)
+            else:
+                m = None
+            if refit(step, m):
+                if m is None:
+                    m = build(np.array(X), np.array(Y)[:,None], fitted[:], kerneltype)
+                t = time.time()
+                m.optimize()
+                refits.append(step)
+                refit_times.append(time.time() - t)
+                fitted = m
+                if incremental:
+                    gp = IncrementalGP.from_gpy(m)
+            elif incremental:
+                for nextx,resp in zip(nextxs, resps):
+                    gp.add(nextx, resp)
+                m = gp.snapshot()
+        elif incremental:
+            for nextx,resp in zip(nextxs, resps):
+                gp.add(nextx, resp)
+            m = gp.snapshot()
+        elif symkern:
+            kerneltype = 'mult'
+            m = train_models_2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, kerneltype='mult',symkern=True, constrain=constrain, backend=backend)
         elif multkern:
-            m = train_models_2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, kerneltype='mult', constrain=constrain)
+            m = train_models_2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, ARD=ARD, kerneltype='mult', constrain=constrain, backend=backend)
         else:
-            m = make_add_model(np.array(X), np.array(Y)[:,None], prior1d=prior1d, prevmodel=models[-1], ARD=ARD, dtprior=dtprior, constrain=constrain)
+            m = make_add_model(np.array(X), np.array(Y)[:,None], prior1d=prior1d, prevmodel=m, ARD=ARD, dtprior=dtprior, constrain=constrain, backend=backend)
             # If continue optimize, we optimize params after every query
             if continue_opt:
                 m.optimize_restarts(num_restarts=num_restarts)
-        models.append(m)
+        models.append(m, kerneltype)
     dct = {
         'models': models,
         'nrnd': n_random_pts,
-        'ntotal': n_total_pts
+        'ntotal': n_total_pts,
+        # sequential steps after which we re-optimized (only with refit)
+        'refits': refits,
+        'refit_times': refit_times,
+        'batch_size': batch_size,
+        'time': time.time() - t0
+    }
+    return dct
+
+def train_models_lockstep_2d(trainsC, m, repeat=25, n_random_pts=10, n_total_pts=15, n_prior_queries=3, prior1d=None, emg=emg, syn=None, dt=dt, sa=True, T=0.001, k=2, f='max', seed=None, canonical=False):
+    # Simulates <repeat> runs of train_model_seq_2d together (see
+    # gp_lockstep), all with the hyperparameters (kernel, noise, mean
+    # function) of m, which stay fixed. As in train_model_seq_2d, every
+    # run starts with the pairs of the n_prior_queries max chs of prior1d
+    # (if given) and random pairs, and has its own sampler (the samplers
+    # and the sa sampling are seeded from seed)
+    # Returns the queries X (repeat,n_total_pts,4) and their indices in
+    # GRID_2D, the responses Y and the posterior means on GRID_2D after
+    # the initial queries and after every sequential one
+    # (repeat,n_total_pts-n_random_pts+1,100)
+    seeds = np.random.SeedSequence(seed).spawn(repeat+1)
+    samplers = [ResponseSampler(trainsC, emg=emg, syn=syn, f=f, seed=s, symmetric=canonical) for s in seeds[:repeat]]
+    X = []
+    if prior1d:
+        nmaxchs = get_nmaxch(prior1d, n=n_prior_queries)
+        X = [xych1+xych2 for xych1 in nmaxchs for xych2 in nmaxchs]
+    else:
+        n_prior_queries = 0
+    X0 = []
+    for sampler in samplers:
+        chs1,chs2,_ = sampler.random_cells(max(n_random_pts - n_prior_queries**2, 0))
+        X0.append(X + [ch2xy[ch1] + ch2xy[ch2] for ch1,ch2 in zip(chs1,chs2)])
+    X0 = np.array(X0, dtype=int).reshape((repeat, -1, 4))
+    if canonical:
+        X0 = canonical_pairs(X0.reshape((-1,4))).reshape(X0.shape)
+    idx0 = np.ravel_multi_index(tuple(np.moveaxis(X0, -1, 0)), (2,5,2,5))
+    cells = ([xy2ch[x][y] for x,y in GRID_2D[:,0:2]], [xy2ch[x][y] for x,y in GRID_2D[:,2:4]], np.full(len(GRID_2D), dt))
+    gp = LockstepGP.from_model(m, GRID_2D, repeat)
+    t0 = time.time()
+    D = lockstep_runs(gp, samplers, cells, idx0, n_total_pts-n_random_pts, k=k, sa=sa, T=T,
+                      cands=SYM_IDX if canonical else None, rng=np.random.default_rng(seeds[-1]))
+    dct = {
+        'X': GRID_2D[D['idx']],
+        'idx': D['idx'],
+        'Y': D['Y'],
+        'means': D['means'],
+        'nrnd': n_random_pts,
+        'ntotal': n_total_pts,
+        'time': time.time() - t0
     }
     return dct
 
@@ -283,23 +570,41 @@ def softmax(x, T=0.001):
     e = np.exp(x/T)
     return e/sum(e)
 
-def get_next_x(m, k=2, sa=False, T=0.001):
-    X,acq = get_acq_map(m,k)
+def pick_idx(acq, sa=False, T=0.001):
     if sa:
         # SA is for simulated annealing (sample instead of taking max)
         sm = softmax(acq, T=T).flatten()
-        nextidx = np.random.choice(range(len(acq)), p=sm)
-    else:
-        nextidx = acq.argmax()
-    nextx = X[nextidx]
+        return np.random.choice(range(len(acq)), p=sm)
+    return acq.argmax()
+
+def get_next_x(m, k=2, sa=False, T=0.001, canonical=False, thompson=False):
+    X,acq = get_acq_map(m,k, canonical=canonical, thompson=thompson)
+    nextx = X[pick_idx(acq, sa=sa and not thompson, T=T)]
     return nextx
 
-def get_acq_map(m, k=2):
+def get_next_xs(m, q, k=2, sa=False, T=0.001, canonical=False, strategy='kb', thompson=False):
+    # q distinct pairs to query in one round (see gp_batch). The first
+    # one is the same as get_next_x's
+    if thompson:
+        strategy, sa = 'ts', False
+    idx = batch_idx(m, GRID_2D, q, lambda acq: pick_idx(acq, sa=sa, T=T), k=k,
+                    strategy=strategy, cands=SYM_IDX if canonical else None)
+    return GRID_2D[idx]
+
+def get_acq_map(m, k=2, canonical=False, thompson=False):
     # We use UCB, k is the "exploration" parameter
-    X = np.array(list(itertools.product(range(2),range(5), range(2), range(5))))
-    mean,var = m.predict(X)
-    std = np.sqrt(var)
-    acq = mean + k*std
+    # If thompson, the map is a joint posterior draw of f instead (see
+    # grid_samples)
+    # If canonical, only on the 55 canonical pairs (GRID_2D[SYM_IDX])
+    X = GRID_2D
+    if thompson:
+        acq = grid_samples(m, X)[0][:,None]
+    else:
+        mean,var = grid_predict(m, X)
+        std = np.sqrt(var)
+        acq = mean + k*std
+    if canonical:
+        return X[SYM_IDX], acq[SYM_IDX]
     return X,acq
 
 def make_2d_grid():
@@ -328,7 +633,7 @@ def plot_model_2d(m, k=-1, fulldatam=None, title="", plot_acq=False, plot_revers
                 ax = axes[2*i+x2i][j]
                 m.plot(ax=ax, fixed_inputs=[(0,i),(1,j),(2,x2i)], plot_data=False, legend=False)
                 # We also plot the max found
-                maxx = m.predict(make_2d_grid())[0].max()
+                maxx = grid_predict(m, GRID_2D)[0].max()
                 x = np.arange(0,4,0.1)
                 ax.plot(x,np.ones(len(x))*maxx, c='r')
                 # And the mean of the full-data-gp, if present
@@ -381,7 +686,7 @@ def plot_model_2d_reverse(m, fulldatam=None, title="", plot_acq=False):
                 m.plot(ax=ax, fixed_inputs=[(2,i),(3,j),(0,x2i)], plot_data=False, legend=False)
                 
                 # We also plot the max found
-                maxx = m.predict(make_2d_grid())[0].max()
+                maxx = grid_predict(m, GRID_2D)[0].max()
                 x = np.arange(0,4,0.1)
                 ax.plot(x,np.ones(len(x))*maxx, c='r')
                 # And the mean of the full-data-gp, if present
@@ -399,14 +704,14 @@ def plot_model_2d_reverse(m, fulldatam=None, title="", plot_acq=False):
         plt.colorbar()
 
 def l2dist(m1, m2):
-    X = make_2d_grid()
-    pred1 = m1.predict(X)[0]
-    pred2 = m2.predict(X)[0]
+    X = GRID_2D
+    pred1 = grid_predict(m1, X)[0]
+    pred2 = grid_predict(m2, X)[0]
     return LA.norm(pred1-pred2)
 def linfdist(m1, m2):
-    X = np.array(list(itertools.product(range(2),range(5), range(2), range(5))))
-    pred1 = m1.predict(X)[0]
-    pred2 = m2.predict(X)[0]
+    X = GRID_2D
+    pred1 = grid_predict(m1, X)[0]
+    pred2 = grid_predict(m2, X)[0]
     # Note that in the 1d linfdist, we divide by pred2.max() so as to normalize
     return abs(pred1.max() - pred2.max())
 
@@ -415,20 +720,76 @@ def get_ch_pair(wxyz):
     return [get_ch([w,x]), get_ch([y,z])]
 
 def get_maxchpair(m):
-    X = np.array(list(itertools.product(range(2),range(5), range(2), range(5))))
-    means,_ = m.predict(X)
+    X = GRID_2D
+    means,_ = grid_predict(m, X)
     maxidx = means.argmax()
     maxwxyz = np.unravel_index(maxidx, (2,5,2,5))
     maxchpair = get_ch_pair(maxwxyz)
     return maxchpair
 
-def run_ch_stats_exps(trainsC, emg=emg, dt=dt, uid='', jobid=None, repeat=25, continue_opt=True, k=2, dtprior=False, ntotal=150, nrnd = [15,76,10], sa=True, multkern=False, symkern=False, ARD=False, T=0.001, constrain=True, n_prior_queries=3):
+def _run_task_2d(task):
+    # One run of run_ch_stats_exps (a task of run_tasks): the arguments
+    # of train_model_seq_2d, whether it uses the 1d prior, and its seed
+    kwargs, use_prior, ss = task
+    ntotal = kwargs['n_total_pts']
+    sampler_seed = seed_task(ss)
+    D = train_model_seq_2d(shared('trainsC'), prior1d=shared('m1d') if use_prior else None, seed=sampler_seed, **kwargs)
+    models = D['models']
+    res = {
+        'queriedchs': [get_ch_pair(xy) for xy in models[-1].X],
+        'maxchs': np.zeros((ntotal, 2)),
+        'vals': np.zeros((ntotal, 100)),
+        'rounds': np.zeros(ntotal, dtype=int),
+        'pcorrect': np.zeros(ntotal),
+        'time': D['time'],
+        'nrefits': len(D['refits'])
+    }
+    for r,rnd,m in query_steps(models, ntotal):
+        res['maxchs'][r] = get_maxchpair(m)
+        res['vals'][r] = grid_predict(m, GRID_2D)[0].reshape((-1))
+        res['rounds'][r] = rnd
+        res['pcorrect'][r] = argmax_probs(m, GRID_2D)[shared('true_idx')]
+    return res
+
+# results of run_ch_stats_exps (see gp_results), in get_exppath
+RESULTS_FILE = 'chruns2d.h5'
+
+# arguments of run_ch_stats_exps that are in get_exppath's path (or
+# don't change the results)
+PATH_ARGS = ('trainsC', 'uid', 'jobid', 'workers', 'emg', 'dt', 'multkern', 'symkern', 'ARD', 'k')
+
+def get_exppath(uid, emg=emg, dt=dt, multkern=False, symkern=False, ARD=False, k=2, config=None):
+    # directory of the results of run_ch_stats_exps. With config (see
+    # exp_config), in a subdirectory named after a hash of the other
+    # arguments, so that experiments which differ in any of them (refit,
+    # backend, nrnd, seed...) don't share their results and checkpoints
+    exppath = path.join('exps', '2d', 'exp{}'.format(uid), 'emg{}'.format(emg), 'dt{}'.format(dt), 'multkern{}'.format(multkern), 'symkern{}'.format(symkern), 'ARD{}'.format(ARD), 'k{}'.format(k))
+    if config is not None:
+        other = {name: v for name,v in config.items() if name not in PATH_ARGS}
+        exppath = path.join(exppath, 'cfg{}'.format(config_hash(other)))
+    return exppath
+
+def exp_config(**kwargs):
+    # the arguments of run_ch_stats_exps(**kwargs), defaults included
+    args = inspect.signature(run_ch_stats_exps).bind_partial(**kwargs)
+    args.apply_defaults()
+    return args.arguments
+
+def run_ch_stats_exps(trainsC, emg=emg, dt=dt, uid='', jobid=None, repeat=25, continue_opt=True, k=2, dtprior=False, ntotal=150, nrnd = [15,76,10], sa=True, multkern=False, symkern=False, ARD=False, T=0.001, constrain=True, n_prior_queries=3, incremental=False, refit=None, canonical=False, backend='gpy', batch_size=1, batch_strategy='kb', thompson=False, lockstep=False, workers=1, seed=None):
+    # The runs are run on <workers> processes, seeded from seed (see gp_pool)
+    # If lockstep, the hyperparameters of every model are fit once (for
+    # each nrnd) on the initial queries of a pilot run and the <repeat>
+    # runs share them, kept fixed, and are simulated together (see
+    # train_models_lockstep_2d). pcorrect is then not computed (nan)
+    # (the arguments as given, for get_exppath)
+    config = exp_config(**locals())
+    assert(continue_opt or not dtprior), "if dtprior is True, must set continue_opt to true"
     if uid == '':
         uid = random.randrange(10000)
     assert(type(nrnd) is list and len(nrnd) == 3)
     trains = trainsC.get_emgdct(emg)
     nrnd = range(*nrnd)
-    exppath = path.join('exps', '2d', 'exp{}'.format(uid), 'emg{}'.format(emg), 'dt{}'.format(dt), 'multkern{}'.format(multkern), 'symkern{}'.format(symkern), 'ARD{}'.format(ARD), 'k{}'.format(k))
+    exppath = get_exppath(uid, emg, dt, multkern, symkern, ARD, k, config=config)
     if not path.isdir(exppath):
         os.makedirs(exppath)
     if jobid:
@@ -439,52 +800,89 @@ def run_ch_stats_exps(trainsC, emg=emg, dt=dt, uid='', jobid=None, repeat=25, co
             f.write('sbatcjobid = {}'.format(jobid))
     n_ch = 2 # pair of channel for 2d experiment
     n_models = 3 if dtprior else 2
-    # Build 1d model for modelsprior
-    X1d,Y1d = make_dataset_1d(trainsC, emg=emg)
-    X = np.array(list(itertools.product(range(2),range(5), range(2), range(5))))
-    m1d = train_model_1d(X1d,Y1d, ARD=ARD)
+    kwargs = dict(n_total_pts=ntotal, num_restarts=1, continue_opt=continue_opt, ARD=ARD, dt=dt, emg=emg,
+                  sa=sa, multkern=multkern, symkern=symkern, T=T, constrain=constrain,
+                  n_prior_queries=n_prior_queries, k=k, incremental=incremental, refit=refit,
+                  canonical=canonical, backend=backend, batch_size=batch_size,
+                  batch_strategy=batch_strategy, thompson=thompson)
+    if not lockstep:
+        # checkpoints of the runs (see gp_checkpoint)
+        store = TaskStore(path.join(exppath, 'tasks'), dict(kwargs, repeat=repeat, nrnd=nrnd, n_models=n_models), seed)
+        seed = store.seed
+    # One seed per run, and one (the last) for this process (the
+    # lockstep runs)
+    seed, seeds = task_seeds(seed, n_models*repeat*len(nrnd) + 1)
+    seed_task(seeds.pop())
+    # Build 1d model for modelsprior (its fit is seeded by fit_cached, so
+    # it is the same in every experiment)
+    X1d,Y1d = make_dataset_1d(trainsC, emg=emg, seed=REF_SEED)
+    X = GRID_2D
+    m1d = fit_cached(train_model_1d, X1d,Y1d, ARD=ARD, backend=backend)
     # queriedchs contains <n_ch> queried channels for all <repeat> runs of <ntotal>
     # queries with <nrnd> initial random pts for each of <n_models> models
     queriedchs = np.zeros((n_models, repeat, len(nrnd), ntotal, n_ch))
     maxchs = np.zeros((n_models, repeat, len(nrnd), ntotal, n_ch))
     vals = np.zeros((n_models, repeat, len(nrnd), ntotal, 100))
-    for repeat in range(repeat):
-        print("Repeat", repeat)
+    # wall-clock time of the sequential queries of each run, and the number
+    # of hyperparameter re-optimizations it did (only counted with refit)
+    runtimes = np.zeros((n_models, repeat, len(nrnd)))
+    nrefits = np.zeros((n_models, repeat, len(nrnd)), dtype=int)
+    # rounds (model updates) done before each query's model (= queries
+    # - nrnd with batch_size=1), to plot regret against rounds
+    rounds = np.zeros((n_models, repeat, len(nrnd), ntotal), dtype=int)
+    # posterior probability that the true best pair is the argmax (see
+    # argmax_probs), after each query
+    pcorrect = np.zeros((n_models, repeat, len(nrnd), ntotal))
+    true_chpair = trainsC.max_ch_2d(emg,dt)
+    true_idx = np.ravel_multi_index(ch2xy[true_chpair[0]] + ch2xy[true_chpair[1]], (2,5,2,5))
+    # the arrays are also written to RESULTS_FILE, run by run
+    results = ResultsStore(os.path.join(exppath, RESULTS_FILE),
+                           {'queriedchs': queriedchs, 'maxchs': maxchs, 'vals': vals, 'rounds': rounds,
+                            'pcorrect': pcorrect, 'runtimes': runtimes, 'nrefits': nrefits},
+                           config=dict(kwargs, repeat=repeat, nrnd=nrnd, n_models=n_models, lockstep=lockstep,
+                                       seed=None if lockstep else seed))
+    if lockstep:
+        assert batch_size == 1 and not thompson, "lockstep only simulates UCB runs with batch_size=1"
+        chpairs = np.array([get_ch_pair(xy) for xy in GRID_2D])
+        pcorrect[:] = np.nan
+        # (prior1d, dtprior) of the models
+        arms = [(None, False), (m1d, False), (m1d, True)][:n_models]
         for i,n1 in enumerate(nrnd):
             print(n1, "random init pts")
-            modelsD = train_model_seq_2d(trainsC,n_random_pts=n1, n_total_pts=ntotal,
-                                         num_restarts=1, continue_opt=continue_opt, ARD=ARD,
-                                         dt=dt, emg=emg, sa=sa, multkern=multkern,
-                                         symkern=symkern, T=T, constrain=constrain,
-                                         n_prior_queries=n_prior_queries, k=k)
-            modelspriorD = train_model_seq_2d(trainsC,n_random_pts=n1, n_total_pts=ntotal,
-                                             num_restarts=1, continue_opt=continue_opt,
-                                             prior1d=m1d, dt=dt, emg=emg, dtprior=False,
-                                              sa=sa, multkern=multkern, symkern=symkern,
-                                              ARD=ARD, T=T, constrain=constrain,
-                                              n_prior_queries=n_prior_queries, k=k)
-            models = modelsD['models']
-            modelsprior = modelspriorD['models']
-            queriedchs[0][repeat][i] = [get_ch_pair(xy) for xy in models[-1].X]
-            queriedchs[1][repeat][i] = [get_ch_pair(xy) for xy in modelsprior[-1].X]
-            for r,m in enumerate(models,n1-1):
-                maxchs[0][repeat][i][r] = get_maxchpair(m)
-                vals[0][repeat][i][r] = m.predict(X)[0].reshape((-1))
-            for r,m in enumerate(modelsprior,n1-1):
-                maxchs[1][repeat][i][r] = get_maxchpair(m)
-                vals[1][repeat][i][r] = m.predict(X)[0].reshape((-1))
-            if dtprior:
-                modelsdtpriorD = train_model_seq_2d(trainsC,n_random_pts=n1, n_total_pts=ntotal,
-                                             num_restarts=1, continue_opt=continue_opt,
-                                                   prior1d=m1d, dt=dt, emg=emg, dtprior=True,
-                                                    sa=sa, multkern=multkern, symkern=symkern,
-                                                    ARD=ARD, T=T, constrain=constrain,
-                                                    n_prior_queries=n_prior_queries, k=k)
-                modelsdtprior = modelsdtpriorD['models']
-                queriedchs[2][repeat][i] = [get_ch_pair(xy) for xy in modelsdtprior[-1].X]
-                for r,m in enumerate(modelsdtprior,n1-1):
-                    maxchs[2][repeat][i][r] = get_maxchpair(m)
-                    vals[2][repeat][i][r] = m.predict(X)[0].reshape((-1))
+            for j,(prior,dtp) in enumerate(arms):
+                if results.done((j,slice(None),i)):
+                    # (done by a previous launch, read back by results)
+                    continue
+                pilot = train_model_seq_2d(trainsC, n_random_pts=n1, n_total_pts=n1, num_restarts=1,
+                                           continue_opt=continue_opt, ARD=ARD, prior1d=prior, dt=dt,
+                                           emg=emg, dtprior=dtp, multkern=multkern, symkern=symkern,
+                                           constrain=constrain, n_prior_queries=n_prior_queries,
+                                           canonical=canonical, backend=backend, save_preds=False)
+                D = train_models_lockstep_2d(trainsC, pilot['models'][0].model, repeat=repeat, n_random_pts=n1,
+                                             n_total_pts=ntotal, n_prior_queries=n_prior_queries, prior1d=prior,
+                                             emg=emg, dt=dt, sa=sa, T=T, k=k, canonical=canonical)
+                queriedchs[j,:,i] = chpairs[D['idx']]
+                maxchs[j,:,i,n1-1:] = chpairs[D['means'].argmax(axis=-1)]
+                vals[j,:,i,n1-1:] = D['means']
+                rounds[j,:,i,n1-1:] = np.arange(ntotal-n1+1)
+                runtimes[j,:,i] = D['time'] / repeat
+                results.write((j,slice(None),i))
+    else:
+        # One task per (model, repeat, nrnd) run (with the kwargs above).
+        # Model 0 has no prior, 1 has the prior1d mean and 2 the dtprior
+        runs = [(j,r,i) for r in range(repeat) for i in range(len(nrnd)) for j in range(n_models)]
+        tasks = [(dict(kwargs, n_random_pts=nrnd[i], dtprior=(j==2)), j > 0, ss) for (j,r,i),ss in zip(runs, seeds)]
+        objs = {'trainsC': trainsC, 'm1d': m1d, 'true_idx': true_idx}
+        for (j,r,i),res in run_tasks(store, _run_task_2d, runs, tasks, workers=workers, shared=objs):
+            print("Repeat {}, {} random init pts, model {}: done".format(r, nrnd[i], j))
+            queriedchs[j][r][i] = res['queriedchs']
+            maxchs[j][r][i] = res['maxchs']
+            vals[j][r][i] = res['vals']
+            rounds[j][r][i] = res['rounds']
+            pcorrect[j][r][i] = res['pcorrect']
+            runtimes[j][r][i] = res['time']
+            nrefits[j][r][i] = res['nrefits']
+            results.write((j,r,i))
     dct = {
         'queriedchs': queriedchs,
         'maxchs': maxchs,
@@ -496,16 +894,28 @@ def run_ch_stats_exps(trainsC, emg=emg, dt=dt, uid='', jobid=None, repeat=25, co
         'dt': dt,
         'uid': uid,
         'repeat': repeat,
-        'true_chpair': trainsC.max_ch_2d(emg,dt),
+        'true_chpair': true_chpair,
         'multkern': multkern,
         'symkern': symkern,
         'constrain': constrain,
-        'n_prior_queries': n_prior_queries
+        'n_prior_queries': n_prior_queries,
+        'incremental': incremental,
+        'refit': refit,
+        'canonical': canonical,
+        'backend': backend,
+        'batch_size': batch_size,
+        'batch_strategy': batch_strategy,
+        'thompson': thompson,
+        'lockstep': lockstep,
+        # (None with lockstep) the seed of all runs
+        'seed': None if lockstep else seed,
+        'rounds': rounds,
+        'pcorrect': pcorrect,
+        'runtimes': runtimes,
+        'nrefits': nrefits
     }
-    filename = os.path.join(exppath, 'chruns2d_dct.pkl')
-    print("Saving stats dictionary to: {}".format(filename))
-    with open(filename, 'wb') as f:
-        pickle.dump(dct, f)
+    print("Saving stats to: {}".format(results.filename))
+    results.close(dct)
     return dct
 
 def run_dist_exps(args):
@@ -517,31 +927,17 @@ def run_dist_exps(args):
     trainsC = Trains(emg=args.emg)
     trains = trainsC.get_emgdct(args.emg)
 
-    X1d,Y1d = make_dataset_1d(trains)
-    m1d = train_model_1d(X1d,Y1d, ARD=False)
+    X1d,Y1d = make_dataset_1d(trainsC, emg=args.emg, seed=REF_SEED)
+    m1d = fit_cached(train_model_1d, X1d,Y1d, ARD=False)
 
-    X,Y = make_dataset_2d(trainsC, emg=args.emg, dt=args.dt)
+    # The full-data models are fit on the cell means (same likelihood)
+    X,Y,N,SS = make_dataset_2d(trainsC, emg=args.emg, dt=args.dt, collapse=True)
     
     # Note that the full-data models can be shared for all exps (with
-    # same emg and dt).
-    # Hence we save them in emgdtpath instead of exppath
-    addpriorpath = path.join(emgdtpath, 'maddprior.h5')
-    if os.path.exists(addpriorpath):
-        with h5py.File(addpriorpath) as f:
-            maddprior, = train_models_2d(X,Y, prior1d=m1d, optimize=False)
-            maddprior[:] = f['param_array']
-    else:
-        maddprior, = train_models_2d(X,Y, prior1d=m1d)
-        maddprior.save(addpriorpath)
-
-    addpath = path.join(emgdtpath, 'madd.h5')
-    if path.exists(addpath):
-        with h5py.File(addpath) as f:
-            madd, = train_models_2d(X,Y, optimize=False)
-            madd[:] = f['param_array']
-    else:
-        madd, = train_models_2d(X,Y)
-        madd.save(addpath)
+    # same data, kernel and prior), so they come from the model cache
+    # (see gp_modelcache)
+    maddprior = fit_cached(train_models_2d, X,Y, prior1d=m1d, counts=N, scatter=SS)
+    madd = fit_cached(train_models_2d, X,Y, counts=N, scatter=SS)
     
     # We train all models with n rnd start pts and m sequential pts
     # And compare them to the model trained with all datapts
@@ -606,9 +1002,9 @@ if __name__ == "__main__":
                           nrnd=[90,100,10], sa=True, multkern=True, symkern=False, ARD=True)
 
     emg=4
-    X1d,Y1d = make_dataset_1d(trainsC, emg=4)
-    m1d = train_model_1d(X1d,Y1d, ARD=False)
-    m1dard = train_model_1d(X1d,Y1d, ARD=True)
+    X1d,Y1d = make_dataset_1d(trainsC, emg=4, seed=REF_SEED)
+    m1d = fit_cached(train_model_1d, X1d,Y1d, ARD=False)
+    m1dard = fit_cached(train_model_1d, X1d,Y1d, ARD=True)
 
     # model_names = 'all'
     # X,Y = make_dataset_2d(trainsC, emg=4, dt=10, means=True)
@@ -620,9 +1016,9 @@ if __name__ == "__main__":
     #     for m in ms:
     #         plot_model_2d(m)
             
-    X,Y = make_dataset_2d(trainsC, emg=4, dt=60)
-    m = train_models_2d(X,Y, kerneltype='mult', ARD=True, prior1d=m1d, constrain=False)
-    mconstrain = train_models_2d(X,Y, kerneltype='mult', ARD=True, prior1d=m1d, constrain=True)
+    X,Y,N,SS = make_dataset_2d(trainsC, emg=4, dt=60, collapse=True)
+    m = fit_cached(train_models_2d, X,Y, kerneltype='mult', ARD=True, prior1d=m1d, constrain=False, counts=N, scatter=SS)
+    mconstrain = fit_cached(train_models_2d, X,Y, kerneltype='mult', ARD=True, prior1d=m1d, constrain=True, counts=N, scatter=SS)
 
     mdct = train_model_seq_2d(trainsC, 50, 100, emg=4, dt=0, prior1d=m1d, symkern=True, sa=False, ARD=True, multkern=True, constrain=True)
     mdctprior = train_model_seq_2d(trainsC, 50, 100, emg=4, dt=60, prior1d=m1dard, symkern=False, sa=False, ARD=True, multkern=True, constrain=True)
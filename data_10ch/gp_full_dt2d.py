@@ -4,7 +4,17 @@ We fit GPs to the full dataset, testing different models and kernels
 
 from load_matlab import *
 from gp_full_1d import *
-from gp_full_2d import make_dataset_2d, build_prior, softmax
+from gp_full_2d import make_dataset_2d, build_prior, softmax, pick_idx, collapse_dataset, CollapsedGPRegression, PairSymmetric
+from gp_incremental import IncrementalGP, RefitSchedule
+from gp_kron import KronGPRegression
+from gp_batch import batch_idx, query_steps
+from gp_pool import task_seeds, seed_task, shared
+from gp_checkpoint import TaskStore, run_tasks, config_hash
+from gp_results import ResultsStore
+from gp_modelcache import fit_cached
+from gp_numpy import get_backend
+from gp_grid import grid_predict, grid_samples, argmax_probs, grid_dt2d
+from gp_snapshots import SeqModels
 import numpy as np
 import GPy
 import matplotlib.pyplot as plt
@@ -12,8 +22,10 @@ import pickle
 import os, os.path as path
 import h5py
 import itertools
+import inspect
 import argparse
 import copy
+import time
 
 parser = argparse.ArgumentParser()
 parser.add_argument('--uid', type=str, default=1, help='uid for job number')
@@ -24,20 +36,38 @@ parser.add_argument('--emg', type=int, default=4, choices=range(7), help='emg. b
 dts=(40,60)
 emg=4
 
-def make_dataset_dt2d(trainsC, emg=emg, syn=None, dts=dts, means=False, n=None):
-    X,Y = make_dataset_2d(trainsC=trainsC,emg=emg,syn=syn,dt=dts[0],means=means,n=n)
+def make_dataset_dt2d(trainsC, emg=emg, syn=None, dts=dts, means=False, n=None, f='max', collapse=False, symmetric=False):
+    # collapse/symmetric: see make_dataset_2d (symmetric is only applied
+    # to dt=0)
+    X,Y = make_dataset_2d(trainsC=trainsC,emg=emg,syn=syn,dt=dts[0],means=means,n=n,f=f,symmetric=symmetric and dts[0]==0)
     X = np.hstack((X, np.ones((len(X),1))*dts[0]))
     for dt in dts[1:]:
-        X_,Y_ = make_dataset_2d(trainsC=trainsC,emg=emg,syn=syn,dt=dt,means=means,n=n)
+        X_,Y_ = make_dataset_2d(trainsC=trainsC,emg=emg,syn=syn,dt=dt,means=means,n=n,f=f,symmetric=symmetric and dt==0)
         X_ = np.hstack((X_, np.ones((len(X_),1))*dt))
         X = np.vstack((X,X_))
         Y = np.vstack((Y,Y_))
+    if collapse:
+        return collapse_dataset(X,Y)
     return X,Y
 
-def train_models_dt2d(X,Y, kerneltype='add', symkern=False, num_restarts=1, prior1d=None, optimize=True, ARD=True, dtprior=False, constrain=False, sparse=None, m1d=None):
-    k1 = GPy.kern.Matern52(input_dim=2, active_dims=[0,1], ARD=ARD)
-    k2 = GPy.kern.Matern52(input_dim=2, active_dims=[2,3], ARD=ARD)
-    kdt = GPy.kern.Matern52(input_dim=1, active_dims=[4], lengthscale=20)
+def train_models_dt2d(X,Y, kerneltype='add', symkern=False, num_restarts=1, prior1d=None, optimize=True, ARD=True, dtprior=False, constrain=False, sparse=None, m1d=None, counts=None, scatter=0., kron=False, grid_dts=None, backend='gpy'):
+    # counts/scatter: X,Y are collapsed cell means (make_dataset_dt2d(collapse=True))
+    # kron: use KronGPRegression on grid_dt2d(grid_dts), the full grid
+    # the model is predicted on (so also the dts without data) (see
+    # gp_kron, (k1*k2)*kdt and (k1+k2)*kdt are both separable, but not
+    # the symkern versions)
+    # backend: 'gpy' or 'numpy' (see gp_numpy, which has no symkern,
+    # sparse, counts or kron)
+    lib = get_backend(backend)
+    if backend != 'gpy' and (symkern or sparse or kron or counts is not None):
+        raise Exception("symkern, sparse, kron and counts need backend='gpy'")
+    if prior1d is not None:
+        # (a copy: the model learns its coefficients, and prior1d is
+        # shared by all the models of the runs, see build_prior)
+        prior1d = prior1d.copy()
+    k1 = lib.kern.Matern52(input_dim=2, active_dims=[0,1], ARD=ARD)
+    k2 = lib.kern.Matern52(input_dim=2, active_dims=[2,3], ARD=ARD)
+    kdt = lib.kern.Matern52(input_dim=1, active_dims=[4], lengthscale=20)
     if m1d:
         k1.lengthscale = k2.lengthscale = m1d.Mat52.lengthscale
         k1.variance = k2.variance = m1d.Mat52.variance
@@ -57,12 +87,20 @@ def train_models_dt2d(X,Y, kerneltype='add', symkern=False, num_restarts=1, prio
         symM = np.zeros((5,5))
         symM[4][4] = 1
         symM[:4,:4] = np.block([[np.zeros((2,2)),np.eye(2)],[np.eye(2),np.zeros((2,2))]])
-        k = GPy.kern.Symmetric(k, symM)
+        k = PairSymmetric(k, symM)
 
-    if sparse:
+    if kron:
+        if symkern:
+            raise Exception("kron doesn't work with symkern (the kernel isn't separable)")
+        if grid_dts is None:
+            raise Exception("kron needs grid_dts (the dts of the grid)")
+        m = KronGPRegression(X,Y,k, grid_dt2d(grid_dts), counts=counts, scatter=scatter, mean_function=prior1d)
+    elif sparse:
         m = GPy.models.SparseGPRegression(X,Y,k, mean_function=prior1d, num_inducing=sparse)
+    elif counts is not None:
+        m = CollapsedGPRegression(X,Y,counts,scatter,k, mean_function=prior1d)
     else:
-        m = GPy.models.GPRegression(X,Y,k, mean_function= prior1d)
+        m = lib.models.GPRegression(X,Y,k, mean_function= prior1d)
     if m1d:
         m.Gaussian_noise.variance = m1d.Gaussian_noise.variance
     if optimize:
@@ -80,8 +118,8 @@ def get_chpairdtidx(wxyzdt, dts):
     return [get_ch([w,x]), get_ch([y,z]), dt]
 
 def get_maxchpairdt(m, dts):
-    X = np.array(list(itertools.product(range(2),range(5), range(2), range(5), dts)))
-    means,_ = m.predict(X)
+    X = grid_dt2d(dts)
+    means,_ = grid_predict(m, X)
     maxidx = means.argmax()
     maxwxyz = np.unravel_index(maxidx, (2,5,2,5,len(dts)))
     maxchpair = get_chpairdtidx(maxwxyz, dts)
@@ -117,11 +155,26 @@ def plot_model_dt2d(m, k=-1, title="", plot_acq=False):
     #     plt.imshow(sm)
     #     plt.colorbar()
 
-def train_model_seq_dt2d(trainsC, n_random_pts=10, n_total_pts=15, n_prior_queries=3, num_restarts=1, ARD=False, prior1d=None, m1d=None, fix=False, continue_opt=True, emg=emg, syn=None, dts=dts, dtprior=False, sa=True, symkern=False, kerneltype='mult', T=0.001, constrain=True, k=2):
-    trains = trainsC.get_emgdct(emg)
-    if dtprior:
-        assert(continue_opt), "if dtprior is True, must set continue_opt to true"
-        assert(prior1d is not None), "if dtprior is True, must give prior1d"
+def train_model_seq_dt2d(trainsC, n_random_pts=10, n_total_pts=15, n_prior_queries=3, num_restarts=1, ARD=False, prior1d=None, m1d=None, fix=False, continue_opt=True, emg=emg, syn=None, dts=dts, dtprior=False, sa=True, symkern=False, kerneltype='mult', T=0.001, constrain=True, k=2, f='max', sampler=None, seed=None, incremental=False, refit=None, save_preds=True, backend='gpy', batch_size=1, batch_strategy='kb', thompson=False):
+    # backend: 'gpy' or 'numpy' (see gp_numpy)
+    # thompson: query the argmax of joint posterior draws on the grid
+    # (Thompson sampling) instead of UCB (sa, T and k are then ignored)
+    # batch_size: number of queries per round (picked with
+    # batch_strategy, see gp_batch), the model is only updated once all
+    # of them are in. Refits (and the models returned) are per round
+    # If incremental (and not continue_opt), the hyperparameters are kept
+    # fixed after the first fit and each new query only extends the
+    # cholesky factor of the previous model (see IncrementalGP)
+    # refit is a RefitSchedule spec (eg. 'every:5'): hyperparameters are
+    # then only re-optimized at the scheduled steps
+    # The models of all steps are returned as a SeqModels (with their
+    # posterior on grid_dt2d(dts) if save_preds)
+    # sampler simulates the stimulator (see ResponseSampler). By
+    # default we draw (with replacement) from the f feature of emg/syn
+    if sampler is None:
+        sampler = ResponseSampler(trainsC, emg=emg, syn=syn, f=f, seed=seed)
+    # (build_prior's dtprior mean has no dt2d version)
+    assert not dtprior, "dtprior isn't implemented for dt2d"
     X = []
     Y = []
 
@@ -130,16 +183,9 @@ def train_model_seq_dt2d(trainsC, n_random_pts=10, n_total_pts=15, n_prior_queri
         # query pts around n_prior_queries max chs of prior1d
         nmaxchs = get_nmaxch(m1d, n=n_prior_queries)
         for xych1 in nmaxchs:
-            ch1 = xy2ch[xych1[0]][xych1[1]]
             for xych2 in nmaxchs:
-                ch2 = xy2ch[xych2[0]][xych2[1]]
                 for dt in dts:
                     X.append(xych1+xych2+[dt])
-                    if syn is None:
-                        resp = random.choice(trainsC.get_resp(emg,dt,ch1,ch2).max(axis=1))
-                    else:
-                        resp = random.choice(trainsC.synergy(syn[0], syn[1], ch1, ch2, dt).max(axis=1))
-                    Y.append(resp)
     else:
         # we need this so as to query the right total # of pts
         # (for loop below has - n_prior_queries**2)
@@ -147,96 +193,224 @@ def train_model_seq_dt2d(trainsC, n_random_pts=10, n_total_pts=15, n_prior_queri
 
     # We need this in case n_prior_queries**2*len(dts) > n_random_pts
     X = X[:n_random_pts]
-    Y = Y[:n_random_pts]
+    if X:
+        Y.extend(sampler.sample([get_ch(x[0:2]) for x in X], [get_ch(x[2:4]) for x in X], [x[4] for x in X]).tolist())
 
     # RANDOM PTS
-    for _ in range(n_random_pts - n_prior_queries**2*len(dts)):
-        ch1 = random.choice(CHS)
-        ch2 = random.choice(CHS)
-        dt = random.choice(dts)
-        X.append(ch2xy[ch1] + ch2xy[ch2] + [dt])
-        if syn is None:
-            resp = random.choice(trainsC.get_resp(emg,dt,ch1,ch2).max(axis=1))
-        else:
-            resp = random.choice(trainsC.synergy(syn[0], syn[1], ch1, ch2, dt).max(axis=1))
-        Y.append(resp)
+    chs1,chs2,rnddts = sampler.random_cells(max(n_random_pts - n_prior_queries**2*len(dts), 0), dts)
+    X.extend([ch2xy[ch1] + ch2xy[ch2] + [dt] for ch1,ch2,dt in zip(chs1,chs2,rnddts)])
+    Y.extend(sampler.sample(chs1, chs2, rnddts).tolist())
+    def build(X, Y, params, tag=None):
+        # GPy model for data X,Y with hyperparameters params (not optimized)
+        m = train_models_dt2d(X, Y, prior1d=prior1d, m1d=m1d, ARD=ARD, kerneltype=kerneltype, symkern=symkern, constrain=constrain, optimize=False, backend=backend)
+        m[:] = params
+        return m
     #We save every model after each query
-    models = []
+    models = SeqModels(build, grid_dt2d(dts) if save_preds else None)
     # Train initial model
-    m = train_models_dt2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, m1d=m1d, ARD=ARD, kerneltype=kerneltype,symkern=symkern, constrain=constrain)
+    m = train_models_dt2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, m1d=m1d, ARD=ARD, kerneltype=kerneltype,symkern=symkern, constrain=constrain, backend=backend)
     models.append(m)
+    if refit is not None:
+        refit = RefitSchedule(refit)
+        incremental = incremental and refit.name != 'always'
+    else:
+        incremental = incremental and not continue_opt
+    if incremental:
+        gp = IncrementalGP.from_gpy(m)
+    # fitted is the last GPy model, whose hyperparameters we use
+    fitted = m
+    refits = []
+    refit_times = []
+    t0 = time.time()
 
     # SEQUENTIAL QUERY PTS
-    for _ in range(n_total_pts-n_random_pts):
-        nextx = get_next_x(m, dts, sa=sa, T=T, k=k)
-        X.append(nextx)
-        ch1 = xy2ch[nextx[0]][nextx[1]]
-        ch2 = xy2ch[nextx[2]][nextx[3]]
-        dt = nextx[4]
-        if syn is None:
-            resp = random.choice(trainsC.get_resp(emg,dt,ch1,ch2).max(axis=1))
+    nseq = n_total_pts - n_random_pts
+    for step in range(1, -(-nseq // batch_size) + 1):
+        # the last round may have less than batch_size queries
+        nextxs = get_next_xs(m, dts, min(batch_size, nseq - (step-1)*batch_size), sa=sa, T=T, k=k, strategy=batch_strategy, thompson=thompson)
+        resps = []
+        for nextx in nextxs:
+            X.append(nextx)
+            ch1 = xy2ch[nextx[0]][nextx[1]]
+            ch2 = xy2ch[nextx[2]][nextx[3]]
+            dt = nextx[4]
+            resps.append(float(sampler.sample(ch1, ch2, dt)))
+        Y.extend(resps)
+        if refit is not None:
+            # Only re-optimize when the schedule says so, warm started
+            # from the last hyperparameters and without random restarts
+            if refit.needs_model or not incremental:
+                m = build(np.array(X), np.array(Y)[:,None], fitted[:])
+            else:
+                m = None
+            if refit(step, m):
+                if m is None:
+                    m = build(np.array(X), np.array(Y)[:,None], fitted[:])
+                t = time.time()
+                m.optimize()
+                refits.append(step)
+                refit_times.append(time.time() - t)
+                fitted = m
+                if incremental:
+                    gp = IncrementalGP.from_gpy(m)
+            elif incremental:
+                for nextx,resp in zip(nextxs, resps):
+                    gp.add(nextx, resp)
+                m = gp.snapshot()
+        elif incremental:
+            for nextx,resp in zip(nextxs, resps):
+                gp.add(nextx, resp)
+            m = gp.snapshot()
         else:
-            resp = random.choice(trainsC.synergy(syn[0], syn[1], ch1, ch2, dt).max(axis=1))
-        Y.append(resp)
-        m = train_models_dt2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, m1d=m1d, ARD=ARD, kerneltype=kerneltype, symkern=symkern, constrain=constrain)
+            m = train_models_dt2d(np.array(X),np.array(Y)[:,None], prior1d=prior1d, m1d=m1d, ARD=ARD, kerneltype=kerneltype, symkern=symkern, constrain=constrain, backend=backend)
 
         models.append(m)
         
     dct = {
         'models': models,
         'nrnd': n_random_pts,
-        'ntotal': n_total_pts
+        'ntotal': n_total_pts,
+        # sequential steps after which we re-optimized (only with refit)
+        'refits': refits,
+        'refit_times': refit_times,
+        'batch_size': batch_size,
+        'time': time.time() - t0
     }
     return dct
 
-def get_next_x(m, dts, k=2, sa=False, T=0.001):
-    X,acq = get_acq_map(m,dts,k=k)
-    if sa:
-        # SA is for simulated annealing (sample instead of taking max)
-        sm = softmax(acq, T=T).flatten()
-        nextidx = np.random.choice(range(len(acq)), p=sm)
-    else:
-        nextidx = acq.argmax()
-    nextx = X[nextidx]
+def get_next_x(m, dts, k=2, sa=False, T=0.001, thompson=False):
+    X,acq = get_acq_map(m,dts,k=k, thompson=thompson)
+    nextx = X[pick_idx(acq, sa=sa and not thompson, T=T)]
     return nextx
 
-def get_acq_map(m, dts, k=2):
+def get_next_xs(m, dts, q, k=2, sa=False, T=0.001, strategy='kb', thompson=False):
+    # q distinct (pair,dt) to query in one round (see gp_batch). The
+    # first one is the same as get_next_x's
+    if thompson:
+        strategy, sa = 'ts', False
+    X = grid_dt2d(dts)
+    idx = batch_idx(m, X, q, lambda acq: pick_idx(acq, sa=sa, T=T), k=k, strategy=strategy)
+    return X[idx]
+
+def get_acq_map(m, dts, k=2, thompson=False):
     # We use UCB, k is the "exploration" parameter
-    X = np.array(list(itertools.product(range(2),range(5), range(2), range(5), dts)))
-    mean,var = m.predict(X)
-    std = np.sqrt(var)
-    acq = mean + k*std
+    # If thompson, the map is a joint posterior draw of f instead (see
+    # grid_samples)
+    X = grid_dt2d(dts)
+    if thompson:
+        acq = grid_samples(m, X)[0][:,None]
+    else:
+        mean,var = grid_predict(m, X)
+        std = np.sqrt(var)
+        acq = mean + k*std
     return X,acq
 
-def run_ch_stats_exps(trainsC, emg=emg, syn=None, dts=dts, uid='', jobid='', repeat=25, continue_opt=True, k=2, dtprior=False, ntotal=100, nrnd = [15,76,10], sa=True, multkern=True, symkern=False, ARD=False, T=0.001, constrain=True, n_prior_queries=3):
+def _run_task_dt2d(task):
+    # One run of run_ch_stats_exps (a task of run_tasks): the arguments
+    # of train_model_seq_dt2d, whether it uses the 1d prior, and its seed
+    kwargs, use_prior, ss = task
+    ntotal, dts = kwargs['n_total_pts'], kwargs['dts']
+    X = grid_dt2d(dts)
+    if use_prior:
+        kwargs = dict(kwargs, prior1d=shared('prior1d'), m1d=shared('m1d'))
+    sampler_seed = seed_task(ss)
+    D = train_model_seq_dt2d(shared('trainsC'), seed=sampler_seed, **kwargs)
+    models = D['models']
+    res = {
+        'queriedchs': [get_chpairdt(xydt,dts) for xydt in models[-1].X],
+        'maxchs': np.zeros((ntotal, 3)),
+        'vals': np.zeros((ntotal, len(X))),
+        'rounds': np.zeros(ntotal, dtype=int),
+        'pcorrect': np.zeros(ntotal),
+        'time': D['time'],
+        'nrefits': len(D['refits'])
+    }
+    for r,rnd,m in query_steps(models, ntotal):
+        res['maxchs'][r] = get_maxchpairdt(m,dts)
+        res['vals'][r] = grid_predict(m, X)[0].reshape((-1))
+        res['rounds'][r] = rnd
+        res['pcorrect'][r] = argmax_probs(m, X)[shared('true_idx')]
+    return res
+
+def true_vals_dt2d(trainsC, emg=emg, syn=None, dts=dts):
+    # the objective (syn, or emg if syn is None) of every (ch1,ch2) pair
+    # (indices of CHS), dt by dt
+    return np.concatenate([trainsC.build_f_grid(emg=emg,syn=syn,dt=dt).flatten() for dt in dts])
+
+def true_best_dt2d(trainsC, emg=emg, syn=None, dts=dts):
+    # the best [ch1,ch2,dt] of the same objective, and its index in
+    # grid_dt2d(dts)
+    chpairdt = trainsC.max_ch_dt2d(emg=emg, dts=dts, syn=syn)
+    idx = np.ravel_multi_index(ch2xy[chpairdt[0]] + ch2xy[chpairdt[1]] + [list(dts).index(chpairdt[2])], (2,5,2,5,len(dts)))
+    return chpairdt, idx
+
+# results of run_ch_stats_exps (see gp_results), in get_exppath
+RESULTS_FILE = 'chrunsdt2d.h5'
+
+# arguments of run_ch_stats_exps that are in get_exppath's path (or
+# don't change the results)
+PATH_ARGS = ('trainsC', 'uid', 'jobid', 'workers', 'emg', 'syn', 'dts', 'sa', 'multkern', 'ARD', 'constrain', 'k')
+
+def get_exppath(uid, emg=emg, syn=None, dts=dts, sa=True, multkern=True, ARD=False, constrain=True, k=2, config=None):
+    # directory of the results of run_ch_stats_exps. With config (see
+    # exp_config), in a subdirectory named after a hash of the other
+    # arguments, so that experiments which differ in any of them (refit,
+    # backend, nrnd, seed...) don't share their results and checkpoints
+    synstr = 'emg{}'.format(emg) if syn is None else 'syn{}'.format(''.join([str(n) for n in syn]))
+    dtsstr = 'dts{}'.format(''.join([str(n) for n in dts]))
+    exppath = path.join('exps', '2d', 'exp{}'.format(uid), synstr, dtsstr, 'sa{}'.format(sa), 'multkern{}'.format(multkern), 'ARD{}'.format(ARD), 'constrain{}'.format(constrain), 'k{}'.format(k))
+    if config is not None:
+        other = {name: v for name,v in config.items() if name not in PATH_ARGS}
+        exppath = path.join(exppath, 'cfg{}'.format(config_hash(other)))
+    return exppath
+
+def exp_config(**kwargs):
+    # the arguments of run_ch_stats_exps(**kwargs), defaults included
+    args = inspect.signature(run_ch_stats_exps).bind_partial(**kwargs)
+    args.apply_defaults()
+    return args.arguments
+
+def run_ch_stats_exps(trainsC, emg=emg, syn=None, dts=dts, uid='', jobid='', repeat=25, continue_opt=True, k=2, dtprior=False, ntotal=100, nrnd = [15,76,10], sa=True, multkern=True, symkern=False, ARD=False, T=0.001, constrain=True, n_prior_queries=3, incremental=False, refit=None, backend='gpy', batch_size=1, batch_strategy='kb', thompson=False, workers=1, seed=None):
+    # The runs are run on <workers> processes, seeded from seed (see gp_pool)
+    # (the arguments as given, for get_exppath)
+    config = exp_config(**locals())
     if multkern: kerneltype='mult'
     else: kerneltype='add'
+    assert not dtprior, "dtprior isn't implemented for dt2d"
     if uid == '':
         uid = random.randrange(10000)
     assert(type(nrnd) is list and len(nrnd) == 3)
     trains = trainsC.get_emgdct(emg)
     nrnd = range(*nrnd)
-    synstr = 'syn{}'.format(''.join([str(n) for n in syn]))
-    dtsstr = 'dts{}'.format(''.join([str(n) for n in dts]))
-    exppath = path.join('exps', '2d', 'exp{}'.format(uid), synstr, dtsstr, 'sa{}'.format(sa), 'multkern{}'.format(multkern), 'ARD{}'.format(ARD), 'constrain{}'.format(constrain), 'k{}'.format(k))
+    exppath = get_exppath(uid, emg, syn, dts, sa, multkern, ARD, constrain, k, config=config)
     if not path.isdir(exppath):
         os.makedirs(exppath)
     with open(os.path.join(exppath, 'jobid={}'.format(jobid)), 'w') as f:
         print("Writing to file: {}".format(os.path.join(exppath, 'jobid={}'.format(jobid))))
         f.write('sbatch jobid = {}'.format(jobid))
         
-    n_models = 3 if dtprior else 2
-    X = np.array(list(itertools.product(range(2),range(5), range(2), range(5), dts)))
-    # Build 1d model for modelsprior
+    n_models = 2
+    X = grid_dt2d(dts)
+    kwargs = dict(n_total_pts=ntotal, num_restarts=1, continue_opt=continue_opt, ARD=ARD, dts=dts,
+                  emg=emg, syn=syn, sa=sa, k=k, kerneltype=kerneltype, symkern=symkern, T=T,
+                  constrain=constrain, n_prior_queries=n_prior_queries, incremental=incremental,
+                  refit=refit, backend=backend, batch_size=batch_size, batch_strategy=batch_strategy,
+                  thompson=thompson)
+    # checkpoints of the runs (see gp_checkpoint)
+    store = TaskStore(path.join(exppath, 'tasks'), dict(kwargs, repeat=repeat, nrnd=nrnd, n_models=n_models), seed)
+    # One seed per run
+    seed, seeds = task_seeds(store.seed, n_models*repeat*len(nrnd))
+    # Build 1d model for modelsprior (their fit is seeded by fit_cached,
+    # so they are the same in every experiment)
     if syn is None:
-        X1d,Y1d = make_dataset_1d(trainsC, emg=emg)
-        m1d1, = train_models_1d(X1d,Y1d, ARD=ARD)
+        X1d,Y1d = make_dataset_1d(trainsC, emg=emg, seed=REF_SEED)
+        m1d1 = fit_cached(train_model_1d, X1d,Y1d, ARD=ARD, backend=backend)
         prior1d = build_prior(m1d1,input_dim=5)
     else:
-        X1d,Y1d = make_dataset_1d(trainsC, emg=syn[0])
-        m1d1, = train_models_1d(X1d,Y1d, ARD=ARD)
-        X1d,Y1d = make_dataset_1d(trainsC, emg=syn[1])
-        m1d2, = train_models_1d(X1d,Y1d, ARD=ARD)
+        X1d,Y1d = make_dataset_1d(trainsC, emg=syn[0], seed=REF_SEED)
+        m1d1 = fit_cached(train_model_1d, X1d,Y1d, ARD=ARD, backend=backend)
+        X1d,Y1d = make_dataset_1d(trainsC, emg=syn[1], seed=REF_SEED)
+        m1d2 = fit_cached(train_model_1d, X1d,Y1d, ARD=ARD, backend=backend)
         prior1d = build_prior(m1d1,m1d2,input_dim=5)
 
     # queriedchs contains 2 queried channels + dt (3) for all <repeat> runs of <ntotal>
@@ -244,64 +418,68 @@ def run_ch_stats_exps(trainsC, emg=emg, syn=None, dts=dts, uid='', jobid='', rep
     queriedchs = np.zeros((n_models, repeat, len(nrnd), ntotal, 3))
     maxchs = np.zeros((n_models, repeat, len(nrnd), ntotal, 3))
     vals = np.zeros((n_models, repeat, len(nrnd), ntotal, 100*len(dts)))
-    for repeat in range(repeat):
-        print("Repeat", repeat)
-        for i,n1 in enumerate(nrnd):
-            print(n1, "random init pts")
-            modelsD = train_model_seq_dt2d(trainsC,n_random_pts=n1, n_total_pts=ntotal,
-                                           num_restarts=1, continue_opt=continue_opt, ARD=ARD,
-                                           dts=dts, emg=emg, syn=syn, sa=sa, k=k,
-                                           kerneltype=kerneltype, symkern=symkern, T=T,
-                                           constrain=constrain,n_prior_queries=n_prior_queries)
-            modelspriorD = train_model_seq_dt2d(trainsC,n_random_pts=n1, n_total_pts=ntotal,
-                                                num_restarts=1, continue_opt=continue_opt,
-                                                prior1d=prior1d, m1d=m1d1, dts=dts, emg=emg,
-                                                dtprior=False, sa=sa, kerneltype=kerneltype,
-                                                syn=syn, symkern=symkern, ARD=ARD, T=T, k=k,
-                                                constrain=constrain, n_prior_queries=n_prior_queries)
-            models = modelsD['models']
-            modelsprior = modelspriorD['models']
-            queriedchs[0][repeat][i] = [get_chpairdt(xydt,dts) for xydt in models[-1].X]
-            queriedchs[1][repeat][i] = [get_chpairdt(xydt,dts) for xydt in modelsprior[-1].X]
-            for r,m in enumerate(models,n1-1):
-                maxchs[0][repeat][i][r] = get_maxchpairdt(m,dts)
-                vals[0][repeat][i][r] = m.predict(X)[0].reshape((-1))
-            for r,m in enumerate(modelsprior,n1-1):
-                maxchs[1][repeat][i][r] = get_maxchpairdt(m,dts)
-                vals[1][repeat][i][r] = m.predict(X)[0].reshape((-1))
-            if dtprior:
-                modelsdtpriorD = train_model_seq_2d(trainsC,n_random_pts=n1, n_total_pts=ntotal,
-                                                    num_restarts=1, continue_opt=continue_opt,
-                                                    prior1d=m1d, dts=dts, emg=emg, dtprior=True,
-                                                    sa=sa, kerneltype=kerneltype, k=k,
-                                                    symkern=symkern, ARD=ARD, T=T, syn=syn,
-                                                    n_prior_queries=n_prior_queries)
-                modelsdtprior = modelsdtpriorD['models']
-                queriedchs[2][repeat][i] = [get_chpairdt(xydt,dts) for xydt in modelsdtprior[-1].X]
-                for r,m in enumerate(modelsdtprior,n1-1):
-                    maxchs[2][repeat][i][r] = get_maxchpairdt(m,dts)
-                    vals[2][repeat][i][r] = m.predict(X)[0].reshape((-1))
+    # wall-clock time of the sequential queries of each run, and the number
+    # of hyperparameter re-optimizations it did (only counted with refit)
+    runtimes = np.zeros((n_models, repeat, len(nrnd)))
+    nrefits = np.zeros((n_models, repeat, len(nrnd)), dtype=int)
+    # rounds (model updates) done before each query's model (= queries
+    # - nrnd with batch_size=1), to plot regret against rounds
+    rounds = np.zeros((n_models, repeat, len(nrnd), ntotal), dtype=int)
+    # posterior probability that the true best (pair,dt) is the argmax
+    # (see argmax_probs), after each query
+    pcorrect = np.zeros((n_models, repeat, len(nrnd), ntotal))
+    true_chpairdt, true_idx = true_best_dt2d(trainsC, emg=emg, syn=syn, dts=dts)
+    # the arrays are also written to RESULTS_FILE, run by run
+    results = ResultsStore(os.path.join(exppath, RESULTS_FILE),
+                           {'queriedchs': queriedchs, 'maxchs': maxchs, 'vals': vals, 'rounds': rounds,
+                            'pcorrect': pcorrect, 'runtimes': runtimes, 'nrefits': nrefits}, dts=dts,
+                           config=dict(kwargs, repeat=repeat, nrnd=nrnd, n_models=n_models, seed=seed))
+    # One task per (model, repeat, nrnd) run (with the kwargs above).
+    # Model 0 has no prior, 1 has the prior1d mean
+    runs = [(j,r,i) for r in range(repeat) for i in range(len(nrnd)) for j in range(n_models)]
+    tasks = [(dict(kwargs, n_random_pts=nrnd[i]), j > 0, ss) for (j,r,i),ss in zip(runs, seeds)]
+    objs = {'trainsC': trainsC, 'prior1d': prior1d, 'm1d': m1d1, 'true_idx': true_idx}
+    for (j,r,i),res in run_tasks(store, _run_task_dt2d, runs, tasks, workers=workers, shared=objs):
+        print("Repeat {}, {} random init pts, model {}: done".format(r, nrnd[i], j))
+        queriedchs[j][r][i] = res['queriedchs']
+        maxchs[j][r][i] = res['maxchs']
+        vals[j][r][i] = res['vals']
+        rounds[j][r][i] = res['rounds']
+        pcorrect[j][r][i] = res['pcorrect']
+        runtimes[j][r][i] = res['time']
+        nrefits[j][r][i] = res['nrefits']
+        results.write((j,r,i))
     dct = {
         'queriedchs': queriedchs,
         'maxchs': maxchs,
         'vals': vals,
         'nrnd': nrnd,
-        'true_vals': np.concatenate([trainsC.build_f_grid(emg=emg,syn=syn,dt=dt).flatten() for dt in dts]),
+        'true_vals': true_vals_dt2d(trainsC, emg=emg, syn=syn, dts=dts),
         'ntotal': ntotal,
         'emg': emg,
         'syn': syn,
         'dts': dts,
         'uid': uid,
         'repeat': repeat,
-        'true_chpairdt': trainsC.max_ch_dt2d(emg,dts),
+        'true_chpairdt': true_chpairdt,
         'multkern': multkern,
         'symkern': symkern,
-        'k': k
+        'k': k,
+        'incremental': incremental,
+        'refit': refit,
+        'backend': backend,
+        'batch_size': batch_size,
+        'batch_strategy': batch_strategy,
+        'thompson': thompson,
+        # the seed of all runs
+        'seed': seed,
+        'rounds': rounds,
+        'pcorrect': pcorrect,
+        'runtimes': runtimes,
+        'nrefits': nrefits
     }
-    filename = os.path.join(exppath, 'chrunsdt2d_dct.pkl')
-    print("Saving stats dictionary to: {}".format(filename))
-    with open(filename, 'wb') as f:
-        pickle.dump(dct, f)
+    print("Saving stats to: {}".format(results.filename))
+    results.close(dct)
     return dct
 
 if __name__ == "__main__":
@@ -310,16 +488,16 @@ if __name__ == "__main__":
     emg = args.emg
     trainsC = Trains(emg=args.emg, clean_thresh=0.06)
 
-    X1d,Y1d = make_dataset_1d(trainsC, emg=0)
-    m1d0, = train_models_1d(X1d,Y1d, ARD=True)
-    X1d,Y1d = make_dataset_1d(trainsC, emg=2)
-    m1d2, = train_models_1d(X1d,Y1d, ARD=True)
-    X1d,Y1d = make_dataset_1d(trainsC, emg=4)
-    m1d4, = train_models_1d(X1d,Y1d, ARD=True)
+    X1d,Y1d = make_dataset_1d(trainsC, emg=0, seed=REF_SEED)
+    m1d0 = fit_cached(train_model_1d, X1d,Y1d, ARD=True)
+    X1d,Y1d = make_dataset_1d(trainsC, emg=2, seed=REF_SEED)
+    m1d2 = fit_cached(train_model_1d, X1d,Y1d, ARD=True)
+    X1d,Y1d = make_dataset_1d(trainsC, emg=4, seed=REF_SEED)
+    m1d4 = fit_cached(train_model_1d, X1d,Y1d, ARD=True)
     prior1d = build_prior(m1d0,m1d4,input_dim=5)
 
-    X,Y = make_dataset_dt2d(trainsC,syn=(0,4),dts=[20,40,60])
-    m = train_models_dt2d(X,Y,prior1d=prior1d, kerneltype='mult', m1d=m1d0)
+    X,Y,N,SS = make_dataset_dt2d(trainsC,syn=(0,4),dts=[20,40,60],collapse=True)
+    m = fit_cached(train_models_dt2d, X,Y,prior1d=prior1d, kerneltype='mult', m1d=m1d0, counts=N, scatter=SS)
     print(get_maxchpairdt(m, dts))
 
     mdct = train_model_seq_dt2d(trainsC, 50, 100, syn=(0,4), dts=(20,40,60), prior1d=prior1d, m1d=m1d0, sa=False, ARD=True, kerneltype='mult', constrain=True, n_prior_queries=0)
@@ -0,0 +1,181 @@
+"""
+GP posteriors on the (small, fixed) candidate grids, from a cached
+prior covariance of the grid, computed once per model step.
+"""
+
+import numpy as np
+import itertools
+from collections import OrderedDict
+from scipy.linalg import solve_triangular
+from load_matlab import ch2xy
+from gp_incremental import IncrementalGP, jitchol
+from gp_kron import KronGPRegression
+
+# grid of get_acq_map in 1d (in the order of ch2xy, ie. of CHS)
+GRID_CHS = np.array(list(ch2xy.values()))
+GRID_1D = np.array(list(itertools.product(range(2),range(5))))
+GRID_2D = np.array(list(itertools.product(range(2),range(5), range(2), range(5))))
+
+def canonical_pairs(X):
+    # For dt=0, (ch1,ch2) and (ch2,ch1) are the same stimulation, so we
+    # map every pair (rows of X, with the electrodes in cols 0:2 and 2:4,
+    # dt (if any) after) to its canonical order: xy of ch1 <= xy of ch2
+    X = np.array(X)
+    swap = (X[:,0] > X[:,2]) | ((X[:,0] == X[:,2]) & (X[:,1] > X[:,3]))
+    X[swap,:4] = X[swap][:,[2,3,0,1]]
+    return X
+
+# the 55 canonical pairs of GRID_2D (search space of symmetric dt=0 runs)
+SYM_IDX = np.flatnonzero((canonical_pairs(GRID_2D) == GRID_2D).all(axis=1))
+GRID_2D_SYM = GRID_2D[SYM_IDX]
+
+_dt2d_grids = {}
+def grid_dt2d(dts):
+    # (cached, so that all consumers share the same array)
+    dts = tuple(dts)
+    if dts not in _dt2d_grids:
+        _dt2d_grids[dts] = np.array(list(itertools.product(range(2),range(5), range(2), range(5), dts)))
+    return _dt2d_grids[dts]
+
+class GridPrior:
+    # Prior of a GP on a grid: mean (the values of the mean function on
+    # grid, None for 0), covariance and an index of the grid points (to
+    # turn training inputs into rows of K)
+    def __init__(self, grid, kern, mean=None):
+        self.grid = grid
+        self.K = kern.K(grid)
+        self.kdiag = np.diag(self.K).copy()
+        self.mean = np.zeros((len(grid), 1)) if mean is None else mean
+        self.index = {tuple(x): i for i,x in enumerate(grid.tolist())}
+
+    def idx(self, X):
+        # grid indices of the rows of X (None if one isn't on the grid)
+        try:
+            return np.array([self.index[tuple(x)] for x in np.asarray(X).tolist()], dtype=int)
+        except KeyError:
+            return None
+
+# LRU of GridPriors. Sequential runs with fixed hyperparameters (or
+# several models with the same ones) all hit the same entry
+GRID_CACHE_SIZE = 16
+_grid_priors = OrderedDict()
+
+def _params_key(p):
+    if p is None:
+        return None
+    # (str as GPy gives the names of shared parameters, eg. of the dtprior
+    # mapping, as an array)
+    return (type(p).__name__, tuple(str(n) for n in p.parameter_names_flat()), p.param_array.tobytes())
+
+def grid_prior(grid, kern, mean_function=None):
+    # mean functions like build_prior's hold state that isn't a parameter
+    # (the tables of Prior1dTable), and are rebuilt at every step (see
+    # make_add_model), so they are keyed on their values on grid
+    mean = None if mean_function is None else mean_function.f(grid)
+    key = (id(grid), _params_key(kern), None if mean is None else mean.tobytes())
+    if key in _grid_priors:
+        _grid_priors.move_to_end(key)
+        prior, g = _grid_priors[key]
+        if g is grid:
+            return prior
+    prior = GridPrior(grid, kern, mean)
+    _grid_priors[key] = (prior, grid)
+    if len(_grid_priors) > GRID_CACHE_SIZE:
+        _grid_priors.popitem(last=False)
+    return prior
+
+def noise_var(m):
+    # noise variance of a model (GPy, gp_numpy or IncrementalGP)
+    if isinstance(m, IncrementalGP):
+        return m.noise_var
+    return m.likelihood.variance[0]
+
+def _model_key(m, grid):
+    # what a model's posterior on grid depends on (IncrementalGPs have
+    # fixed hyperparameters)
+    return (id(grid), len(m.X), _params_key(None if isinstance(m, IncrementalGP) else m))
+
+def grid_predict(m, grid):
+    # Same as m.predict(grid) (mean and variance, both (len(grid),1)),
+    # computed from the cached grid prior and cached on the model, so
+    # calling it again for the same model/step is free
+    # (see also grid_posterior_cov for the full covariance)
+    if hasattr(m, 'stored_predict'):
+        # a StepModel (see gp_snapshots), which may have it recorded
+        pred = m.stored_predict(grid)
+        if pred is not None:
+            return pred
+        m = m.model
+    key = _model_key(m, grid)
+    cache = m.__dict__.setdefault('_grid_preds', {})
+    if cache.get(id(grid), (None,))[0] == key:
+        return cache[id(grid)][1]
+    if isinstance(m, KronGPRegression):
+        # has its own (Kronecker) posterior, and no dense factor
+        cache[id(grid)] = (key, m.predict(grid))
+        return cache[id(grid)][1]
+    prior = grid_prior(grid, m.kern, m.mean_function)
+    idx = prior.idx(m.X)
+    if idx is None:
+        # some training pts aren't candidates, we can't use the grid prior
+        pred = m.predict(grid)
+    else:
+        Kxg = prior.K[idx]
+        if isinstance(m, IncrementalGP):
+            V = solve_triangular(m.L, Kxg, lower=True)
+            mean = prior.mean + V.T.dot(m._w[:m.n])[:,None]
+        else:
+            # GPy's own posterior (so this is what m.predict computes)
+            V = solve_triangular(m.posterior.woodbury_chol, Kxg, lower=True)
+            mean = prior.mean + Kxg.T.dot(m.posterior.woodbury_vector)
+        var = prior.kdiag - (V**2).sum(axis=0)
+        pred = (mean, var[:,None] + noise_var(m))
+    cache[id(grid)] = (key, pred)
+    return pred
+
+def grid_posterior_cov(m, grid):
+    # Full posterior covariance (of f, ie. without the noise) of m on
+    # grid, from the same cached prior and training factor as
+    # grid_predict (but not cached itself)
+    if hasattr(m, 'stored_predict'):
+        m = m.model
+    if isinstance(m, KronGPRegression):
+        raise Exception("grid_posterior_cov needs a dense model (not KronGPRegression)")
+    prior = grid_prior(grid, m.kern, m.mean_function)
+    idx = prior.idx(m.X)
+    Kxg = m.kern.K(m.X, grid) if idx is None else prior.K[idx]
+    L = m.L if isinstance(m, IncrementalGP) else m.posterior.woodbury_chol
+    V = solve_triangular(L, Kxg, lower=True)
+    return prior.K - V.T.dot(V)
+
+def grid_sample_factor(m, grid):
+    # Posterior mean (N,) of m on grid and a factor L of the posterior
+    # covariance of f (L L^T = cov, up to jitter). Cached on the model
+    # like grid_predict, so all the draws of a model/step (grid_samples)
+    # share one factorization
+    if hasattr(m, 'stored_predict'):
+        m = m.model
+    key = _model_key(m, grid)
+    cache = m.__dict__.setdefault('_grid_factors', {})
+    if cache.get(id(grid), (None,))[0] != key:
+        L,_ = jitchol(grid_posterior_cov(m, grid))
+        cache[id(grid)] = (key, (grid_predict(m, grid)[0][:,0], L))
+    return cache[id(grid)][1]
+
+def grid_samples(m, grid, n=1, rng=np.random):
+    # n joint draws of f from the posterior of m on grid, (n,len(grid)).
+    # rng is np.random (the global RNG, like the sa sampling of
+    # get_next_x) or a np.random.Generator
+    mean, L = grid_sample_factor(m, grid)
+    z = rng.standard_normal((n, len(mean)))
+    return mean + z.dot(L.T)
+
+def argmax_probs(m, grid, n=500, rng=None):
+    # Posterior probability that each cell of grid is the argmax of f,
+    # from n joint draws. By default the draws use their own fixed seed,
+    # so they don't touch the global RNG of the runs (and all the steps
+    # of a run use the same random numbers)
+    if rng is None:
+        rng = np.random.default_rng(0)
+    draws = grid_samples(m, grid, n, rng)
+    return np.bincount(draws.argmax(axis=1), minlength=len(grid)) / n
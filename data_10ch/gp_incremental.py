@@ -0,0 +1,219 @@
+"""
+Sequential GP with fixed hyperparameters: IncrementalGP grows the
+Cholesky factor of a GPy model one point at a time (O(n^2) per query)
+and predicts like it. RefitSchedule decides after which queries the
+hyperparameters are re-optimized.
+"""
+
+import numpy as np
+import math
+from scipy.linalg import solve_triangular
+
+def jitchol(A, maxtries=5):
+    # Same idea as GPy.util.linalg.jitchol: add increasing jitter to
+    # the diagonal until A is numerically positive definite. Also
+    # returns the jitter that was added
+    try:
+        return np.linalg.cholesky(A), 0.
+    except np.linalg.LinAlgError:
+        jitter = np.diag(A).mean() * 1e-6
+        for _ in range(maxtries):
+            try:
+                return np.linalg.cholesky(A + np.eye(len(A)) * jitter), jitter
+            except np.linalg.LinAlgError:
+                jitter *= 10
+        raise
+
+# GPy's ExactGaussianInference always adds this to the diagonal of
+# K+noise*I, we do the same so that our posterior matches GPy's
+CONST_JITTER = 1e-8
+
+class IncrementalGP:
+    """GP regression posterior, updated with rank-one Cholesky appends.
+
+    The kernel, noise variance and mean function are considered fixed:
+    if they change, call set_data to refactorize (or build a new one).
+    """
+
+    def __init__(self, kern, noise_var, mean_function=None, X=None, Y=None):
+        self.kern = kern
+        self.noise_var = float(noise_var)
+        self.mean_function = mean_function
+        # hyperparameters of the GPy model we come from (see from_gpy)
+        self.param_array = None
+        self._frozen = False
+        if X is None:
+            X = np.zeros((0, kern.input_dim))
+            Y = np.zeros((0, 1))
+        self.set_data(X, Y)
+
+    @classmethod
+    def from_gpy(cls, m):
+        # Takes the (current) hyperparameters and data of a GPy model
+        gp = cls(m.kern, m.likelihood.variance[0], m.mean_function, m.X, m.Y)
+        gp.param_array = m.param_array.copy()
+        return gp
+
+    def _mean(self, X):
+        if self.mean_function is None:
+            return np.zeros((len(X), 1))
+        return self.mean_function.f(X)
+
+    def _grow(self, n):
+        # The factor lives in preallocated buffers that double in size,
+        # so appending a point doesn't copy the whole factor
+        if n <= len(self._L):
+            return
+        cap = max(n, 2*len(self._L), 16)
+        L = np.zeros((cap, cap))
+        L[:self.n,:self.n] = self._L[:self.n,:self.n]
+        w = np.zeros(cap)
+        w[:self.n] = self._w[:self.n]
+        X = np.zeros((cap, self._X.shape[1]))
+        X[:self.n] = self._X[:self.n]
+        Y = np.zeros((cap, 1))
+        Y[:self.n] = self._Y[:self.n]
+        self._L, self._w, self._X, self._Y = L, w, X, Y
+
+    def set_data(self, X, Y):
+        # Full O(n^3) factorization of K + noise*I
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        Y = np.asarray(Y, dtype=float).reshape((-1, 1))
+        self.n = 0
+        self._L = np.zeros((0, 0))
+        self._w = np.zeros(0)
+        self._X = np.zeros((0, X.shape[1]))
+        self._Y = np.zeros((0, 1))
+        self._grow(len(X))
+        self.n = len(X)
+        self._jitter = 0.
+        if self.n == 0:
+            return
+        K = self.kern.K(X) + np.eye(self.n) * (self.noise_var + CONST_JITTER)
+        L, self._jitter = jitchol(K)
+        self._L[:self.n,:self.n] = L
+        # w = L^-1 (Y - mean), so that the posterior mean is V.T w
+        # (see predict)
+        self._w[:self.n] = solve_triangular(L, (Y - self._mean(X))[:,0], lower=True)
+        self._X[:self.n] = X
+        self._Y[:self.n] = Y
+
+    @property
+    def X(self):
+        return self._X[:self.n]
+
+    @property
+    def Y(self):
+        return self._Y[:self.n]
+
+    @property
+    def L(self):
+        return self._L[:self.n,:self.n]
+
+    def add(self, x, y):
+        # Appends one observation (x,y) in O(n^2)
+        assert not self._frozen, "can't add points to a snapshot"
+        x = np.asarray(x, dtype=float).reshape((1, -1))
+        if self.n == 0:
+            self.set_data(x, [[y]])
+            return
+        k = self.kern.K(self.X, x)[:,0]
+        l = solve_triangular(self.L, k, lower=True)
+        # the jitter of the last full factorization is kept for all
+        # appended pts, so K+noise*I stays as well conditioned as it was
+        kxx = self.kern.Kdiag(x)[0] + self.noise_var + CONST_JITTER + self._jitter
+        d2 = kxx - l.dot(l)
+        if d2 <= kxx * 1e-10:
+            # (numerically) lost positive definiteness: refactorize, which
+            # adds jitter
+            self.set_data(np.vstack((self.X, x)), np.vstack((self.Y, [[y]])))
+            return
+        n = self.n
+        self._grow(n+1)
+        d = np.sqrt(d2)
+        self._L[n,:n] = l
+        self._L[n,n] = d
+        r = y - self._mean(x)[0,0]
+        self._w[n] = (r - l.dot(self._w[:n])) / d
+        self._X[n] = x
+        self._Y[n] = y
+        self.n = n+1
+
+    def snapshot(self):
+        # Read-only view of the current posterior. The leading block of
+        # the factor never changes when we append, so the snapshot can
+        # share the buffers with self (no copy)
+        snap = object.__new__(IncrementalGP)
+        snap.__dict__.update(self.__dict__)
+        snap.__dict__.pop('_grid_preds', None)
+        snap._frozen = True
+        return snap
+
+    def predict(self, Xnew, full_cov=False, include_likelihood=True):
+        # Same outputs as GPy's model.predict: mean (n,1) and variance
+        # (n,1), or (n,n) covariance if full_cov
+        Xnew = np.atleast_2d(np.asarray(Xnew, dtype=float))
+        mean = self._mean(Xnew)
+        if self.n == 0:
+            V = np.zeros((0, len(Xnew)))
+        else:
+            V = solve_triangular(self.L, self.kern.K(self.X, Xnew), lower=True)
+            mean = mean + V.T.dot(self._w[:self.n])[:,None]
+        if full_cov:
+            var = self.kern.K(Xnew) - V.T.dot(V)
+            if include_likelihood:
+                var = var + np.eye(len(Xnew)) * self.noise_var
+        else:
+            var = (self.kern.Kdiag(Xnew) - (V**2).sum(axis=0))[:,None]
+            if include_likelihood:
+                var = var + self.noise_var
+        return mean, var
+
+class RefitSchedule:
+    """When to re-optimize the hyperparameters during a sequential run.
+
+    spec is one of
+      'always'        after every query (what continue_opt=True does)
+      'never'         keep the hyperparameters of the initial fit
+      'every:k'       every k queries
+      'geometric:r'   after queries 1, r, r^2, ... (rounded up)
+      'grad:tol'      when the norm of the gradient of the log marginal
+                      likelihood (at the current hyperparameters, with
+                      the new data) is larger than tol
+    step is the number of sequential queries done so far (starts at 1).
+    """
+
+    def __init__(self, spec='always'):
+        self.spec = spec
+        name, _, arg = spec.partition(':')
+        if name not in ('always', 'never', 'every', 'geometric', 'grad'):
+            raise Exception("refit schedule should be one of always, never, every:k, geometric:r, grad:tol")
+        self.name = name
+        self.k = int(arg) if name == 'every' else None
+        self.r = float(arg) if name == 'geometric' else None
+        self.tol = float(arg) if name == 'grad' else None
+        assert self.k is None or self.k >= 1, "every:k needs k >= 1"
+        assert self.r is None or self.r > 1, "geometric:r needs r > 1"
+        self._next = 1
+
+    @property
+    def needs_model(self):
+        # The grad schedule needs a GPy model with the new data
+        return self.name == 'grad'
+
+    def __call__(self, step, m=None):
+        if self.name == 'always':
+            return True
+        elif self.name == 'never':
+            return False
+        elif self.name == 'every':
+            return step % self.k == 0
+        elif self.name == 'geometric':
+            if step >= self._next:
+                while self._next <= step:
+                    self._next = math.ceil(self._next * self.r)
+                return True
+            return False
+        else:
+            grad = m.objective_function_gradients()
+            return np.linalg.norm(grad) > self.tol
@@ -0,0 +1,209 @@
+"""
+Exact GP on a full grid with a product kernel (eg. (k1*k2)*kdt of
+train_models_dt2d), using Kronecker algebra on the small per-part
+covariances instead of a dense solve.
+"""
+
+import numpy as np
+import GPy
+from gp_incremental import CONST_JITTER
+
+def kron_mvm(Ms, v):
+    # (M1 kron M2 kron ... kron MD) v, without forming the product.
+    # v is (N,) or (N,k)
+    shape = [M.shape[1] for M in Ms]
+    V = v.reshape(shape + list(v.shape[1:]))
+    for d,M in enumerate(Ms):
+        V = np.moveaxis(np.tensordot(M, V, axes=([1],[d])), 0, d)
+    return V.reshape((-1,) + v.shape[1:])
+
+def kron_vec(vs):
+    # kron of vectors (eg. the eigenvalues of K1 kron K2 kron ...)
+    out = np.ones(1)
+    for v in vs:
+        out = np.multiply.outer(out, v).reshape(-1)
+    return out
+
+class KronGPRegression(GPy.core.Model):
+    # grid is the full grid (in itertools.product order, eg. GRID_2D or
+    # grid_dt2d(dts)). X,Y,counts are the observed cells (output of
+    # make_dataset_2d(collapse=True)), scatter is used like in
+    # CollapsedGPRegression so that the likelihood is that of all trials.
+    # mean_function (eg. build_prior) is kept fixed. With equal counts
+    # everything is exact; otherwise the mean and variances are still
+    # exact (conjugate gradients with Kronecker MVMs), but the log
+    # determinant is approximated (Wilson et al. 2014). Only product
+    # kernels are separable (not the 4d Matern52 of kerneltype='mult')
+    def __init__(self, X, Y, kernel, grid, counts=None, scatter=0., noise_var=1., mean_function=None, name='kron GP regression'):
+        super(KronGPRegression, self).__init__(name=name)
+        self.grid = np.asarray(grid, dtype=float)
+        self.kern = kernel
+        self.parts = kernel.parts if isinstance(kernel, GPy.kern.Prod) else [kernel]
+        # Every part gives one Kronecker factor, on the unique values
+        # of its dims in the grid
+        self.axes = []
+        self.Xaxes = []
+        pos = 0
+        for part in self.parts:
+            dims = list(part.active_dims)
+            assert dims == list(range(pos, pos+len(dims))), \
+                "kernel parts must act on consecutive blocks of dims (a Symmetric or a 4d Matern kernel isn't separable)"
+            pos += len(dims)
+            _, first = np.unique(self.grid[:,dims], axis=0, return_index=True)
+            axis = self.grid[np.sort(first)][:,dims]
+            Xd = np.zeros((len(axis), self.grid.shape[1]))
+            Xd[:,dims] = axis
+            self.axes.append(axis)
+            self.Xaxes.append(Xd)
+        self.sizes = [len(a) for a in self.axes]
+        assert np.prod(self.sizes) == len(self.grid), "grid is not a product of the kernel's axes"
+        self.index = {tuple(x): i for i,x in enumerate(self.grid.tolist())}
+        self.X = np.asarray(X, dtype=float)
+        self.Y = np.asarray(Y, dtype=float).reshape((-1,1))
+        if counts is None:
+            counts = np.ones(len(self.X))
+        self.counts = np.asarray(counts, dtype=float).reshape(-1)
+        self.scatter = scatter
+        self.idx = np.array([self.index[tuple(x)] for x in self.X.tolist()], dtype=int)
+        assert len(np.unique(self.idx)) == len(self.idx), "X must have one row per cell (use collapse_dataset)"
+        self.w = np.zeros(len(self.grid))
+        self.w[self.idx] = self.counts
+        self.obs = self.w > 0
+        self.exact = self.obs.all() and np.all(self.w == self.w[0])
+        self.mean_function = mean_function
+        self.mean = np.zeros(len(self.grid)) if mean_function is None else mean_function.f(self.grid)[:,0]
+        self.y = np.zeros(len(self.grid))
+        self.y[self.idx] = self.Y[:,0]
+        self.likelihood = GPy.likelihoods.Gaussian(variance=noise_var)
+        self.link_parameters(self.kern, self.likelihood)
+
+    def _solve(self, D, R):
+        # (K + diag(D))^-1 R on the observed cells (R is (N,) or (N,k),
+        # only its observed rows are used), by conjugate gradients on all
+        # the columns at once, preconditioned with (K + mean(D) I)^-1
+        # (both via Kronecker MVMs)
+        obs = self.obs
+        N, n = len(self.grid), obs.sum()
+        def embed(x):
+            z = np.zeros((N, x.shape[1]))
+            z[obs] = x
+            return z
+        def mvm(x):
+            return kron_mvm(self.Ks, embed(x))[obs] + D[obs][:,None]*x
+        def precond(x):
+            return kron_mvm(self.Qs, kron_mvm(self.QTs, embed(x)) / (self.lam + self.dbar)[:,None])[obs]
+        B = R[obs].reshape((n, -1))
+        X = np.zeros(B.shape)
+        res = B.copy()
+        Z = precond(res)
+        P = Z.copy()
+        rz = (res*Z).sum(0)
+        tol = 1e-10*np.linalg.norm(B, axis=0)
+        for _ in range(10*n):
+            done = np.linalg.norm(res, axis=0) <= tol
+            if done.all():
+                break
+            AP = mvm(P)
+            a = np.where(done, 0., rz / np.where(done, 1., (P*AP).sum(0)))
+            X += a*P
+            res -= a*AP
+            Z = precond(res)
+            rznew = (res*Z).sum(0)
+            b = np.where(done, 0., rznew / np.where(done, 1., rz))
+            P = Z + b*P
+            rz = rznew
+        out = np.zeros((N, B.shape[1]))
+        out[obs] = X
+        return out.reshape(R.shape)
+
+    def parameters_changed(self):
+        self.Ks = [part.K(Xd) for part,Xd in zip(self.parts, self.Xaxes)]
+        eigs = [np.linalg.eigh(K) for K in self.Ks]
+        self.lams = [np.clip(l, 0, None) for l,_ in eigs]
+        self.Qs = [Q for _,Q in eigs]
+        self.QTs = [Q.T for Q in self.Qs]
+        self.lam = kron_vec(self.lams)
+        # + GPy's jitter, as in CollapsedGPRegression (so the noise of a
+        # cell is never 0)
+        v = self.likelihood.variance[0] + CONST_JITTER
+        obs = self.obs
+        n, N = obs.sum(), len(self.grid)
+        D = np.full(N, np.inf)
+        D[obs] = v / self.w[obs]
+        # dbar is the (mean) noise of a cell, and dv its derivative wrt v
+        dv = (1./self.w[obs]).mean()
+        self.dbar = v * dv
+        self.D = D
+        # (predictive variances, computed by predict_grid when needed)
+        self._var = None
+        r = np.where(obs, self.y - self.mean, 0.)
+        if self.exact:
+            c = 1.
+            top = np.ones(N, dtype=bool)
+            self.alpha = kron_mvm(self.Qs, kron_mvm(self.QTs, r) / (self.lam + self.dbar))
+        else:
+            # log det approximation from the n largest eigenvalues
+            c = n / N
+            top = np.zeros(N, dtype=bool)
+            top[np.argsort(self.lam)[N-n:]] = True
+            self.alpha = self._solve(D, r)
+        t = np.where(top, 1./(c*self.lam + self.dbar), 0.)
+        logdet = np.log(c*self.lam[top] + self.dbar).sum()
+        self._log_marginal_likelihood = -0.5*r.dot(self.alpha) - 0.5*logdet - 0.5*n*np.log(2*np.pi)
+        # The trials' scatter around the cell means (see CollapsedGPRegression)
+        nextra = self.counts.sum() - n
+        self._log_marginal_likelihood += (-0.5*self.scatter/v - 0.5*nextra*np.log(2*np.pi*v)
+                                          - 0.5*np.log(self.counts).sum())
+        self.likelihood.variance.gradient = (0.5*(self.alpha[obs]**2 / self.w[obs]).sum() - 0.5*t.sum()*dv
+                                             + 0.5*self.scatter/v**2 - 0.5*nextra/v)
+        # Kernel gradients: for each part d, dL/dK_d as a (small) matrix
+        # from the quadratic term alpha^T dK alpha and the log det term
+        # sum_j c t_j dlam_j, where dlam_j = diag(Q^T dK Q)_j
+        A = self.alpha.reshape(self.sizes)
+        S = (c*t).reshape(self.sizes)
+        for d,(part,Xd) in enumerate(zip(self.parts, self.Xaxes)):
+            B = A
+            cd = S
+            for e in range(len(self.sizes)):
+                if e != d:
+                    B = np.moveaxis(np.tensordot(self.Ks[e], B, axes=([1],[e])), 0, e)
+                    cd = np.moveaxis(np.tensordot(self.lams[e], cd, axes=([0],[e]))[None], 0, e)
+            Ad = np.moveaxis(A, d, 0).reshape(self.sizes[d], -1)
+            Bd = np.moveaxis(B, d, 0).reshape(self.sizes[d], -1)
+            Wquad = Ad.dot(Bd.T)
+            Wtr = (self.Qs[d] * cd.reshape(-1)).dot(self.QTs[d])
+            W = 0.5*(Wquad - Wtr)
+            part.update_gradients_full(0.5*(W + W.T), Xd)
+
+    def log_likelihood(self):
+        return self._log_marginal_likelihood
+
+    def _grid_var(self):
+        # diag(K - K_go (K_oo + D)^-1 K_og) on the whole grid (o: the
+        # observed cells)
+        if self.exact:
+            # = (Q**2 kron ...) (lam dbar/(lam + dbar))
+            return kron_mvm([Q**2 for Q in self.Qs], self.lam*self.dbar/(self.lam + self.dbar))
+        obs = np.flatnonzero(self.obs)
+        E = np.zeros((len(self.grid), len(obs)))
+        E[obs, np.arange(len(obs))] = 1.
+        Kgo = kron_mvm(self.Ks, E)
+        Ainv = self._solve(self.D, E)[obs]
+        diagK = kron_vec([np.diag(K) for K in self.Ks])
+        return diagK - (Kgo.dot(Ainv) * Kgo).sum(1)
+
+    def predict_grid(self, include_likelihood=True):
+        # Posterior mean and variance (both (N,1)) on the whole grid
+        mean = self.mean + kron_mvm(self.Ks, self.alpha)
+        if self._var is None:
+            self._var = np.clip(self._grid_var(), 0, None)
+        var = self._var
+        if include_likelihood:
+            var = var + self.likelihood.variance[0]
+        return mean[:,None], var[:,None]
+
+    def predict(self, Xnew, include_likelihood=True):
+        # Xnew must be points of the grid
+        idx = [self.index[tuple(x)] for x in np.asarray(Xnew, dtype=float).tolist()]
+        mean,var = self.predict_grid(include_likelihood)
+        return mean[idx], var[idx]
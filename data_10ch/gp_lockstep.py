@@ -0,0 +1,100 @@
+"""
+Many sequential runs with shared, fixed hyperparameters, simulated in
+lock step: LockstepGP stacks the grid posteriors of the runs and
+updates them all with one rank-one update per step.
+"""
+
+import numpy as np
+from gp_grid import grid_prior, noise_var
+from gp_incremental import CONST_JITTER
+
+class LockstepGP:
+    """Posteriors of R GPs with the same kernel, noise and mean function
+    on the same grid, updated with one observation per GP at a time."""
+
+    def __init__(self, grid, kern, noise_var, mean_function=None, R=1):
+        self.grid = grid
+        # + GPy's jitter, so that we get the posterior of a GPy model
+        self.noise_var = float(noise_var) + CONST_JITTER
+        prior = grid_prior(grid, kern, mean_function)
+        self.mean = np.repeat(prior.mean[:,0][None], R, axis=0)
+        self.cov = np.repeat(prior.K[None], R, axis=0)
+        self.n = 0
+
+    @classmethod
+    def from_model(cls, m, grid, R=1):
+        # R priors with the hyperparameters of m (not its data)
+        return cls(grid, m.kern, noise_var(m), m.mean_function, R)
+
+    @property
+    def R(self):
+        return len(self.mean)
+
+    def add(self, idx, y):
+        # Observe y[r] at grid[idx[r]] in run r (idx, y are (R,))
+        r = np.arange(self.R)
+        idx = np.asarray(idx, dtype=int)
+        y = np.asarray(y, dtype=float).reshape(-1)
+        cj = self.cov[r,:,idx]
+        c = cj / (cj[r,idx] + self.noise_var)[:,None]
+        self.mean += c * (y - self.mean[r,idx])[:,None]
+        self.cov -= np.einsum('ri,rj->rij', c, cj)
+        self.n += 1
+
+    def predict(self, include_likelihood=True):
+        # posterior mean and variance of every run on grid, both (R,N)
+        var = np.clip(np.diagonal(self.cov, axis1=1, axis2=2), 0, None)
+        if include_likelihood:
+            var = var + self.noise_var
+        return self.mean, var
+
+    def acq(self, k=2):
+        # UCB of every run (same as get_acq_map), (R,N)
+        mean,var = self.predict()
+        return mean + k*np.sqrt(var)
+
+def pick_rows(acq, sa=False, T=0.001, rng=None):
+    # argmax of every row of acq or, if sa, a sample of the softmax of
+    # every row (like pick_idx of gp_full_2d) using rng
+    if not sa:
+        return acq.argmax(axis=1)
+    e = np.exp((acq - acq.max(axis=1, keepdims=True)) / T)
+    cdf = np.cumsum(e / e.sum(axis=1, keepdims=True), axis=1)
+    u = rng.random((len(acq), 1))
+    return np.minimum((cdf < u).sum(axis=1), acq.shape[1]-1)
+
+def lockstep_runs(gp, samplers, cells, X0, n_steps, k=2, sa=False, T=0.001, cands=None, rng=None, save_means=True):
+    # Runs the R = gp.R sequential runs, run r drawing its responses
+    # from samplers[r] (ResponseSamplers). cells = (chs1, chs2, dts) of
+    # every grid point. X0 (R,n0) are the grid indices of the initial
+    # queries of the runs, then every step queries the argmax of each
+    # run's UCB (or with sa, a softmax sample with rng), among cands
+    # (indices of the grid, default all).
+    # Returns the queried grid indices (R,n0+n_steps), the responses
+    # and, if save_means, the posterior means after the initial queries
+    # and after every step ((R,n_steps+1,N))
+    if cands is None:
+        cands = np.arange(len(gp.grid))
+    if rng is None:
+        rng = np.random.default_rng()
+    chs1, chs2, dts = [np.asarray(c) for c in cells]
+    def observe(idx):
+        y = np.array([float(s.sample(chs1[i], chs2[i], dts[i])) for s,i in zip(samplers, idx)])
+        gp.add(idx, y)
+        return y
+    X0 = np.asarray(X0, dtype=int).reshape((gp.R, -1))
+    idxs = [X0[:,j] for j in range(X0.shape[1])]
+    Y = [observe(idx) for idx in idxs]
+    means = [gp.mean.copy()] if save_means else []
+    for step in range(n_steps):
+        idx = cands[pick_rows(gp.acq(k)[:,cands], sa=sa, T=T, rng=rng)]
+        idxs.append(idx)
+        Y.append(observe(idx))
+        if save_means:
+            means.append(gp.mean.copy())
+    dct = {
+        'idx': np.stack(idxs, axis=1),
+        'Y': np.stack(Y, axis=1),
+        'means': np.stack(means, axis=1) if save_means else None
+    }
+    return dct
@@ -0,0 +1,133 @@
+"""
+Cache of the optimised parameters of the full-data reference models,
+keyed on a hash of the train function, its arguments and data (see
+fit_cached). Bump VERSION when a train function changes.
+"""
+
+import os
+import hashlib
+import inspect
+import tempfile
+import numpy as np
+
+VERSION = 1
+# arguments of train that don't change the fitted parameters
+IGNORED_ARGS = ('optimize', 'verbose')
+
+def _update(h, v, X):
+    # adds v (an argument of a train function) to the hash h, X: the
+    # inputs of the data (to hash mean functions by their values)
+    if hasattr(v, 'param_array') and hasattr(v, 'X'):
+        # a model (eg. prior1d)
+        h.update(type(v).__name__.encode())
+        for a in (v.X, v.Y, v.param_array):
+            _update(h, np.asarray(a), X)
+    elif hasattr(v, 'param_array') and hasattr(v, 'f'):
+        # a mean function (eg. build_prior)
+        h.update(type(v).__name__.encode())
+        for a in (v.param_array, v.f(np.asarray(X))):
+            _update(h, np.asarray(a), X)
+    elif isinstance(v, np.ndarray):
+        h.update('{}{}'.format(v.dtype.str, v.shape).encode())
+        h.update(np.ascontiguousarray(v).tobytes())
+    elif isinstance(v, (list, tuple, range)):
+        h.update('{}{}'.format(type(v).__name__, len(v)).encode())
+        for x in v:
+            _update(h, x, X)
+    else:
+        h.update(repr(v).encode())
+
+def model_key(train, X, Y, **kwargs):
+    # hash of the model train(X, Y, **kwargs)
+    args = inspect.signature(train).bind(X, Y, **kwargs)
+    args.apply_defaults()
+    h = hashlib.sha1('{}{}'.format(VERSION, train.__name__).encode())
+    for name,v in args.arguments.items():
+        if name in IGNORED_ARGS:
+            continue
+        h.update(name.encode())
+        _update(h, v, X)
+    return h.hexdigest()
+
+class ModelCache:
+    """Parameter arrays keyed by model_key, in the directory path, with at
+    most max_mb MB of them (least recently used ones removed first)."""
+
+    def __init__(self, path=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'exps', 'models'), max_mb=100):
+        self.path = path
+        self.max_bytes = max_mb * 2**20
+
+    def _filename(self, key):
+        return os.path.join(self.path, '{}.npy'.format(key))
+
+    def get(self, key):
+        # the parameters of key (None if not in the cache)
+        filename = self._filename(key)
+        try:
+            params = np.load(filename)
+            os.utime(filename)
+        except (OSError, ValueError):
+            # (not there, or removed by another job in the meantime)
+            return None
+        return params
+
+    def put(self, key, params):
+        # Written to a temporary file then renamed, so that jobs sharing
+        # the cache never read a partial file
+        os.makedirs(self.path, exist_ok=True)
+        fd,tmp = tempfile.mkstemp(dir=self.path, prefix='.tmp', suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, np.asarray(params))
+        os.replace(tmp, self._filename(key))
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        # removes the least recently used files until the cache is under
+        # max_bytes (except the file of keep)
+        files = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.npy') or name.startswith('.tmp'):
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _,size,_ in files)
+        for _,size,name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if name == '{}.npy'.format(keep):
+                continue
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+MODEL_CACHE = ModelCache()
+
+def fit_cached(train, X, Y, cache=MODEL_CACHE, **kwargs):
+    # train(X, Y, **kwargs) (eg. train_model_1d, train_models_2d, which
+    # must take optimize), with its optimised parameters from cache when
+    # they are there (cache=None to always optimise). The optimisation
+    # (its random restarts) is seeded from the key, and the global RNG
+    # restored after it, so that the model only depends on its inputs,
+    # whether it comes from the cache or not
+    if not kwargs.get('optimize', True):
+        return train(X, Y, **kwargs)
+    key = model_key(train, X, Y, **kwargs)
+    params = cache.get(key) if cache is not None else None
+    if params is not None:
+        m = train(X, Y, **dict(kwargs, optimize=False))
+        m[:] = params
+        return m
+    state = np.random.get_state()
+    np.random.seed(int(key[:8], 16))
+    try:
+        m = train(X, Y, **kwargs)
+    finally:
+        np.random.set_state(state)
+    if cache is not None:
+        cache.put(key, m.param_array)
+    return m
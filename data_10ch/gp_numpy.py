@@ -0,0 +1,468 @@
+"""
+Minimal GP regression in numpy/scipy, with the bits of GPy's API that
+the builders and the sequential runs use, without GPy's (slow) model
+construction. Pick it with get_backend.
+"""
+
+import sys
+import copy
+import numpy as np
+from types import SimpleNamespace
+from scipy.linalg import cho_solve, solve_triangular
+from scipy.optimize import minimize
+from gp_incremental import jitchol, CONST_JITTER
+
+BACKENDS = ('gpy', 'numpy')
+
+def get_backend(backend):
+    # module with kern.Matern52 and models.GPRegression for backend
+    if backend == 'gpy':
+        import GPy
+        return GPy
+    elif backend == 'numpy':
+        return sys.modules[__name__]
+    raise Exception("backend should be one of {}".format(BACKENDS))
+
+class Param(np.ndarray):
+    # A (vector) hyperparameter, constrained positive by default
+    def __new__(cls, value, size, name):
+        obj = np.array(np.broadcast_to(np.asarray(value, dtype=float).reshape(-1), (size,))).view(cls)
+        obj.name = name
+        obj.bounds = (0., np.inf)
+        obj.fixed = False
+        return obj
+
+    def __array_finalize__(self, obj):
+        self.name = getattr(obj, 'name', None)
+        self.bounds = getattr(obj, 'bounds', (0., np.inf))
+        self.fixed = getattr(obj, 'fixed', False)
+
+    def __reduce__(self):
+        # so that pickles (and copies) keep the constraints
+        return (_unpickle_param, (self.values.copy(), self.name, self.bounds, self.fixed))
+
+    @property
+    def values(self):
+        return self.view(np.ndarray)
+
+    def constrain_bounded(self, lower, upper, warning=True):
+        self.bounds = (lower, upper)
+        self[:] = np.clip(self.values, lower, upper)
+
+    def constrain_positive(self, warning=True):
+        self.bounds = (0., np.inf)
+
+    def fix(self):
+        self.fixed = True
+
+    def unfix(self):
+        self.fixed = False
+
+    # in optimizer space: log(x-lower), or logit when bounded
+    def to_opt(self):
+        lo,hi = self.bounds
+        x = self.values
+        if np.isinf(hi):
+            return np.log(np.maximum(x - lo, 1e-300))
+        u = np.clip((x - lo) / (hi - lo), 1e-12, 1-1e-12)
+        return np.log(u) - np.log1p(-u)
+
+    def from_opt(self, t):
+        lo,hi = self.bounds
+        if np.isinf(hi):
+            return lo + np.exp(t)
+        return lo + (hi - lo) / (1 + np.exp(-t))
+
+    def dopt(self):
+        # dx/dt at the current value
+        lo,hi = self.bounds
+        x = self.values
+        if np.isinf(hi):
+            return x - lo
+        return (x - lo) * (hi - x) / (hi - lo)
+
+def _unpickle_param(value, name, bounds, fixed):
+    p = Param(value, len(value), name)
+    p.bounds = bounds
+    p.fixed = fixed
+    return p
+
+class Parameterized:
+    # k.variance = 2. sets the values of the parameter (like GPy)
+    def __setattr__(self, name, value):
+        p = self.__dict__.get(name)
+        if isinstance(p, Param) and not isinstance(value, Param):
+            p[:] = value
+        elif isinstance(p, Param):
+            p[:] = value.values
+        else:
+            object.__setattr__(self, name, value)
+
+    def _own_params(self):
+        return [p for p in self.__dict__.values() if isinstance(p, Param)]
+
+    @property
+    def parameters(self):
+        return self._own_params()
+
+    @property
+    def param_array(self):
+        return np.concatenate([p.values for p in self.parameters])
+
+    def parameter_names_flat(self):
+        return ['{}.{}'.format(self.name, p.name) for p in self.parameters]
+
+    def fix(self):
+        for p in self.parameters:
+            p.fix()
+
+    def unfix(self):
+        for p in self.parameters:
+            p.unfix()
+
+    def copy(self):
+        return copy.deepcopy(self)
+
+class Kern(Parameterized):
+    def __init__(self, input_dim, active_dims, name):
+        self.input_dim = input_dim
+        self.active_dims = np.arange(input_dim) if active_dims is None else np.asarray(active_dims)
+        self.name = name
+        self.parts = []
+
+    def __add__(self, other):
+        return Add([self, other])
+
+    def __mul__(self, other):
+        return Prod([self, other])
+
+    def __getattr__(self, name):
+        # parts by name, like k.Mat52_1 in GPy
+        if name.startswith('__') or 'parts' not in self.__dict__:
+            raise AttributeError(name)
+        for part in self.parts:
+            if part.name == name:
+                return part
+        raise AttributeError(name)
+
+    def Kdiag(self, X):
+        return np.diag(self.K(X)).copy()
+
+class Matern52(Kern):
+    def __init__(self, input_dim=1, variance=1., lengthscale=None, ARD=False, active_dims=None, name='Mat52'):
+        super(Matern52, self).__init__(input_dim, active_dims, name)
+        self.ARD = ARD
+        self.variance = Param(variance, 1, 'variance')
+        self.lengthscale = Param(1. if lengthscale is None else lengthscale, input_dim if ARD else 1, 'lengthscale')
+
+    def _r(self, X, X2):
+        l = self.lengthscale.values
+        Xs = X[:,self.active_dims] / l
+        X2s = Xs if X2 is None else X2[:,self.active_dims] / l
+        r2 = (Xs**2).sum(1)[:,None] + (X2s**2).sum(1)[None,:] - 2*Xs.dot(X2s.T)
+        r2 = np.clip(r2, 0, None)
+        return np.sqrt(r2), r2
+
+    def K(self, X, X2=None):
+        r, r2 = self._r(X, X2)
+        s5r = np.sqrt(5)*r
+        return self.variance[0] * (1 + s5r + 5./3*r2) * np.exp(-s5r)
+
+    def Kdiag(self, X):
+        return np.full(len(X), self.variance[0])
+
+    def gradients_full(self, dL_dK, X, X2=None):
+        # gradient of sum(dL_dK * K) wrt [variance, lengthscale]
+        v = self.variance[0]
+        l = self.lengthscale.values
+        r, r2 = self._r(X, X2)
+        s5r = np.sqrt(5)*r
+        E = np.exp(-s5r)
+        dvar = (dL_dK * (1 + s5r + 5./3*r2) * E).sum()
+        # dK/dr = -r*G
+        W = dL_dK * (5./3 * v * (1 + s5r) * E)
+        if not self.ARD:
+            dl = np.array([(W * r2).sum() / l[0]])
+        else:
+            Xa = X[:,self.active_dims]
+            X2a = Xa if X2 is None else X2[:,self.active_dims]
+            # sum_jk W_jk (x_ji - x2_ki)**2 for every dim i
+            d2 = W.sum(1).dot(Xa**2) + W.sum(0).dot(X2a**2) - 2*(Xa * W.dot(X2a)).sum(0)
+            dl = d2 / l**3
+        return np.concatenate(([dvar], dl))
+
+class Combination(Kern):
+    # Add / Prod of kernels. Like GPy, nested ones of the same type are
+    # flattened and parts get unique names (Mat52, Mat52_1, ...)
+    def __init__(self, parts, name):
+        flat = []
+        for part in parts:
+            flat.extend(part.parts if type(part) is type(self) else [part])
+        dims = np.unique(np.concatenate([p.active_dims for p in flat]))
+        super(Combination, self).__init__(dims.max()+1, dims, name)
+        names = {}
+        for part in flat:
+            base = part.name.split('_')[0] if part.name.rsplit('_',1)[-1].isdigit() else part.name
+            n = names.get(base, 0)
+            part.name = base if n == 0 else '{}_{}'.format(base, n)
+            names[base] = n + 1
+        self.parts = flat
+
+    @property
+    def parameters(self):
+        return [p for part in self.parts for p in part.parameters]
+
+    def parameter_names_flat(self):
+        return ['{}.{}'.format(self.name, n) for part in self.parts for n in part.parameter_names_flat()]
+
+class Add(Combination):
+    def __init__(self, parts, name='sum'):
+        super(Add, self).__init__(parts, name)
+
+    def K(self, X, X2=None):
+        return sum(part.K(X, X2) for part in self.parts)
+
+    def Kdiag(self, X):
+        return sum(part.Kdiag(X) for part in self.parts)
+
+    def gradients_full(self, dL_dK, X, X2=None):
+        return np.concatenate([part.gradients_full(dL_dK, X, X2) for part in self.parts])
+
+class Prod(Combination):
+    def __init__(self, parts, name='mul'):
+        super(Prod, self).__init__(parts, name)
+
+    def K(self, X, X2=None):
+        return np.prod([part.K(X, X2) for part in self.parts], axis=0)
+
+    def Kdiag(self, X):
+        return np.prod([part.Kdiag(X) for part in self.parts], axis=0)
+
+    def gradients_full(self, dL_dK, X, X2=None):
+        Ks = [part.K(X, X2) for part in self.parts]
+        grads = []
+        for i,part in enumerate(self.parts):
+            others = np.prod([K for j,K in enumerate(Ks) if j != i], axis=0)
+            grads.append(part.gradients_full(dL_dK * others, X, X2))
+        return np.concatenate(grads)
+
+class MappingParam:
+    # A parameter of a GPy mean function (eg. the Linear coefficients of
+    # build_prior's), which GPy learns with the GP: unconstrained, and
+    # optimized as is
+    def __init__(self, p):
+        self.p = p
+        self.name = p.name
+
+    def __len__(self):
+        return self.p.size
+
+    @property
+    def values(self):
+        return np.array(self.p.values, dtype=float).reshape(-1)
+
+    @property
+    def fixed(self):
+        return self.p.is_fixed
+
+    def __setitem__(self, key, value):
+        x = self.values
+        x[key] = value
+        self.p[:] = x.reshape(self.p.shape)
+
+    def to_opt(self):
+        return self.values
+
+    def from_opt(self, t):
+        return t
+
+    def dopt(self):
+        return np.ones(len(self))
+
+class Gaussian(Parameterized):
+    def __init__(self, variance=1., name='Gaussian_noise'):
+        self.name = name
+        self.variance = Param(variance, 1, 'variance')
+
+class GPRegression:
+    def __init__(self, X, Y, kernel=None, noise_var=1., mean_function=None):
+        self.X = np.asarray(X, dtype=float)
+        self.Y = np.asarray(Y, dtype=float)
+        self.kern = Matern52(self.X.shape[1]) if kernel is None else kernel
+        self.likelihood = Gaussian(noise_var)
+        self.mean_function = mean_function
+        self._key = None
+
+    def __getattr__(self, name):
+        # m.Mat52 / m.sum / m.Gaussian_noise / m.mapping like in GPy
+        if name.startswith('_') or 'kern' not in self.__dict__:
+            raise AttributeError(name)
+        if name == self.kern.name:
+            return self.kern
+        if name == self.likelihood.name:
+            return self.likelihood
+        if name == 'mapping' and self.mean_function is not None:
+            return self.mean_function
+        raise AttributeError(name)
+
+    def _mapping_params(self):
+        # (first, like in GPy's param_array)
+        if self.mean_function is None:
+            return []
+        return [MappingParam(p) for p in self.mean_function.flattened_parameters]
+
+    @property
+    def parameters(self):
+        return self._mapping_params() + self.kern.parameters + self.likelihood.parameters
+
+    @property
+    def param_array(self):
+        return np.concatenate([p.values for p in self.parameters])
+
+    @param_array.setter
+    def param_array(self, x):
+        i = 0
+        for p in self.parameters:
+            p[:] = x[i:i+len(p)]
+            i += len(p)
+
+    def parameter_names_flat(self):
+        mapping = [] if self.mean_function is None else list(self.mean_function.parameter_names_flat())
+        return mapping + self.kern.parameter_names_flat() + self.likelihood.parameter_names_flat()
+
+    def __getitem__(self, key):
+        return self.param_array[key]
+
+    def __setitem__(self, key, value):
+        x = self.param_array
+        x[key] = value
+        self.param_array = x
+
+    def _mean(self, X):
+        if self.mean_function is None:
+            return np.zeros((len(X), 1))
+        return self.mean_function.f(X)
+
+    def _update(self):
+        # (cached) posterior for the current parameters
+        key = self.param_array.tobytes()
+        if key == self._key:
+            return
+        K = self.kern.K(self.X)
+        K[np.diag_indices_from(K)] += self.likelihood.variance[0] + CONST_JITTER
+        L, _ = jitchol(K)
+        r = self.Y - self._mean(self.X)
+        alpha = cho_solve((L, True), r)
+        self._posterior = SimpleNamespace(woodbury_chol=L, woodbury_vector=alpha)
+        self._log_marginal_likelihood = (-0.5*(r*alpha).sum() - np.log(np.diag(L)).sum()
+                                         - 0.5*r.size*np.log(2*np.pi))
+        self._key = key
+
+    @property
+    def posterior(self):
+        # (like GPy's, up to date with the parameters)
+        self._update()
+        return self._posterior
+
+    def log_likelihood(self):
+        self._update()
+        return self._log_marginal_likelihood
+
+    def gradient(self):
+        # of the log marginal likelihood, wrt param_array
+        self._update()
+        L = self.posterior.woodbury_chol
+        alpha = self.posterior.woodbury_vector
+        Kinv = cho_solve((L, True), np.eye(len(L)))
+        dL_dK = 0.5*(alpha.dot(alpha.T) - Kinv)
+        dmapping = []
+        if self.mean_function is not None and self.mean_function.size:
+            # dL/dmean = alpha
+            self.mean_function.update_gradients(alpha, self.X)
+            dmapping = [np.asarray(self.mean_function.gradient).reshape(-1)]
+        return np.concatenate(dmapping + [self.kern.gradients_full(dL_dK, self.X), [np.trace(dL_dK)]])
+
+    # optimizer space (free parameters only)
+    def _free(self):
+        return np.concatenate([~np.full(len(p), p.fixed) for p in self.parameters])
+
+    @property
+    def optimizer_array(self):
+        return np.concatenate([p.to_opt() for p in self.parameters])[self._free()]
+
+    @optimizer_array.setter
+    def optimizer_array(self, t):
+        x = self.param_array
+        free = self._free()
+        tt = np.zeros(len(x))
+        tt[free] = t
+        i = 0
+        for p in self.parameters:
+            if not p.fixed:
+                x[i:i+len(p)] = p.from_opt(tt[i:i+len(p)])
+            i += len(p)
+        self.param_array = x
+
+    def objective_function(self):
+        return -self.log_likelihood()
+
+    def objective_function_gradients(self):
+        dopt = np.concatenate([p.dopt() for p in self.parameters])
+        return (-self.gradient() * dopt)[self._free()]
+
+    def _objective(self, t):
+        self.optimizer_array = t
+        try:
+            return self.objective_function(), self.objective_function_gradients()
+        except np.linalg.LinAlgError:
+            return np.inf, np.zeros(len(t))
+
+    def optimize(self, optimizer=None, messages=False, max_iters=1000, **kwargs):
+        if not self._free().any():
+            return
+        # (disp is deprecated in recent scipy, only passed when asked for)
+        options = dict(maxiter=max_iters, **({'disp': True} if messages else {}))
+        res = minimize(self._objective, self.optimizer_array, jac=True, method='L-BFGS-B', options=options)
+        self.optimizer_array = res.x
+
+    def randomize(self):
+        # like GPy: standard normal in optimizer space
+        self.optimizer_array = np.random.normal(0, 1, self._free().sum())
+
+    def optimize_restarts(self, num_restarts=10, verbose=True, robust=False, **kwargs):
+        best = None
+        for i in range(num_restarts):
+            try:
+                if i > 0:
+                    self.randomize()
+                self.optimize(**kwargs)
+                f = self.objective_function()
+                if verbose:
+                    print("Optimization restart {}/{}, f = {}".format(i+1, num_restarts, f))
+                if best is None or f < best[0]:
+                    best = (f, self.param_array)
+            except np.linalg.LinAlgError:
+                if not robust:
+                    raise
+                if verbose:
+                    print("Warning - optimization restart {}/{} failed".format(i+1, num_restarts))
+        if best is not None:
+            self.param_array = best[1]
+
+    def predict(self, Xnew, full_cov=False, include_likelihood=True):
+        self._update()
+        Kx = self.kern.K(self.X, Xnew)
+        mean = self._mean(Xnew) + Kx.T.dot(self.posterior.woodbury_vector)
+        V = solve_triangular(self.posterior.woodbury_chol, Kx, lower=True)
+        if full_cov:
+            var = self.kern.K(Xnew) - V.T.dot(V)
+            if include_likelihood:
+                var[np.diag_indices_from(var)] += self.likelihood.variance[0]
+        else:
+            var = (self.kern.Kdiag(Xnew) - (V**2).sum(0))[:,None]
+            if include_likelihood:
+                var = var + self.likelihood.variance[0]
+        return mean, var
+
+kern = SimpleNamespace(Matern52=Matern52, Add=Add, Prod=Prod)
+models = SimpleNamespace(GPRegression=GPRegression)
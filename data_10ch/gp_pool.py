@@ -0,0 +1,101 @@
+"""
+Runs the independent runs of run_ch_stats_exps on a process pool, each
+seeded from its own SeedSequence (see task_seeds), so the results don't
+depend on the number of workers.
+"""
+
+import os
+import numpy as np
+import multiprocessing as mp
+from contextlib import contextmanager
+from functools import partial
+from load_matlab import Trains
+
+BLAS_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+             'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def task_seeds(seed, n):
+    # n independent SeedSequences from seed (random if None). Also
+    # returns the entropy, which reproduces them when given as seed
+    ss = np.random.SeedSequence(seed)
+    return ss.entropy, ss.spawn(n)
+
+def seed_task(ss):
+    # Seeds the global RNG of the task (sa sampling, GPy's restarts...)
+    # and returns the seed for its ResponseSampler (both are children of
+    # ss, without changing ss, so a task can be run again)
+    glob, sampler = [np.random.SeedSequence(ss.entropy, spawn_key=ss.spawn_key + (i,)) for i in range(2)]
+    np.random.seed(glob.generate_state(1))
+    return sampler
+
+_shared = {}
+
+def _init_worker(shared):
+    _shared.clear()
+    _shared.update(shared)
+
+def shared(name):
+    # object given to map_tasks in shared
+    return _shared[name]
+
+@contextmanager
+def blas_threads_env(n):
+    # Environment of processes started in this block: BLAS with n threads
+    old = {v: os.environ.get(v) for v in BLAS_VARS}
+    os.environ.update({v: str(n) for v in BLAS_VARS})
+    try:
+        yield
+    finally:
+        for v,val in old.items():
+            if val is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = val
+
+@contextmanager
+def shared_copies(shared):
+    # shared, with its Trains replaced by copies in shared memory (see
+    # Trains.shared_copy), whose segments are freed on exit. The Trains
+    # of the caller are left as they are
+    copies = {k: obj.shared_copy() for k,obj in shared.items() if isinstance(obj, Trains)}
+    try:
+        yield dict(shared, **copies)
+    finally:
+        for k,obj in copies.items():
+            if obj is not shared[k]:
+                obj.unlink_shared()
+
+def _call_indexed(fn, itask):
+    i,task = itask
+    return i, fn(task)
+
+def as_completed(fn, tasks, workers=1, blas_threads=1, shared=None):
+    # Yields (i, fn(tasks[i])) for every task, as soon as it is done (in
+    # any order with workers > 1). fn must be a module level function
+    # (it is pickled), and so must be the tasks and shared. shared (eg.
+    # the Trains, in shared memory) is sent once per worker, and tasks
+    # get it back with shared(name). Each worker's BLAS has blas_threads
+    # threads (workers*blas_threads should not exceed the cores)
+    shared = shared or {}
+    if workers <= 1:
+        for i,task in enumerate(tasks):
+            # (again for every task, in case fn runs tasks itself)
+            _init_worker(shared)
+            yield i, fn(task)
+        return
+    with shared_copies(shared) as shared:
+        with blas_threads_env(blas_threads):
+            pool = mp.get_context('spawn').Pool(workers, initializer=_init_worker, initargs=(shared,))
+        with pool:
+            for res in pool.imap_unordered(partial(_call_indexed, fn), enumerate(tasks)):
+                yield res
+
+def map_tasks(fn, tasks, workers=1, blas_threads=1, shared=None):
+    # Yields fn(task) for every task, in order
+    done = {}
+    nxt = 0
+    for i,res in as_completed(fn, tasks, workers, blas_threads, shared):
+        done[i] = res
+        while nxt in done:
+            yield done.pop(nxt)
+            nxt += 1
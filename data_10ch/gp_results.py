@@ -0,0 +1,180 @@
+"""
+HDF5 results of run_ch_stats_exps: one chunked dataset per array, one
+chunk and a 'done' flag per run, written as the runs complete (and
+appended to on relaunch). load_results reads them back like the old
+pickled dict.
+"""
+
+import os
+import json
+import numpy as np
+import h5py
+from load_matlab import CHS
+
+# dtype on disk of each array (others are float32)
+DTYPES = {
+    'queriedchs': np.int8,
+    'maxchs': np.int8,
+    'rounds': np.int16,
+    'nrefits': np.int16,
+}
+# arrays of channels (stored as indices)
+CH_ARRAYS = ('queriedchs', 'maxchs')
+# number of leading axes that index the runs
+RUN_AXES = 3
+
+def _index_table(values):
+    # value -> index lookup table (-1 for everything else)
+    table = np.full(max(values)+1, -1, dtype=np.int8)
+    table[list(values)] = np.arange(len(values))
+    return table
+
+def encode_chs(a, dts=None):
+    # channels (and, if dts, dts in the last column) -> int8 indices
+    a = np.asarray(a).astype(int)
+    idx = _index_table(CHS)[np.clip(a, 0, max(CHS))]
+    if dts is not None:
+        idx[...,-1] = _index_table(dts)[np.clip(a[...,-1], 0, max(dts))]
+    return idx
+
+def decode_chs(idx, dts=None):
+    # inverse of encode_chs (-1 -> 0)
+    idx = np.asarray(idx)
+    a = np.where(idx < 0, 0, np.array(CHS)[idx])
+    if dts is not None:
+        a[...,-1] = np.where(idx[...,-1] < 0, 0, np.array(dts)[idx[...,-1]])
+    return a.astype(float)
+
+def _to_json(v):
+    if isinstance(v, (range, tuple)):
+        return list(v)
+    if isinstance(v, np.ndarray):
+        return v.tolist()
+    if isinstance(v, np.generic):
+        return v.item()
+    raise TypeError("can't store {} in the attributes".format(type(v)))
+
+class ResultsStore:
+    """HDF5 copy of the result arrays of run_ch_stats_exps (all of shape
+    runs + per run shape, with runs = the first RUN_AXES axes)."""
+
+    def __init__(self, filename, arrays, dts=None, config=None):
+        # arrays: name -> array (the in memory results, which write
+        # copies). dts: the dts of dt2d experiments (last column of the
+        # channel arrays). config: the arguments of the experiment. If
+        # filename exists (an interrupted launch of the same experiment,
+        # checked with config), its done runs are read back into arrays
+        # (or, if it can't be read, it is moved aside)
+        self.filename = filename
+        self.arrays = arrays
+        self.dts = dts
+        runs = next(iter(arrays.values())).shape[:RUN_AXES]
+        try:
+            self._open(config, runs)
+        except (OSError, KeyError) as e:
+            # eg. the job was killed during a write. We start over: the
+            # runs of the TaskStore are written again (see run_tasks),
+            # and the others (lockstep) are run again
+            print("Can't read {} ({}), moved to {}.bad".format(filename, e, filename))
+            if self.f is not None:
+                self.f.close()
+            os.replace(filename, filename + '.bad')
+            self._open(config, runs)
+
+    def _open(self, config, runs):
+        # opens (or creates) the file, and reads its done runs back
+        self.f = None
+        self.f = h5py.File(self.filename, 'a')
+        meta = {'config': config, 'dts': self.dts}
+        for k,v in meta.items():
+            if v is None:
+                continue
+            v = json.dumps(v, default=_to_json, sort_keys=True)
+            if k in self.f.attrs:
+                assert self.f.attrs[k] == v, "{} holds the results of another experiment (use another uid): {}".format(self.filename, self.f.attrs[k])
+            self.f.attrs[k] = v
+        for name,a in self.arrays.items():
+            dtype = DTYPES.get(name, np.float32)
+            if name in self.f:
+                ds = self.f[name]
+                assert ds.shape == a.shape and ds.dtype == dtype, "{} has another {} ({} {})".format(self.filename, name, ds.shape, ds.dtype)
+                continue
+            fill = -1 if name in CH_ARRAYS else 0
+            if a.ndim > RUN_AXES:
+                chunks = (1,)*RUN_AXES + a.shape[RUN_AXES:]
+                ds = self.f.create_dataset(name, shape=a.shape, dtype=dtype, chunks=chunks, compression='gzip', shuffle=True, fillvalue=fill)
+            else:
+                ds = self.f.create_dataset(name, shape=a.shape, dtype=dtype, fillvalue=fill)
+            if name in CH_ARRAYS:
+                ds.attrs['encoding'] = 'chs+dt' if self.dts is not None else 'chs'
+        if 'done' not in self.f:
+            self.f.create_dataset('done', shape=runs, dtype=bool)
+        done = self.f['done'][()]
+        if done.any():
+            print("Resuming from {}: {} of {} runs already done".format(self.filename, done.sum(), done.size))
+            # (all read before any is copied, in case one can't be)
+            vals = {name: self.f[name][()] for name in self.arrays}
+            for name,a in self.arrays.items():
+                v = vals[name]
+                if name in CH_ARRAYS:
+                    v = decode_chs(v, self.dts)
+                a[done] = v[done]
+        self.f.flush()
+
+    def done(self, key):
+        # whether the run(s) key are all done
+        return bool(np.all(self.f['done'][key]))
+
+    def write(self, key):
+        # writes the run(s) key (eg. (j,r,i), or (j,slice(None),i)) of
+        # every array and marks them done
+        for name,a in self.arrays.items():
+            if name in CH_ARRAYS:
+                self.f[name][key] = encode_chs(a[key], self.dts)
+            else:
+                self.f[name][key] = a[key]
+        self.f['done'][key] = True
+        self.f.flush()
+
+    def close(self, dct=None):
+        # Saves the other entries of the results dict dct (arrays as
+        # datasets, the rest as attributes) and closes the file
+        for k,v in (dct or {}).items():
+            if k in self.arrays:
+                continue
+            if isinstance(v, np.ndarray) and v.ndim > 0:
+                if k in self.f:
+                    del self.f[k]
+                self.f.create_dataset(k, data=v)
+            else:
+                self.f.attrs[k] = json.dumps(v, default=_to_json)
+        self.f.close()
+
+def results_done(filename):
+    # whether filename holds the complete results of an experiment (all
+    # runs done, and closed with the results dict)
+    try:
+        with h5py.File(filename, 'r') as f:
+            return 'ntotal' in f.attrs and bool(f['done'][()].all())
+    except (OSError, KeyError):
+        return False
+
+def load_results(filename, names=None, runs=()):
+    # Reads a ResultsStore file back into a dict like the one of
+    # run_ch_stats_exps: the attributes, and the datasets in names
+    # (default: all of them), only for the runs selected by runs (an
+    # index of the run axes, eg. (0, slice(None), 2) for all repeats of
+    # model 0 with the 3rd nrnd; default: all)
+    dct = {}
+    with h5py.File(filename, 'r') as f:
+        dts = json.loads(f.attrs['dts']) if 'dts' in f.attrs else None
+        for k,v in f.attrs.items():
+            dct[k] = json.loads(v)
+        for name in (f.keys() if names is None else names):
+            ds = f[name]
+            a = ds[runs] if ds.ndim >= RUN_AXES else ds[()]
+            encoding = ds.attrs.get('encoding')
+            if encoding is not None:
+                a = decode_chs(a, dts if encoding == 'chs+dt' else None)
+            dct[name] = a
+    return dct
@@ -0,0 +1,100 @@
+"""
+Compact records of the models of a sequential run: SeqModels keeps the
+data once and the hyperparameters (and grid posterior) of every step,
+and rebuilds the GPy model of a step on demand.
+"""
+
+import numpy as np
+from collections.abc import Sequence
+from gp_grid import grid_predict
+
+class SeqModels(Sequence):
+    # build(X, Y, params, tag) must return the GPy model of a step. tag
+    # is whatever was given to append (eg. the kernel type, if it changes
+    # between steps)
+    def __init__(self, build, grid=None):
+        self.build = build
+        self.grid = grid
+        self.X = None
+        self.Y = None
+        self.n = []
+        self.params = []
+        self.tags = []
+        self.means = []
+        self.vars = []
+
+    def append(self, m, tag=None):
+        # Records the current model of the run
+        self.X = np.array(m.X)
+        self.Y = np.array(m.Y)
+        self.n.append(len(self.X))
+        params = np.array(m.param_array)
+        if self.params and np.array_equal(self.params[-1], params):
+            # fixed hyperparameters, share the array
+            params = self.params[-1]
+        self.params.append(params)
+        self.tags.append(tag)
+        if self.grid is not None:
+            mean,var = grid_predict(m, self.grid)
+            self.means.append(mean)
+            self.vars.append(var)
+
+    def __len__(self):
+        return len(self.n)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("step {} out of range".format(i))
+        return StepModel(self, i)
+
+    @property
+    def queries(self):
+        # inputs and responses, in the order they were queried
+        return self.X, self.Y
+
+class StepModel:
+    # Model of step i of a SeqModels
+    def __init__(self, seq, i):
+        self.seq = seq
+        self.i = i
+        self._model = None
+
+    @property
+    def X(self):
+        return self.seq.X[:self.seq.n[self.i]]
+
+    @property
+    def Y(self):
+        return self.seq.Y[:self.seq.n[self.i]]
+
+    @property
+    def param_array(self):
+        return self.seq.params[self.i]
+
+    @property
+    def model(self):
+        # The GPy model of this step, rebuilt (once) from the record
+        if self._model is None:
+            self._model = self.seq.build(self.X, self.Y, self.param_array, self.seq.tags[self.i])
+        return self._model
+
+    def stored_predict(self, grid):
+        # posterior on grid, if it was recorded (else None)
+        if grid is self.seq.grid and self.seq.means:
+            return self.seq.means[self.i], self.seq.vars[self.i]
+        return None
+
+    def predict(self, Xnew, **kwargs):
+        pred = None if kwargs else self.stored_predict(Xnew)
+        if pred is None:
+            pred = self.model.predict(Xnew, **kwargs)
+        return pred
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name in ('seq', 'i'):
+            raise AttributeError(name)
+        return getattr(self.model, name)
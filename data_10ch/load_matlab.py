@@ -7,6 +7,11 @@ import matplotlib.gridspec as gridspec
 import random
 import itertools
 import os
+import json
+import weakref
+from collections.abc import Mapping
+from functools import partial
+from multiprocessing import shared_memory
 
 """
 # TODO #
@@ -43,13 +48,84 @@ for ch in CHS:
 DTS = [0, 10, 20, 40, 60, 80, 100]
 EMG = 4
 N_EMGS = 7
+# Dense arrays saved in the FilteredPairedTrains.cache/ directory
+# (bump CACHE_VERSION whenever the way they are built changes)
+CACHE_FIELDS = ('resps', 'valid', 'trialmaxs')
+CACHE_VERSION = 1
+# Arrays put in shared memory by Trains.shared_copy (with the features)
+SHARED_FIELDS = ('resps', 'valid', 'trialmaxs', 'ntrials', 'maxs', 'meanmax', 'stdmax')
+# window used for the 'rms' feature (same as in samplecode_pairedburstpilot.m)
+RMS_WINDOW = 100
+RMS_OVERLAP = 50
+
+def windowed_rms(signal, windowlength, overlap, zeropad=False):
+    # Same as rms.m, but for the last axis of an array of signals
+    n = signal.shape[-1]
+    delta = windowlength - overlap
+    indices = np.arange(0, n, delta)
+    if n - indices[-1] < windowlength:
+        if zeropad:
+            pad = [(0,0)]*(signal.ndim-1) + [(0, indices[-1]+windowlength-n)]
+            signal = np.pad(signal, pad)
+        else:
+            indices = indices[indices+windowlength <= n]
+    # window means of signal**2 from a cumsum
+    cumsq = np.cumsum(signal.astype(float)**2, axis=-1)
+    cumsq = np.concatenate((np.zeros(signal.shape[:-1]+(1,)), cumsq), axis=-1)
+    return np.sqrt((cumsq[...,indices+windowlength] - cumsq[...,indices]) / windowlength)
+
+# Per trial scalar features of the responses. Each takes an array of
+# timeseries (..., ticks), which last 300ms, and reduces the last axis.
+# New features can be added to this dict.
+FEATURES = {
+    'max': lambda resps: resps.max(axis=-1),
+    # max of the windowed rms
+    'rms': lambda resps: windowed_rms(resps, RMS_WINDOW, RMS_OVERLAP).max(axis=-1),
+    # area under the curve (in V.ms)
+    'auc': lambda resps: (resps[...,1:] + resps[...,:-1]).sum(axis=-1) / 2 * 300/resps.shape[-1],
+    # time of the peak (in ms)
+    'latency': lambda resps: resps.argmax(axis=-1) * 300/resps.shape[-1],
+}
+
+class TrainsView(Mapping):
+    """Read-only nested-dict view on the dense store of a Trains object.
+
+    trainsC.emgdct[emg][ch1][ch2][dt][field] walks down the levels
+    (emg, ch1, ch2, dt, field) and only indexes into the dense arrays
+    when a field is asked for, so no per-cell python objects are kept.
+    Fields are 'data', 'maxs', 'meanmax' and 'stdmax'.
+    """
+    FIELDS = ('data', 'maxs', 'meanmax', 'stdmax')
+
+    def __init__(self, trainsC, idx=()):
+        self._trainsC = trainsC
+        self._idx = idx
+
+    def _keys(self):
+        t = self._trainsC
+        return [range(t.N_EMGS), t.chs, t.chs, t.dts, self.FIELDS][len(self._idx)]
+
+    def __getitem__(self, key):
+        keys = list(self._keys())
+        if key not in keys:
+            raise KeyError(key)
+        if len(self._idx) == 4:
+            return self._trainsC._get_field(*self._idx, key)
+        return TrainsView(self._trainsC, self._idx + (keys.index(key),))
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
 
 class Trains:
 
-    def __init__(self, emg = EMG, N_EMGS = N_EMGS, path_to_data=None, clean_thresh=None, verbose=True):
-        self.chs = CHS
-        self.n_ch = len(self.chs)
-        self.dts = DTS
+    def __init__(self, emg = EMG, N_EMGS = N_EMGS, path_to_data=None, clean_thresh=None, verbose=True, cache=True, preload=None):
+        # to rebuild it elsewhere (see __reduce__)
+        self._init_args = dict(emg=emg, N_EMGS=N_EMGS, path_to_data=path_to_data, clean_thresh=clean_thresh,
+                               verbose=False, cache=cache, preload=preload)
+        self._init_consts(N_EMGS)
 
         # conditions are
         # 0 : seulement channel A
@@ -64,109 +140,354 @@ class Trains:
         # each cell contains a 20x733 matrix (20 stimulations, 733 time series
         # emg response)
         if path_to_data:
-            filtmat = loadmat(os.path.join(path_to_data, 'FilteredPairedTrains.mat'))
+            matpath = os.path.join(path_to_data, 'FilteredPairedTrains.mat')
         else:
-            filtmat = loadmat('FilteredPairedTrains.mat')
-        filtdata = filtmat['gfilt_resp']
+            matpath = 'FilteredPairedTrains.mat'
 
         # Let's build a proper datastructure
-        # trains[chi][chj][deltat] will contain all timeseries for pair chi, chj
-        # with time delay delta_t
-        # trains[ch_i][ch_i] will contain single channel pulses
+        # All timeseries live in one dense array
+        # self.resps[emg,i,j,k] (padded to the max # of trials), where
+        # i,j index self.chs and k indexes self.dts.
+        # self.valid[emg,i,j,k] flags the trials which are real data
+        # (cells can be ragged, or empty for ch1==ch2 with dt=10,20)
+        # The old dict API trains[ch1][ch2][dt]['data'] is kept as a
+        # view on top of these arrays (see TrainsView)
+        # Parsing the .mat file is slow, so the dense arrays are cached
+        # next to it (see _save_cache) and memory-mapped on later runs
+        # EMGs are loaded lazily: an emg's slice of the arrays is only
+        # filled in (and its maxs/meanmax/stdmax computed) the first
+        # time it is accessed, unless it is in preload
+        self._cells = None
+        if not (cache and self._load_cache(matpath, verbose=verbose)):
+            filtdata = loadmat(matpath)['gfilt_resp']
+            self._build_store(filtdata)
+            if cache:
+                self._save_cache(matpath, verbose=verbose)
+        self._init_stats()
+        self.emgdct = TrainsView(self)
+
+        self.clean_report = None
+        if clean_thresh:
+            self.clean_report = self.clean(clean_thresh, verbose=verbose)
+        for emg_ in (preload or []):
+            self.load_emg(emg_)
+        self.trains = self.emgdct[emg]
+
+    def _init_consts(self, N_EMGS):
+        self.chs = CHS
+        self.n_ch = len(self.chs)
+        self.dts = DTS
+        self.chidx = {ch:i for i,ch in enumerate(self.chs)}
+        self.dtidx = {dt:k for k,dt in enumerate(self.dts)}
         self.N_EMGS = N_EMGS
-        self.emgdct = {}
-        for emg in range(N_EMGS):
-            # Pairs
-            dct = {ch1:{ch2:{} for ch2 in self.chs} for ch1 in self.chs}
-            for i,ch1 in enumerate(self.chs):
-                for j,ch2 in enumerate(self.chs):
+        # raw per trial features (see FEATURES), filled per emg
+        self._features = {}
+        self._features_done = {}
+        # names of the shared memory segments, and what frees them (see
+        # shared_copy)
+        self._shm_spec = None
+        self._unlink = None
+
+    def __reduce__(self):
+        # Pickled as its constructor arguments, not its data: unpickling
+        # reloads it from the cache (memory-mapped) or the .mat file, eg.
+        # in the workers of gp_pool. Changes made after __init__ (other
+        # than lazy loading) are not kept. A shared copy (see
+        # shared_copy) is pickled as the names of its segments instead
+        if self._shm_spec is not None:
+            return (attach_trains, (self._shm_spec, self._init_args, self.clean_report))
+        return (partial(Trains, **self._init_args), ())
+
+    def shared_copy(self, features=()):
+        # A copy of this Trains with its dense arrays (SHARED_FIELDS, and
+        # the per trial features in features) in shared memory segments,
+        # for the workers of a process pool. Pickling the copy only sends
+        # the names of the segments, and unpickling attaches (read only)
+        # views of them (see attach_trains): the workers start in
+        # milliseconds, and the node holds one copy of the data however
+        # many workers there are. All emgs are loaded first, and this
+        # Trains is left as it is. The segments are freed by
+        # unlink_shared (or with the copy, or at exit). A Trains that is
+        # already shared is its own copy
+        if self._shm_spec is not None:
+            assert set(features) <= set(self._features_done), "can't share more features of a shared Trains"
+            return self
+        for emg in range(self.N_EMGS):
+            self.load_emg(emg)
+            for f in features:
+                self.feature(f, emg)
+        arrays = {name: getattr(self, name) for name in SHARED_FIELDS}
+        arrays.update({'feature:' + f: self._features[f] for f in features if f != 'max'})
+        spec, shms = {}, []
+        for name,a in arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[...] = a
+            spec[name] = (shm.name, a.shape, a.dtype.str)
+            shms.append(shm)
+        trainsC = attach_trains(spec, self._init_args, self.clean_report)
+        trainsC._unlink = weakref.finalize(trainsC, _unlink_shms, shms)
+        return trainsC
+
+    def unlink_shared(self):
+        # Frees the segments of a copy made by shared_copy (its arrays
+        # can't be used anymore)
+        if self._unlink is not None:
+            self._unlink()
+
+    def _set_array(self, name, a):
+        if name.startswith('feature:'):
+            f = name[len('feature:'):]
+            self._features[f] = a
+            self._features_done[f] = np.ones(self.N_EMGS, dtype=bool)
+        else:
+            setattr(self, name, a)
+
+    def clean(self, thresh, verbose=True):
+        # We remove all resps whose max is > thresh. A trial is removed
+        # for all emgs at the same time, so cleaning needs the maxs of
+        # every emg. Returns a report with the # of removed trials per
+        # cell ('removed', indexed like self.meanmax[emg]) and per emg
+        # whose max was above thresh ('removed_emg')
+        assert self._shm_spec is None, "can't clean a shared Trains (clean before shared_copy)"
+        for emg in range(self.N_EMGS):
+            self._decode_emg(emg)
+        over = self.valid & (self.trialmaxs > thresh)
+        bad = over.any(axis=0)
+        self.valid &= ~bad
+        self._init_stats()
+        # (ch1,ch2) and (ch2,ch1) are the same data for dt=0, so we
+        # only count those trials once
+        unique = np.ones(bad.shape[:-1], dtype=bool)
+        unique[:,:,0] = np.triu(unique[:,:,0])
+        report = {
+            'thresh': thresh,
+            'removed': bad.sum(axis=-1),
+            'removed_emg': (over & unique[...,None]).sum(axis=(1,2,3,4)),
+            'total': int((bad & unique[...,None]).sum())
+        }
+        if verbose:
+            for emg,n in enumerate(report['removed_emg']):
+                print("emg {}: {} resps with max > {}".format(emg, n, thresh))
+            print("Removed {} resps in total from dataset".format(report['total']))
+        return report
+
+    def _build_store(self, filtdata):
+        # Only picks the cells for every (emg,i,j,k) and allocates the
+        # dense arrays. The data itself is copied by _decode_emg.
+        # np.zeros doesn't touch the memory, so emgs that are never
+        # decoded don't use any.
+        n_dts = len(self.dts)
+        cells = np.empty((self.N_EMGS, self.n_ch, self.n_ch, n_dts), dtype=object)
+        for emg in range(self.N_EMGS):
+            for i in range(self.n_ch):
+                for j in range(self.n_ch):
                     # We deal with dt=0 separately, since it should be
                     # symmetric! (ch1,ch2 = ch2,ch1 since stimulations
                     # are done simultaneously (dt=0))
-                    if i == j:
-                        dct[ch1][ch1][0] = {'data': filtdata[emg,i,j,0]}
-                    else:
-                        data = filtdata[emg,i,j,0]
-                        if data.size == 0:
-                            data = filtdata[emg,j,i,0]
-                        dct[ch1][ch2][0] = dct[ch2][ch1][0] = {'data': data}
-                    ch = dct[ch1][ch2][0]['data']
-                    maxs = ch.max(axis=1)
-                    dct[ch1][ch2][0]['maxs'] = dct[ch2][ch1][0]['maxs'] = maxs
-                    dct[ch1][ch2][0]['meanmax'] = dct[ch2][ch1][0]['meanmax'] = maxs.mean()
-                    dct[ch1][ch2][0]['stdmax'] = dct[ch2][ch1][0]['stdmax'] = maxs.std()
+                    data = filtdata[emg,max(i,j),min(i,j),0]
+                    if data.size == 0:
+                        data = filtdata[emg,min(i,j),max(i,j),0]
+                    cells[emg,i,j,0] = data
                     # Then we deal with dt!=0
-                    for k,dt in enumerate(self.dts[1:],1):
-                        dct[ch1][ch2][dt] = {'data': filtdata[emg,i,j,k]}
-                        # We also precompute the meanmax and stdmax
-                        # statistics
-                        ch = dct[ch1][ch2][dt]['data']
-                        if ch.size != 0:
-                            maxs = ch.max(axis=1)
-                            dct[ch1][ch2][dt]['maxs'] = maxs
-                            dct[ch1][ch2][dt]['meanmax'] = maxs.mean()
-                            dct[ch1][ch2][dt]['stdmax'] = maxs.std()
-            self.emgdct[emg] = dct
-
-        if clean_thresh:
-            # we remove all resps whose max is > clean_thresh
-            count=0
-            for emg in range(N_EMGS):
-                for ch1 in self.chs:
-                    for ch2 in self.chs:
-                        for dt in self.dts:
-                            if (dt==10 or dt==20) and ch1==ch2:
-                                continue
-                            maxs = self.emgdct[emg][ch1][ch2][dt]['maxs']
-                            i=0
-                            while i<len(maxs):
-                                if maxs[i] > clean_thresh:
-                                    if verbose:
-                                        print("Removing resp with max {}".format(maxs[i]))
-                                        print("emg {}, ch1 {}, ch2 {}, dt {}".format(emg,ch1,ch2,dt))
-                                    count+=1
-                                    for other_emg in range(N_EMGS):
-                                        data = self.emgdct[other_emg][ch1][ch2][dt]['data']
-                                        data = np.delete(data,i,0)
-                                        self.emgdct[other_emg][ch1][ch2][dt]['data'] = data
-                                        maxs = data.max(axis=1)
-                                        self.emgdct[other_emg][ch1][ch2][dt]['maxs']  = maxs
-                                        self.emgdct[other_emg][ch1][ch2][dt]['meanmax'] = maxs.mean()
-                                        self.emgdct[other_emg][ch1][ch2][dt]['stdmax'] = maxs.std()
-                                i+=1
+                    for k in range(1,n_dts):
+                        cells[emg,i,j,k] = filtdata[emg,i,j,k]
+        nonempty = [data for data in cells.flat if data.size != 0]
+        n_trials = max(data.shape[0] for data in nonempty)
+        n_ticks = max(data.shape[1] for data in nonempty)
+        dtype = np.result_type(*nonempty)
+        self.resps = np.zeros(cells.shape + (n_trials, n_ticks), dtype=dtype)
+        self.valid = np.zeros(cells.shape + (n_trials,), dtype=bool)
+        # per trial maxs of all (also invalid) trials. We keep these
+        # around so that cleaning never has to touch self.resps again
+        self.trialmaxs = np.zeros(cells.shape + (n_trials,), dtype=dtype)
+        self._cells = cells
+        self._decoded = np.zeros(self.N_EMGS, dtype=bool)
+
+    def _decode_emg(self, emg):
+        # copies the .mat cells of emg into the dense arrays (nothing
+        # to do if they were memory-mapped from the cache)
+        if self._cells is None or self._decoded[emg]:
+            return
+        for idx,data in np.ndenumerate(self._cells[emg]):
+            if data.size != 0:
+                self.resps[emg][idx][:data.shape[0],:data.shape[1]] = data
+                self.valid[emg][idx][:data.shape[0]] = True
+        self.trialmaxs[emg] = self.resps[emg].max(axis=-1)
+        self._decoded[emg] = True
+        if self._decoded.all():
+            # we don't need the loadmat output anymore
+            self._cells = None
+
+    def _cache_files(self, matpath):
+        cachedir = os.path.splitext(matpath)[0] + '.cache'
+        files = {name: os.path.join(cachedir, name + '.npy') for name in CACHE_FIELDS}
+        return cachedir, os.path.join(cachedir, 'index.json'), files
+
+    def _cache_index(self, matpath):
+        st = os.stat(matpath)
+        return {'version': CACHE_VERSION, 'source': os.path.basename(matpath),
+                'mtime_ns': st.st_mtime_ns, 'size': st.st_size, 'N_EMGS': self.N_EMGS,
+                'chs': list(self.chs), 'dts': list(self.dts)}
+
+    def _load_cache(self, matpath, verbose=True):
+        # Returns True if a cache matching the current .mat file (same
+        # mtime and size) was found. self.resps and self.trialmaxs are
+        # opened with mmap_mode='r': they are read only, and shared (in
+        # the page cache) between all jobs running on the same node
+        cachedir, indexpath, files = self._cache_files(matpath)
+        try:
+            with open(indexpath) as f:
+                index = json.load(f)
+            if {k: index.get(k) for k in self._cache_index(matpath)} != self._cache_index(matpath):
+                return False
+            arrays = {name: np.load(files[name], mmap_mode='r') for name in CACHE_FIELDS}
+        except (OSError, ValueError):
+            return False
+        self.resps = arrays['resps']
+        self.trialmaxs = arrays['trialmaxs']
+        # valid is modified by clean_thresh so we need our own copy
+        self.valid = np.array(arrays['valid'])
+        if verbose:
+            print("Loaded trains from cache {}".format(cachedir))
+        return True
+
+    def _save_cache(self, matpath, verbose=True):
+        # Every file is written under a tmp name and then renamed, so
+        # that concurrent jobs never see a half written cache. The
+        # index is written last, since it is what validates the cache
+        cachedir, indexpath, files = self._cache_files(matpath)
+        for emg in range(self.N_EMGS):
+            self._decode_emg(emg)
+        try:
+            os.makedirs(cachedir, exist_ok=True)
+            for name in CACHE_FIELDS:
+                tmppath = '{}.{}.tmp'.format(files[name], os.getpid())
+                with open(tmppath, 'wb') as f:
+                    np.save(f, getattr(self, name))
+                os.replace(tmppath, files[name])
+            tmppath = '{}.{}.tmp'.format(indexpath, os.getpid())
+            with open(tmppath, 'w') as f:
+                json.dump(self._cache_index(matpath), f)
+            os.replace(tmppath, indexpath)
+        except OSError as e:
             if verbose:
-                print("Removed {} resps in total from dataset".format(count))
-        self.trains = self.emgdct[emg]
+                print("Could not write trains cache to {}: {}".format(cachedir, e))
+            return
+        if verbose:
+            print("Saved trains cache to {}".format(cachedir))
+
+    def _init_stats(self):
+        # Statistics are (re)computed per emg by load_emg
+        self._loaded = np.zeros(self.N_EMGS, dtype=bool)
+        # feature cubes depend on valid, so they are also reset
+        self._cubes = {}
+        self.ntrials = np.zeros(self.valid.shape[:-1], dtype=int)
+        self.maxs = np.full(self.valid.shape, np.nan)
+        self.meanmax = np.full(self.valid.shape[:-1], np.nan)
+        self.stdmax = np.full(self.valid.shape[:-1], np.nan)
+
+    def load_emg(self, emg):
+        # Makes sure the data of emg is in the dense arrays, and
+        # computes the per trial maxs, and the meanmax and stdmax
+        # statistics for all of its cells at once. Invalid trials are nan.
+        if self._loaded[emg]:
+            return
+        self._decode_emg(emg)
+        valid = self.valid[emg]
+        self.ntrials[emg] = valid.sum(axis=-1)
+        self.maxs[emg] = np.where(valid, self.trialmaxs[emg], np.nan)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            # empty cells get nan statistics
+            self.meanmax[emg] = np.where(valid, self.maxs[emg], 0).sum(axis=-1) / self.ntrials[emg]
+            centered = np.where(valid, self.maxs[emg] - self.meanmax[emg][...,None], 0)
+            self.stdmax[emg] = np.sqrt((centered**2).sum(axis=-1) / self.ntrials[emg])
+        self._loaded[emg] = True
+
+    def _cell_idx(self, emg, ch1, ch2, dt):
+        return emg, self.chidx[ch1], self.chidx[ch2], self.dtidx[dt]
+
+    def _get_field(self, emg, i, j, k, field):
+        self.load_emg(emg)
+        valid = self.valid[emg,i,j,k]
+        if field == 'data':
+            # empty cells are (0,ticks), whether they are empty in the
+            # .mat file or were emptied by clean
+            return self.resps[emg,i,j,k][valid]
+        elif field == 'maxs':
+            return self.maxs[emg,i,j,k][valid]
+        elif field == 'meanmax':
+            return self.meanmax[emg,i,j,k]
+        elif field == 'stdmax':
+            return self.stdmax[emg,i,j,k]
+        raise KeyError(field)
+
+    def get_trials(self, emg, ch1, ch2, dt):
+        # all (valid) timeseries for pair ch1,ch2 with time delay dt
+        return self._get_field(*self._cell_idx(emg,ch1,ch2,dt), 'data')
+
+    def feature(self, f, emg):
+        # Per trial feature f (a key of FEATURES) of all trials of emg,
+        # as an array [i,j,k,trial]. It is computed once per emg, and
+        # is garbage for invalid trials (see feature_cube)
+        if f == 'max':
+            self.load_emg(emg)
+            return self.trialmaxs[emg]
+        if f not in self._features:
+            self._features[f] = np.zeros(self.valid.shape)
+            self._features_done[f] = np.zeros(self.N_EMGS, dtype=bool)
+        if not self._features_done[f][emg]:
+            self.load_emg(emg)
+            # one dt at a time, to keep temporaries small
+            for k in range(len(self.dts)):
+                self._features[f][emg,:,:,k] = FEATURES[f](self.resps[emg,:,:,k])
+            self._features_done[f][emg] = True
+        return self._features[f][emg]
+
+    def feature_cube(self, emg=None, syn=None, f='max', filldiag=True):
+        # Per trial values of the objective f for all cells, as an array
+        # [i,j,k,trial] (i,j index self.chs, k self.dts) with nan for
+        # invalid trials. syn=(emg1,emg2) uses the synergy instead (only
+        # for f='max'). If filldiag, the empty diag cells of dt=10,20
+        # get the dt=0 values, like in synergy.
+        if syn is not None:
+            emg1,emg2 = syn
+            if emg2 is not None:
+                assert f == 'max', "synergies can only use f='max'"
+                key = ('syn', emg1, emg2, filldiag)
+                if key not in self._cubes:
+                    self._cubes[key] = self.synergy_maxs(emg1, emg2, filldiag=filldiag)
+                return self._cubes[key]
+            emg = emg1
+        key = (f, emg, filldiag)
+        if key not in self._cubes:
+            cube = np.where(self.valid[emg], self.feature(f, emg), np.nan)
+            if filldiag:
+                diag = np.arange(self.n_ch)
+                for dt in (10,20):
+                    cube[diag,diag,self.dtidx[dt]] = cube[diag,diag,0]
+            self._cubes[key] = cube
+        return self._cubes[key]
+
+    def cell_feature(self, ch1, ch2, dt, emg=None, syn=None, f='max', filldiag=True):
+        # Values of the objective for all trials of one cell. Same as
+        # get_resp(emg,dt,ch1,ch2).max(axis=1) for f='max', but read
+        # from the precomputed feature cube
+        vals = self.feature_cube(emg=emg, syn=syn, f=f, filldiag=filldiag)[self.chidx[ch1],self.chidx[ch2],self.dtidx[dt]]
+        return vals[~np.isnan(vals)]
 
     ######### GETTERS ############
     def get_emgdct(self, emg):
         return self.emgdct[emg]
 
     def build_f_grid_dt(self, emg=2, syn=None, dts=[40,60], f='meanmax'):
+        #TODO: now with synergies we can only do f='meanmax'
+        #      maybe change this later if needed
         if syn is None:
             syn = (emg, None)
-        z_grid = np.zeros((self.n_ch,self.n_ch,len(dts)))
-        for i,ch1 in enumerate(self.chs):
-            for j,ch2 in enumerate(self.chs):
-                for k,dt in enumerate(dts):
-                    #TODO: now with synergies we can only do f='meanmax'
-                    #      maybe change this later if needed
-                    z_grid[i][j][k] = self.synergy_meanmax(*syn,ch1,ch2,dt)
-                #self.emgdct[emg][ch1][ch2][dt][f]
-        return z_grid
-
+        return self.synergy_meanmax_grid(*syn, dts=dts)
 
     def build_f_grid(self, emg=2, syn=None, dt=40, f='meanmax'):
-        if syn is None:
-            syn = (emg, None)
-        z_grid = np.zeros((self.n_ch,self.n_ch))
-        for i,ch1 in enumerate(self.chs):
-            for j,ch2 in enumerate(self.chs):
-                #TODO: now with synergies we can only do f='meanmax'
-                #      maybe change this later if needed
-                z_grid[i][j] = self.synergy_meanmax(*syn,ch1,ch2,dt)
-                #self.emgdct[emg][ch1][ch2][dt][f]
-        return z_grid
+        return self.build_f_grid_dt(emg=emg, syn=syn, dts=[dt], f=f)[:,:,0]
 
     def build_f_grid_1d(self, emg=2, f='meanmax'):
         #only dt=0 makes sense in 1d so we don't need dt as argument
@@ -185,15 +506,15 @@ class Trains:
         # instead of max of a particular channel)
         # dt is dt between stim pulses
         # tau is how much we shift resp2
-        if emg2 is None:
-            emg2=0
-            b=0
         if filldiag and ch1==ch2 and (dt==10 or dt==20):
             # We don't have values on the diag for dt=10 and dt=20,
             # so we get them from dt=0 if filldiag is True
             dt=0
-        resps1 = self.emgdct[emg1][ch1][ch2][dt]['data']
-        resps2 = self.emgdct[emg2][ch1][ch2][dt]['data']
+        resps1 = self.get_trials(emg1,ch1,ch2,dt)
+        if emg2 is None:
+            # single emg, we don't need to load (or shift) a second one
+            return a*resps1
+        resps2 = self.get_trials(emg2,ch1,ch2,dt)
         # resps are 1466 (resps1.shape[1]) ticks ts, which last 300ms
         dtidx = int(tau/300*resps1.shape[1])+1
         resps2_shifted = np.zeros_like(resps2)
@@ -207,6 +528,67 @@ class Trains:
         else:
             return syn.max(axis=1).mean()
 
+    def synergy_maxs(self, emg1, emg2, dts=None, tau=40, a=1, b=1, filldiag=True):
+        # Batched version of synergy(...).max(axis=1): computes the
+        # per trial max of the synergy for all (ch1,ch2) pairs and all
+        # dts at once, and returns it as maxs[i,j,k,trial] (i,j index
+        # self.chs, k indexes dts, invalid trials are nan).
+        # tau, a and b can also be arrays (broadcast together) to
+        # compute many synergy definitions in one call. The result then
+        # has an extra leading axis for them.
+        if dts is None:
+            dts = self.dts
+        single = all(np.ndim(v) == 0 for v in (tau,a,b))
+        taus,As,Bs = np.broadcast_arrays(np.atleast_1d(tau), np.atleast_1d(a), np.atleast_1d(b))
+        if emg2 is None:
+            emg2 = emg1
+            Bs = np.zeros(Bs.shape)
+        self.load_emg(emg1)
+        self.load_emg(emg2)
+        resps1, resps2 = self.resps[emg1], self.resps[emg2]
+        valid = self.valid[emg1] & self.valid[emg2]
+        n_ticks = resps1.shape[-1]
+        diag = np.arange(self.n_ch)
+        maxs = np.full((len(taus), self.n_ch, self.n_ch, len(dts), resps1.shape[-2]), np.nan)
+        # buffers for a*resps1 and b*resps2 of one dt, which we reuse
+        # for every dt and every synergy
+        buf1 = np.empty(resps1[:,:,0].shape, dtype=np.result_type(resps1, float))
+        buf2 = np.empty_like(buf1)
+
+        def synmax(r1, r2, a, b, tau, out1, out2):
+            # same as synergy, but the shift of r2 is only a view
+            np.multiply(r1, a, out=out1)
+            if b != 0:
+                # resps are 1466 (n_ticks) ticks ts, which last 300ms
+                dtidx = int(tau/300*n_ticks)+1
+                np.multiply(r2[...,dtidx:], b, out=out2[...,:-dtidx])
+                out1[...,:-dtidx] += out2[...,:-dtidx]
+            return out1.max(axis=-1)
+
+        for k,dt in enumerate(dts):
+            kk = self.dtidx[dt]
+            cellvalid = valid[:,:,kk].copy()
+            for s,(tau_,a_,b_) in enumerate(zip(taus,As,Bs)):
+                maxs[s,:,:,k] = synmax(resps1[:,:,kk], resps2[:,:,kk], a_, b_, tau_, buf1, buf2)
+                if filldiag and (dt==10 or dt==20):
+                    # We don't have values on the diag for dt=10 and dt=20,
+                    # so we get them from dt=0
+                    maxs[s,diag,diag,k] = synmax(resps1[diag,diag,0], resps2[diag,diag,0],
+                                                 a_, b_, tau_, buf1[0], buf2[0])
+                    cellvalid[diag,diag] = valid[diag,diag,0]
+            maxs[:,:,:,k][:,~cellvalid] = np.nan
+        return maxs[0] if single else maxs
+
+    def synergy_meanmax_grid(self, emg1, emg2, dts=None, tau=40, a=1, b=1, filldiag=True):
+        # synergy_meanmax for all (ch1,ch2) pairs and dts at once
+        # (see synergy_maxs). Empty cells are 0.
+        maxs = self.synergy_maxs(emg1, emg2, dts=dts, tau=tau, a=a, b=b, filldiag=filldiag)
+        valid = ~np.isnan(maxs)
+        ntrials = valid.sum(axis=-1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            meanmax = np.where(valid, maxs, 0).sum(axis=-1) / ntrials
+        return np.where(ntrials > 0, meanmax, 0)
+
     def max_ch_dt2d(self, emg=4, dts=[40,60], syn=(0,4)):
         if syn is None:
             syn = (emg,None)
@@ -440,7 +822,8 @@ class Trains:
 
         
         maxch1,maxch2 = self.max_ch_2d(syn=syn,dt=dt)
-        maxr = self.synergy_meanmax(*syn,maxch1,maxch2,dt,tau=tau)
+        meanmaxs = self.synergy_meanmax_grid(*syn,dts=[dt],tau=tau)[:,:,0]
+        maxr = meanmaxs[self.chidx[maxch1],self.chidx[maxch2]]
         for i,ch1 in enumerate(self.chs):
             for j,ch2 in enumerate(self.chs):
                 ax = plt.subplot(gs[i+2,j+2])
@@ -451,7 +834,7 @@ class Trains:
                 data = self.synergy(*syn,ch1,ch2,dt, tau=tau)
                 if data.size != 0:
                     plt.plot(data.T)
-                mm = float(self.synergy_meanmax(*syn,ch1,ch2,dt,tau=tau))
+                mm = float(meanmaxs[i,j])
                 # if ch1==maxch1 and ch2==maxch2:
                 #     bbox = dict(facecolor='green', alpha=0.5)
                 if plot_green and mm > maxr - 0.002:
@@ -483,6 +866,130 @@ class Trains:
                         vals.extend(trainsC.get_emgdct(emg)[ch1][ch2][dt]['maxs'].tolist())
         plt.plot(vals, '.')
 
+def _attach_shm(name):
+    # (since python 3.13, attaching can leave the segment to its owner)
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+def _unlink_shms(shms):
+    for shm in shms:
+        try:
+            shm.close()
+        except BufferError:
+            # views of it are still alive (at exit), unlink is enough
+            pass
+        shm.unlink()
+
+def attach_trains(spec, init_args, clean_report=None):
+    # Trains on the shared memory segments of another one (see
+    # Trains.shared_copy), without loading anything
+    trainsC = Trains.__new__(Trains)
+    trainsC._init_args = init_args
+    trainsC._init_consts(init_args['N_EMGS'])
+    trainsC._shm = []
+    for name,(shm_name,shape,dtype) in spec.items():
+        shm = _attach_shm(shm_name)
+        a = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        a.flags.writeable = False
+        trainsC._set_array(name, a)
+        trainsC._shm.append(shm)
+    trainsC._shm_spec = spec
+    trainsC._cells = None
+    trainsC._loaded = np.ones(trainsC.N_EMGS, dtype=bool)
+    trainsC._cubes = {}
+    trainsC.emgdct = TrainsView(trainsC)
+    trainsC.clean_report = clean_report
+    trainsC.trains = trainsC.emgdct[init_args['emg']]
+    return trainsC
+
+class ResponseSampler:
+    """Simulates the stimulator by drawing responses from a Trains feature cube.
+
+    Responses for arrays of (ch1,ch2,dt) are drawn in one vectorised
+    call, using a numpy Generator (seed it per run/worker with seed).
+    emg, syn, f and filldiag pick the cube (see Trains.feature_cube).
+    mode is one of
+      'replace': every draw picks a trial of the cell uniformly
+      'noreplace': a cell only repeats a trial once all of its trials
+                   have been drawn (it then starts a new pass)
+      'bootstrap': the trials of every cell are first resampled with
+                   replacement (one bootstrap replicate of the dataset)
+                   and are then drawn with replacement
+    If symmetric, a dt=0 cell (ch1,ch2) draws from the trials of both
+    (ch1,ch2) and (ch2,ch1) (the same stimulation, see canonical_pairs).
+    """
+    MODES = ('replace', 'noreplace', 'bootstrap')
+
+    def __init__(self, trainsC, emg=None, syn=None, f='max', filldiag=True, mode='replace', seed=None, symmetric=False):
+        assert mode in self.MODES, "mode should be one of {}".format(self.MODES)
+        self.mode = mode
+        self.rng = np.random.default_rng(seed)
+        self.chs = trainsC.chs
+        self.dts = trainsC.dts
+        self._chlut = np.full(max(self.chs)+1, -1)
+        self._chlut[self.chs] = np.arange(len(self.chs))
+        self._dtlut = np.full(max(self.dts)+1, -1)
+        self._dtlut[self.dts] = np.arange(len(self.dts))
+        cube = trainsC.feature_cube(emg=emg, syn=syn, f=f, filldiag=filldiag)
+        if symmetric and 0 in self.dts:
+            k0 = self._dtlut[0]
+            mirror = np.full(cube.shape, np.nan)
+            mirror[:,:,k0] = cube[:,:,k0].transpose(1,0,2)
+            diag = np.arange(len(self.chs))
+            mirror[diag,diag,k0] = np.nan
+            cube = np.concatenate((cube, mirror), axis=-1)
+        valid = ~np.isnan(cube)
+        self.counts = valid.sum(axis=-1)
+        # valid trials first (in their original order)
+        self.values = np.take_along_axis(cube, np.argsort(~valid, axis=-1, kind='stable'), axis=-1)
+        if mode == 'bootstrap':
+            trials = self.rng.integers(np.maximum(self.counts,1)[...,None], size=self.values.shape)
+            self.values = np.take_along_axis(self.values, trials, axis=-1)
+        elif mode == 'noreplace':
+            # a random permutation of the valid trials of every cell
+            keys = np.where(np.arange(cube.shape[-1]) < self.counts[...,None],
+                            self.rng.random(cube.shape), np.inf)
+            self._perms = np.argsort(keys, axis=-1)
+            self._ndrawn = np.zeros(self.counts.shape, dtype=int)
+
+    def sample(self, ch1, ch2, dt):
+        # ch1, ch2 (channels) and dt can be scalars or arrays, which are
+        # broadcast together. Returns one response per (ch1,ch2,dt)
+        i = self._chlut[np.asarray(ch1, dtype=int)]
+        j = self._chlut[np.asarray(ch2, dtype=int)]
+        k = self._dtlut[np.asarray(dt, dtype=int)]
+        return self.sample_idx(i, j, k)
+
+    def sample_idx(self, i, j, k):
+        # same as sample, but with indices into chs and dts
+        i,j,k = np.broadcast_arrays(i, j, k)
+        counts = self.counts[i,j,k]
+        if (counts == 0).any():
+            raise ValueError("Can't sample from cells without any trials")
+        if self.mode == 'noreplace':
+            cells = np.ravel_multi_index((i,j,k), self.counts.shape).ravel()
+            # rank of every draw among the draws of the same cell in this call
+            order = np.argsort(cells, kind='stable')
+            start = np.r_[True, cells[order][1:] != cells[order][:-1]]
+            ranks = np.empty(len(cells), dtype=int)
+            ranks[order] = np.arange(len(cells)) - np.maximum.accumulate(np.where(start, np.arange(len(cells)), 0))
+            ndrawn = self._ndrawn.reshape(-1)
+            pos = (ndrawn[cells] + ranks).reshape(i.shape) % counts
+            np.add.at(ndrawn, cells, 1)
+            trials = self._perms[i,j,k,pos]
+        else:
+            trials = self.rng.integers(counts)
+        return self.values[i,j,k,trials]
+
+    def random_cells(self, n, dts=None):
+        # n uniformly random (ch1,ch2,dt) triples, with dt among dts
+        # (used for the initial random queries)
+        if dts is None:
+            dts = self.dts
+        return self.rng.choice(self.chs, n), self.rng.choice(self.chs, n), self.rng.choice(dts, n)
+
 if __name__ == "__main__":
     trainsC = Trains(emg=EMG, clean_thresh=0.06)
     trainsC.plot_response_matrix(emg=4,dt=60)
@@ -1,23 +1,3 @@
-uid=2d
-for multkern in '--multkern' ''; do
-    for ardkern in '--ardkern' ''; do
-	for k in 2 4 6; do
-	    name="2d$multkern$ardkern--k=$k"
-	    options="$multkern $ardkern --k $k"
-	    sbatch --job-name $name chruns2d_script.sh 4 60 $uid "$options"
-	    sbatch --job-name $name chruns2d_script.sh 0 10 $uid "$options"
-	done
-    done
-done
-
-for multkern in '--multkern' ''; do
-    for ardkern in '--ardkern' ''; do
-	for k in 2 4 6; do
-	    name="2d--symkern$multkern$ardkern$--k=$k"
-	    options="--symkern $multkern $ardkern --k $k"
-	    sbatch --job-name $name chruns2d_script.sh 0 0 $uid "$options"
-	    sbatch --job-name $name chruns2d_script.sh 4 0 $uid "$options"
-	done
-    done
-done
-
+# one experiment per (multkern, ardkern, k) for emg 4 dt 60, emg 0 dt 10
+# and, with symkern, emg 0 and 4 dt 0 (see sweep_2d.json)
+python sweep.py sweep_2d.json --slurm
@@ -11,11 +11,6 @@
 #     done
 # done
 
-uid=dt2dkmult
-for ardkern in '--ardkern' ''; do
-    for k in 2 3 4 5 6; do
-	name="dt2dk--multkern$ardkern--constrain--k$k"
-	options="--multkern $ardkern --constrain --k $k"
-	sbatch --job-name $name chrunsdt2d_script.sh 4 60 $uid "$options"
-    done
-done
+# one experiment per (ardkern, k), with multkern and constrain (see
+# sweep_dt2d.json)
+python sweep.py sweep_dt2d.json --slurm
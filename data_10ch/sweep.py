@@ -0,0 +1,146 @@
+"""
+Sweeps of chruns_2d.py / chruns_dt2d.py over a grid of arguments (a
+json file, see expand), run locally or as a SLURM job array.
+
+    python sweep.py sweep_2d.json --cpus 8
+    python sweep.py sweep_2d.json --slurm --max_jobs 20
+"""
+
+import os
+import json
+import shutil
+import argparse
+import importlib
+import itertools
+import subprocess
+from functools import partial
+from contextlib import redirect_stdout
+from load_matlab import Trains
+from gp_pool import as_completed, shared
+from gp_results import results_done
+
+SCRIPTS = ('chruns_2d.py', 'chruns_dt2d.py')
+
+parser = argparse.ArgumentParser()
+parser.add_argument('sweep', type=str, nargs='?', help='json file of the sweep')
+parser.add_argument('--cpus', type=int, default=1, help='number of processes (default=1)')
+parser.add_argument('--workers', type=int, default=1, help='with --cpus 1, number of processes of each experiment (default=1)')
+parser.add_argument('--slurm', action='store_true', help='submit the experiments as a SLURM job array instead of running them')
+parser.add_argument('--max_jobs', type=int, default=None, help='with --slurm, max number of array tasks running at a time')
+parser.add_argument('--dry', action='store_true', help='only list the experiments to run')
+parser.add_argument('--tasks', type=str, default=None, help='(job array) file of the experiments written by --slurm')
+parser.add_argument('--task', type=int, default=None, help='(job array) index of the experiment in --tasks to run')
+
+def expand(sweep):
+    # the experiments of a sweep: (script, dict of arguments) for every
+    # combination of every entry of its grid. A sweep is eg.
+    #   {"script": "chruns_2d.py", "args": {"uid": "2d", "repeat": 25},
+    #    "grid": [{"emg": 4, "dt": 60, "multkern": [true, false], "k": [2, 4, 6]},
+    #             {"emg": [0, 4], "dt": 0, "symkern": true}]}
+    # where the list values of an entry are the axes of its product (a
+    # list argument, eg. nrnd, is then a list of lists), and args are
+    # shared by all entries. true is --flag, false no flag
+    assert sweep['script'] in SCRIPTS, "script must be one of {}".format(SCRIPTS)
+    configs = []
+    for entry in sweep.get('grid', [{}]):
+        entry = dict(sweep.get('args', {}), **entry)
+        axes = [k for k,v in entry.items() if isinstance(v, list)]
+        for values in itertools.product(*[entry[k] for k in axes]):
+            config = dict(entry, **dict(zip(axes, values)))
+            if config not in configs:
+                configs.append(config)
+    return [(sweep['script'], config) for config in configs]
+
+def to_argv(config):
+    # command line arguments of a dict of arguments
+    argv = []
+    for k,v in config.items():
+        if v is True:
+            argv.append('--{}'.format(k))
+        elif v is False or v is None:
+            continue
+        elif isinstance(v, list):
+            argv += ['--{}'.format(k)] + [str(x) for x in v]
+        else:
+            argv += ['--{}'.format(k), str(v)]
+    return argv
+
+def parse(task):
+    # (script module, parsed args) of a task
+    script, config = task
+    mod = importlib.import_module(script[:-len('.py')])
+    args = mod.parser.parse_args(to_argv(config))
+    mod.check_args(args)
+    assert args.uid, "a sweep needs a uid (otherwise it can't find its results)"
+    return mod, args
+
+def run_task(task, workers=1, jobid=''):
+    # runs the experiment of task (a task of as_completed, with the
+    # Trains in shared), its output going to log.txt
+    mod, args = parse(task)
+    args.workers = workers
+    args.jobid = jobid or args.jobid
+    filename = mod.results_path(args)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(os.path.join(os.path.dirname(filename), 'log.txt'), 'a') as f, redirect_stdout(f):
+        mod.main(args, trainsC=shared('trainsC'))
+    return filename
+
+def pending(tasks):
+    # the tasks whose results don't exist yet (the others are skipped,
+    # so a sweep can be launched again until it is done)
+    todo = []
+    for task in tasks:
+        mod, args = parse(task)
+        if not results_done(mod.results_path(args)):
+            todo.append(task)
+    return todo
+
+def run_local(tasks, cpus=1, workers=1):
+    # The Trains is loaded once, here, and shared with the workers. With
+    # cpus=1 the experiments run one after the other in this process,
+    # each on workers processes
+    fn = partial(run_task, workers=workers if cpus <= 1 else 1)
+    for n,(i,filename) in enumerate(as_completed(fn, tasks, workers=cpus, shared={'trainsC': Trains()}), 1):
+        print("[{}/{}] Done: {}".format(n, len(tasks), filename))
+
+def submit_slurm(tasks, sweepfile, max_jobs=None):
+    # writes the tasks next to sweepfile and submits them as a job array
+    # of sweep_array.sh (or prints the sbatch command without SLURM)
+    tasksfile = os.path.splitext(sweepfile)[0] + '_tasks.json'
+    with open(tasksfile, 'w') as f:
+        json.dump(tasks, f)
+    array = '0-{}'.format(len(tasks)-1) + ('%{}'.format(max_jobs) if max_jobs else '')
+    name = os.path.splitext(os.path.basename(sweepfile))[0]
+    cmd = ['sbatch', '--array', array, '--job-name', name, 'sweep_array.sh', tasksfile]
+    if shutil.which('sbatch') is None:
+        print("sbatch not found, run:\n{}".format(' '.join(cmd)))
+        return
+    subprocess.run(cmd, check=True)
+
+def main(args):
+    if args.task is not None:
+        # one task of a job array
+        with open(args.tasks) as f:
+            task = json.load(f)[args.task]
+        jobid = '{}_{}'.format(os.environ.get('SLURM_ARRAY_JOB_ID', ''), args.task)
+        fn = partial(run_task, workers=args.workers, jobid=jobid)
+        for i,filename in as_completed(fn, [task], shared={'trainsC': Trains()}):
+            print("Done:", filename)
+        return
+    with open(args.sweep) as f:
+        tasks = expand(json.load(f))
+    todo = pending(tasks)
+    print("{}: {} experiments, {} already done".format(args.sweep, len(tasks), len(tasks) - len(todo)))
+    if args.dry:
+        for task in todo:
+            print(task[0], ' '.join(to_argv(task[1])))
+    elif not todo:
+        return
+    elif args.slurm:
+        submit_slurm(todo, args.sweep, args.max_jobs)
+    else:
+        run_local(todo, cpus=args.cpus, workers=args.workers)
+
+if __name__ == "__main__":
+    main(parser.parse_args())
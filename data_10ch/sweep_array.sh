@@ -0,0 +1,10 @@
+#!/bin/bash
+#SBATCH -o /network/tmp1/laferris/slurm-%A_%a.out
+
+## this script is submitted by sweep.py --slurm as
+## sbatch --array 0-<n-1> sweep_array.sh <tasks json>
+## and runs the experiment $SLURM_ARRAY_TASK_ID of the sweep
+
+source /network/home/laferris/.bashrc
+conda activate gp
+python sweep.py --tasks $1 --task $SLURM_ARRAY_TASK_ID
@@ -0,0 +1,61 @@
+import numpy as np
+import GPy
+from gp_incremental import IncrementalGP, RefitSchedule
+
+def make_data(n=30, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.uniform(0, 4, (n, 2))
+    Y = np.sin(X[:,:1]) + 0.1*rng.randn(n, 1)
+    return X, Y
+
+def make_model(X, Y, mean_function=None):
+    k = GPy.kern.Matern52(input_dim=2, ARD=True, lengthscale=[1.2, 0.8], variance=0.7)
+    return GPy.models.GPRegression(X, Y, k, noise_var=0.05, mean_function=mean_function)
+
+def assert_same_posterior(gp, m, Xnew):
+    for full_cov in (False, True):
+        mean, var = gp.predict(Xnew, full_cov=full_cov)
+        gmean, gvar = m.predict(Xnew, full_cov=full_cov)
+        np.testing.assert_allclose(mean, gmean, atol=1e-10)
+        np.testing.assert_allclose(var, gvar, atol=1e-10)
+
+def test_appends_match_gpy():
+    X, Y = make_data()
+    Xnew, _ = make_data(10, seed=1)
+    gp = IncrementalGP.from_gpy(make_model(X[:5], Y[:5]))
+    for x,y in zip(X[5:], Y[5:,0]):
+        gp.add(x, y)
+    assert gp.n == len(X)
+    np.testing.assert_allclose(gp.L.dot(gp.L.T), gp.kern.K(X) + (0.05 + 1e-8)*np.eye(len(X)), atol=1e-10)
+    assert_same_posterior(gp, make_model(X, Y), Xnew)
+
+def test_appends_from_empty_with_mean_function():
+    X, Y = make_data()
+    mf = GPy.mappings.Linear(2, 1)
+    mf.A = [[0.3], [-0.2]]
+    m = make_model(X, Y, mean_function=mf)
+    gp = IncrementalGP(m.kern, 0.05, mf)
+    for x,y in zip(X, Y[:,0]):
+        gp.add(x, y)
+    assert_same_posterior(gp, m, make_data(10, seed=1)[0])
+
+def test_snapshot_is_not_changed_by_appends():
+    X, Y = make_data()
+    Xnew, _ = make_data(10, seed=1)
+    gp = IncrementalGP.from_gpy(make_model(X[:10], Y[:10]))
+    snap = gp.snapshot()
+    before = snap.predict(Xnew)
+    for x,y in zip(X[10:], Y[10:,0]):
+        gp.add(x, y)
+    after = snap.predict(Xnew)
+    np.testing.assert_array_equal(before[0], after[0])
+    np.testing.assert_array_equal(before[1], after[1])
+    assert_same_posterior(snap, make_model(X[:10], Y[:10]), Xnew)
+
+def test_refit_schedules():
+    steps = range(1, 21)
+    assert [s for s in steps if RefitSchedule('every:5')(s)] == [5, 10, 15, 20]
+    geometric = RefitSchedule('geometric:2')
+    assert [s for s in steps if geometric(s)] == [1, 2, 4, 8, 16]
+    assert all(RefitSchedule('always')(s) for s in steps)
+    assert not any(RefitSchedule('never')(s) for s in steps)
@@ -0,0 +1,75 @@
+import itertools
+import numpy as np
+import GPy
+from gp_kron import KronGPRegression
+
+def make_grid(sizes):
+    return np.array(list(itertools.product(*[range(s) for s in sizes])), dtype=float)
+
+def make_kern():
+    k1 = GPy.kern.Matern52(input_dim=1, active_dims=[0], lengthscale=1.5, variance=0.8)
+    k2 = GPy.kern.Matern52(input_dim=1, active_dims=[1], lengthscale=2.0)
+    return k1 * k2
+
+def fit_both(grid, idx, noise=0.05, seed=0):
+    rng = np.random.RandomState(seed)
+    X = grid[idx]
+    Y = rng.randn(len(idx), 1)
+    mk = KronGPRegression(X, Y, make_kern(), grid, noise_var=noise)
+    mg = GPy.models.GPRegression(X, Y, make_kern(), noise_var=noise)
+    return mk, mg
+
+def test_full_grid_matches_gpy():
+    grid = make_grid((5, 4))
+    mk, mg = fit_both(grid, np.arange(len(grid)))
+    assert mk.exact
+    mean, var = mk.predict_grid(include_likelihood=False)
+    gmean, gvar = mg.predict(grid, include_likelihood=False)
+    np.testing.assert_allclose(mean, gmean, atol=1e-8)
+    np.testing.assert_allclose(var, gvar, atol=1e-8)
+    np.testing.assert_allclose(mk.log_likelihood(), mg.log_likelihood(), rtol=1e-8)
+
+def test_partial_grid_matches_gpy():
+    # 5 of 20 cells observed: the means and variances are exact (only
+    # the log likelihood is approximated)
+    grid = make_grid((5, 4))
+    mk, mg = fit_both(grid, np.array([0, 3, 7, 12, 18]))
+    assert not mk.exact
+    mean, var = mk.predict_grid(include_likelihood=False)
+    gmean, gvar = mg.predict(grid, include_likelihood=False)
+    np.testing.assert_allclose(mean, gmean, atol=1e-8)
+    np.testing.assert_allclose(var, gvar, atol=1e-8)
+    mean, var = mk.predict(grid[[1, 2]])
+    gmean, gvar = mg.predict(grid[[1, 2]])
+    np.testing.assert_allclose(var, gvar, atol=1e-8)
+
+def test_partial_grid_variances_follow_parameters():
+    grid = make_grid((5, 4))
+    mk, mg = fit_both(grid, np.array([1, 6, 11, 16]))
+    mk.likelihood.variance = mg.likelihood.variance = 0.2
+    mk.kern.Mat52.lengthscale = mg.kern.Mat52.lengthscale = 0.7
+    _, var = mk.predict_grid(include_likelihood=False)
+    _, gvar = mg.predict(grid, include_likelihood=False)
+    np.testing.assert_allclose(var, gvar, atol=1e-8)
+
+def test_dt2d_predicts_dts_without_data():
+    from gp_full_dt2d import train_models_dt2d
+    from gp_grid import grid_dt2d
+    dts = (20, 40, 60)
+    grid = grid_dt2d(dts)
+    rng = np.random.RandomState(1)
+    idx = rng.choice(np.flatnonzero(grid[:,4] < 60), 40, replace=False)
+    X, Y, N = grid[idx], 1e-2*rng.randn(40, 1), rng.randint(1, 5, 40)
+    mk = train_models_dt2d(X, Y, kerneltype='mult', counts=N, kron=True, grid_dts=dts, optimize=False)
+    mc = train_models_dt2d(X, Y, kerneltype='mult', counts=N, optimize=False)
+    mc[:] = mk.param_array
+    mean, var = mk.predict(grid)
+    cmean, cvar = mc.predict(grid)
+    np.testing.assert_allclose(mean, cmean, atol=1e-8)
+    np.testing.assert_allclose(var, cvar, atol=1e-8)
+
+def test_full_grid_gradients_match_gpy():
+    grid = make_grid((5, 4))
+    mk, mg = fit_both(grid, np.arange(len(grid)))
+    assert mk.checkgrad()
+    np.testing.assert_allclose(mk.gradient, mg.gradient, rtol=1e-6, atol=1e-8)
@@ -0,0 +1,66 @@
+import itertools
+import numpy as np
+import GPy
+from gp_lockstep import LockstepGP, lockstep_runs, pick_rows
+
+def make_grid():
+    return np.array(list(itertools.product(range(6), range(5))), dtype=float)
+
+def make_model(X, Y, mean_function=None):
+    k = GPy.kern.Matern52(input_dim=2, ARD=True, lengthscale=[1.5, 2.], variance=0.5)
+    return GPy.models.GPRegression(X, Y, k, noise_var=0.02, mean_function=mean_function)
+
+class FnSampler:
+    # deterministic stand-in for a ResponseSampler
+    def __init__(self, shift):
+        self.shift = shift
+    def sample(self, ch1, ch2, dt):
+        return np.sin((ch1 + self.shift) / 2.) + 0.1*ch2
+
+def test_posteriors_match_gpy():
+    grid = make_grid()
+    mf = GPy.mappings.Linear(2, 1)
+    mf.A = [[0.1], [-0.2]]
+    m = make_model(grid[:1], np.zeros((1, 1)), mean_function=mf)
+    R = 3
+    gp = LockstepGP.from_model(m, grid, R)
+    rng = np.random.RandomState(0)
+    # (with repeated queries of a cell)
+    idx = rng.randint(len(grid), size=(R, 8))
+    Y = rng.randn(R, 8)
+    for j in range(idx.shape[1]):
+        gp.add(idx[:,j], Y[:,j])
+    mean, var = gp.predict()
+    for r in range(R):
+        mr = make_model(grid[idx[r]], Y[r][:,None], mean_function=mf)
+        gmean, gvar = mr.predict(grid)
+        np.testing.assert_allclose(mean[r], gmean[:,0], atol=1e-8)
+        # (noise_var includes GPy's jitter)
+        np.testing.assert_allclose(var[r], gvar[:,0], atol=1e-7)
+
+def test_pick_rows():
+    acq = np.array([[0., 1., 0.5], [2., 0., 1.]])
+    np.testing.assert_array_equal(pick_rows(acq), [1, 0])
+    rng = np.random.default_rng(0)
+    np.testing.assert_array_equal(pick_rows(acq, sa=True, T=1e-3, rng=rng), [1, 0])
+    picks = np.array([pick_rows(acq, sa=True, T=1., rng=rng) for _ in range(4000)])
+    p = np.exp(acq) / np.exp(acq).sum(1, keepdims=True)
+    for r in range(2):
+        np.testing.assert_allclose(np.bincount(picks[:,r], minlength=3) / len(picks), p[r], atol=0.03)
+
+def test_runs_match_sequential_gpy_runs():
+    grid = make_grid()
+    cells = (grid[:,0], grid[:,1], np.zeros(len(grid)))
+    samplers = [FnSampler(0), FnSampler(3)]
+    X0 = np.array([[0, 7], [12, 29]])
+    gp = LockstepGP.from_model(make_model(grid[:1], np.zeros((1, 1))), grid, R=2)
+    dct = lockstep_runs(gp, samplers, cells, X0, 5)
+    assert dct['idx'].shape == (2, 7) and dct['means'].shape == (2, 6, len(grid))
+    for r,s in enumerate(samplers):
+        idx = list(X0[r])
+        for step in range(5):
+            Y = np.array([[s.sample(*grid[i], 0)] for i in idx])
+            mean, var = make_model(grid[idx], Y).predict(grid)
+            idx.append(np.argmax(mean + 2*np.sqrt(var)))
+        np.testing.assert_array_equal(dct['idx'][r], idx)
+        np.testing.assert_allclose(dct['Y'][r], [s.sample(*grid[i], 0) for i in idx])
@@ -0,0 +1,42 @@
+import os
+import time
+import numpy as np
+from gp_modelcache import ModelCache, fit_cached, model_key
+from gp_full_1d import train_model_1d
+
+def make_data(seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.randint(0, 5, (40, 2)).astype(float)
+    Y = np.sin(X[:,:1]) + 0.1*rng.randn(40, 1)
+    return X, Y
+
+def test_hit_is_the_fit_whatever_the_global_rng(tmp_path):
+    X, Y = make_data()
+    cache = ModelCache(str(tmp_path))
+    np.random.seed(1)
+    m1 = fit_cached(train_model_1d, X, Y, cache=cache, verbose=False)
+    np.random.seed(2)
+    state = np.random.get_state()
+    m2 = fit_cached(train_model_1d, X, Y, cache=None, verbose=False)
+    # (the global RNG is left as it was)
+    assert np.random.get_state()[1].tolist() == state[1].tolist()
+    m3 = fit_cached(train_model_1d, X, Y, cache=cache, verbose=False)
+    np.testing.assert_array_equal(m1.param_array, m2.param_array)
+    np.testing.assert_array_equal(m1.param_array, m3.param_array)
+    assert len(os.listdir(str(tmp_path))) == 1
+
+def test_key_depends_on_arguments_and_data():
+    X, Y = make_data()
+    key = model_key(train_model_1d, X, Y, ARD=False)
+    assert key == model_key(train_model_1d, X, Y, ARD=False, num_restarts=3, verbose=False)
+    assert key != model_key(train_model_1d, X, Y, ARD=True)
+    assert key != model_key(train_model_1d, X, Y + 1e-9, ARD=False)
+
+def test_lru_eviction(tmp_path):
+    cache = ModelCache(str(tmp_path), max_mb=1)
+    for i in range(5):
+        cache.put('k{}'.format(i), np.zeros(2**15))
+        time.sleep(0.02)
+        if i == 2:
+            cache.get('k0')
+    assert sorted(os.listdir(str(tmp_path))) == ['k0.npy', 'k3.npy', 'k4.npy']
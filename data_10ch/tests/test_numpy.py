@@ -0,0 +1,81 @@
+import numpy as np
+import GPy
+import gp_numpy
+from gp_full_2d import train_models_2d
+
+def make_data(n=25, d=4, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.uniform(0, 3, (n, d))
+    Y = np.sin(X[:,:1]) * np.cos(X[:,2:3]) + 0.1*rng.randn(n, 1)
+    return X, Y
+
+def make_models(lib, X, Y):
+    k1 = lib.kern.Matern52(input_dim=2, active_dims=[0,1], ARD=True, lengthscale=[0.7, 1.3], variance=0.6)
+    k2 = lib.kern.Matern52(input_dim=2, active_dims=[2,3], lengthscale=1.1)
+    k3 = lib.kern.Matern52(input_dim=2, active_dims=[0,2], lengthscale=0.9, variance=0.3)
+    return lib.models.GPRegression(X, Y, k1*k2 + k3, noise_var=0.04)
+
+def test_posterior_matches_gpy():
+    X, Y = make_data()
+    Xnew, _ = make_data(8, seed=1)
+    mn, mg = make_models(gp_numpy, X, Y), make_models(GPy, X, Y)
+    np.testing.assert_allclose(mn.param_array, mg.param_array)
+    np.testing.assert_allclose(mn.log_likelihood(), mg.log_likelihood(), rtol=1e-10)
+    np.testing.assert_allclose(mn.gradient(), mg.gradient, rtol=1e-8, atol=1e-10)
+    for full_cov in (False, True):
+        for include_likelihood in (False, True):
+            mean, var = mn.predict(Xnew, full_cov=full_cov, include_likelihood=include_likelihood)
+            gmean, gvar = mg.predict(Xnew, full_cov=full_cov, include_likelihood=include_likelihood)
+            np.testing.assert_allclose(mean, gmean, atol=1e-10)
+            np.testing.assert_allclose(var, gvar, atol=1e-10)
+
+def test_set_params_and_copy_kernel():
+    # (like make_add_model does with the previous model's kernel)
+    X, Y = make_data()
+    mn, mg = make_models(gp_numpy, X, Y), make_models(GPy, X, Y)
+    mn[:] = mg[:] = mg.param_array * np.linspace(0.5, 1.5, len(mg.param_array))
+    c = gp_numpy.models.GPRegression(X, Y, kernel=mn.sum.copy(), noise_var=mn.Gaussian_noise.variance)
+    mn[:] = 1.
+    np.testing.assert_allclose(c.log_likelihood(), mg.log_likelihood(), rtol=1e-10)
+    np.testing.assert_allclose(c.predict(X)[1], mg.predict(X)[1], atol=1e-10)
+
+def test_optimize_reaches_gpy_optimum():
+    X, Y = make_data()
+    mn = train_models_2d(X, Y, kerneltype='add', optimize=False, backend='numpy')
+    mg = train_models_2d(X, Y, kerneltype='add', optimize=False, backend='gpy')
+    mn.optimize()
+    mg.optimize()
+    assert mn.objective_function() <= mg.objective_function() + 1e-4
+    # at the optimum the (free) gradients vanish
+    assert np.abs(mn.objective_function_gradients()).max() < 1e-3
+
+def test_prior_coefficients_are_learnt_like_gpy():
+    from gp_full_2d import build_prior
+    from gp_grid import GRID_1D
+    X, Y = make_data()
+    X = np.floor(X[:,[0,1,0,1]] * [2/3., 5/3., 2/3., 5/3.])
+    m1d = GPy.models.GPRegression(GRID_1D.astype(float), np.random.RandomState(2).rand(10, 1), GPy.kern.Matern52(2))
+    mn = train_models_2d(X, Y, kerneltype='add', prior1d=m1d, optimize=False, backend='numpy')
+    mg = train_models_2d(X, Y, kerneltype='add', prior1d=m1d, optimize=False, backend='gpy')
+    assert list(mn.parameter_names_flat()) == [n.split('.', 1)[1] for n in mg.parameter_names_flat()]
+    np.testing.assert_allclose(mn.param_array, mg.param_array)
+    mn[:] = mg[:] = mg.param_array * np.linspace(0.5, 1.5, len(mg.param_array))
+    np.testing.assert_allclose(mn.log_likelihood(), mg.log_likelihood(), rtol=1e-10)
+    np.testing.assert_allclose(mn.gradient(), mg.gradient, rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(mn.predict(X)[0], mg.predict(X)[0], atol=1e-10)
+    start = mn.param_array
+    mn.optimize()
+    mg.optimize()
+    # (the coefficients of the prior are the first parameters)
+    assert not np.allclose(mn.param_array[:2], start[:2])
+    assert mn.objective_function() <= mg.objective_function() + 1e-4
+    assert np.abs(mn.objective_function_gradients()).max() < 1e-3
+
+def test_grid_posterior_of_a_new_model():
+    # (grid_posterior_cov reads m.posterior before anything else)
+    from gp_grid import grid_posterior_cov, GRID_2D
+    X, Y = make_data()
+    X = np.floor(X[:,[0,1,0,1]] * [2/3., 5/3., 2/3., 5/3.])
+    mn = train_models_2d(X, Y, kerneltype='add', optimize=False, backend='numpy')
+    mg = train_models_2d(X, Y, kerneltype='add', optimize=False, backend='gpy')
+    np.testing.assert_allclose(grid_posterior_cov(mn, GRID_2D), grid_posterior_cov(mg, GRID_2D), atol=1e-10)
@@ -0,0 +1,36 @@
+import os
+import numpy as np
+from gp_checkpoint import TaskStore, run_tasks
+from gp_results import ResultsStore, load_results, results_done
+
+CALLS = []
+
+def run(task):
+    CALLS.append(task)
+    return np.full(3, float(task))
+
+def launch(tmp_path, keys):
+    # one launch of an experiment, like run_ch_stats_exps
+    store = TaskStore(str(tmp_path / 'tasks'), {'n': len(keys)}, seed=0)
+    arrays = {'vals': np.zeros((2, 2, 1, 3))}
+    results = ResultsStore(str(tmp_path / 'results.h5'), arrays, config={'n': len(keys)})
+    for key,res in run_tasks(store, run, keys, [10*j + r for j,r,_ in keys]):
+        arrays['vals'][key] = res
+        results.write(key)
+    results.close({'ntotal': 3})
+    return arrays
+
+def test_resume_from_truncated_file(tmp_path):
+    keys = [(j, r, 0) for j in range(2) for r in range(2)]
+    expected = launch(tmp_path, keys)['vals']
+    filename = str(tmp_path / 'results.h5')
+    # (as if the job had been killed during a write)
+    with open(filename, 'r+b') as f:
+        f.truncate(os.path.getsize(filename) // 2)
+    del CALLS[:]
+    arrays = launch(tmp_path, keys)
+    assert CALLS == []
+    np.testing.assert_array_equal(arrays['vals'], expected)
+    assert results_done(filename)
+    np.testing.assert_array_equal(load_results(filename)['vals'], expected)
+    assert os.path.exists(filename + '.bad')
@@ -0,0 +1,37 @@
+import numpy as np
+import GPy
+from load_matlab import CHS
+from gp_grid import GRID_1D, grid_dt2d
+from gp_full_2d import build_prior
+from gp_full_dt2d import train_model_seq_dt2d
+
+class FakeSampler:
+    # smooth responses, without a Trains
+    def __init__(self, seed=0):
+        self.rng = np.random.default_rng(seed)
+
+    def sample(self, ch1, ch2, dt):
+        ch1, ch2, dt = np.broadcast_arrays(ch1, ch2, dt)
+        return 1e-2*(np.sin(ch1/5.) + np.cos(ch2/7.) + dt/100.) + 1e-3*self.rng.standard_normal(ch1.shape)
+
+    def random_cells(self, n, dts):
+        return self.rng.choice(CHS, n), self.rng.choice(CHS, n), self.rng.choice(dts, n)
+
+def test_rebuilt_snapshots_dont_share_the_prior():
+    np.random.seed(0)
+    Y1d = 1e-2*np.random.rand(len(GRID_1D), 1)
+    m1d = GPy.models.GPRegression(GRID_1D.astype(float), Y1d, GPy.kern.Matern52(2))
+    prior = build_prior(m1d, input_dim=5)
+    prior_params = prior.param_array.copy()
+    dts = (20, 40)
+    D = train_model_seq_dt2d(None, n_random_pts=8, n_total_pts=11, n_prior_queries=0, prior1d=prior, m1d=m1d,
+                             dts=dts, sampler=FakeSampler(), save_preds=False, sa=False, constrain=False)
+    models = D['models']
+    X = grid_dt2d(dts)
+    before = models[-2].predict(X)
+    models[-1].predict(X)
+    after = models[-2].predict(X)
+    np.testing.assert_array_equal(before[0], after[0])
+    np.testing.assert_array_equal(before[1], after[1])
+    np.testing.assert_array_equal(models[-2].model.param_array, models[-2].param_array)
+    np.testing.assert_array_equal(prior.param_array, prior_params)
@@ -0,0 +1,29 @@
+import os
+import numpy as np
+import chruns_2d
+import gp_pool
+from gp_results import ResultsStore, results_done
+from sweep import expand, pending, run_task
+
+def fake_main(args, trainsC=None):
+    # writes complete (empty) results where the experiment of args would
+    filename = chruns_2d.results_path(args)
+    arrays = {'vals': np.zeros((1, 1, 1, 2))}
+    results = ResultsStore(filename, arrays, config={'refit': str(args.refit)})
+    results.write((0, 0, 0))
+    results.close({'ntotal': 2})
+
+def test_configs_differing_in_refit_both_run(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(chruns_2d, 'main', fake_main)
+    gp_pool._init_worker({'trainsC': None})
+    sweep = {'script': 'chruns_2d.py', 'args': {'uid': 'test'}, 'grid': [{'refit': ['never', 'every:5']}]}
+    tasks = expand(sweep)
+    assert len(tasks) == 2
+    assert pending(tasks) == tasks
+    filenames = [run_task(task) for task in tasks]
+    assert filenames[0] != filenames[1]
+    assert all(results_done(f) for f in filenames)
+    assert pending(tasks) == []
+    # and their checkpoints don't mix either
+    assert os.path.dirname(filenames[0]) != os.path.dirname(filenames[1])
@@ -0,0 +1,31 @@
+import numpy as np
+import GPy
+from gp_full_2d import PairSymmetric
+
+def swap():
+    A = np.zeros((4, 4))
+    A[:2,2:] = A[2:,:2] = np.eye(2)
+    return A
+
+def kernels(ARD, lengthscale):
+    base = lambda: GPy.kern.Matern52(input_dim=4, ARD=ARD, lengthscale=lengthscale, variance=0.7)
+    return PairSymmetric(base(), swap()), GPy.kern.Symmetric(base(), swap(), symmetry_type='even')
+
+def check(kp, kg, X, X2=None):
+    np.testing.assert_allclose(kp.K(X, X2), kg.K(X, X2), rtol=1e-12, atol=1e-14)
+    dL_dK = np.random.RandomState(1).randn(len(X), len(X if X2 is None else X2))
+    kp.update_gradients_full(dL_dK, X, X2)
+    kg.update_gradients_full(dL_dK, X, X2)
+    np.testing.assert_allclose(kp.gradient, kg.gradient, rtol=1e-10)
+
+def test_matches_gpy_symmetric():
+    rng = np.random.RandomState(0)
+    X = rng.randint(0, 5, (12, 4)).astype(float)
+    X2 = rng.randint(0, 5, (7, 4)).astype(float)
+    for ARD, lengthscale in [(False, 1.3), (True, [1.1, 2.0, 1.1, 2.0]), (True, [1.1, 2.0, 0.7, 1.5])]:
+        kp, kg = kernels(ARD, lengthscale)
+        # (the 2 evaluation path is only taken when the base kernel is
+        # invariant to the swap)
+        assert kp.invariant() == (not ARD or lengthscale[0] == lengthscale[2])
+        check(kp, kg, X)
+        check(kp, kg, X, X2)
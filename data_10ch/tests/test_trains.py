@@ -0,0 +1,31 @@
+import numpy as np
+from load_matlab import Trains, TrainsView, CHS, DTS
+
+N_TRIALS, N_TICKS = 3, 5
+
+def make_trains(rng):
+    # a Trains built from fake .mat cells, where ch1==ch2 is empty for
+    # dt!=0 (as in FilteredPairedTrains.mat)
+    filtdata = np.empty((1, len(CHS), len(CHS), len(DTS)), dtype=object)
+    for idx in np.ndindex(filtdata.shape):
+        _,i,j,k = idx
+        empty = (i == j and k != 0) or (i < j and k == 0)
+        filtdata[idx] = np.zeros((0,0)) if empty else rng.rand(N_TRIALS, N_TICKS)
+    trainsC = Trains.__new__(Trains)
+    trainsC._init_consts(1)
+    trainsC._build_store(filtdata)
+    trainsC._init_stats()
+    trainsC.emgdct = TrainsView(trainsC)
+    return trainsC, filtdata
+
+def test_empty_cells_have_no_trials():
+    trainsC, filtdata = make_trains(np.random.RandomState(0))
+    ch = CHS[0]
+    data = trainsC.emgdct[0][ch][ch][DTS[1]]['data']
+    assert data.shape == (0, N_TICKS)
+    assert data.max(axis=1).shape == (0,)
+    assert np.isnan(trainsC.emgdct[0][ch][ch][DTS[1]]['meanmax'])
+    # the other cells are unchanged
+    i, j = CHS.index(CHS[1]), CHS.index(CHS[2])
+    assert np.array_equal(trainsC.emgdct[0][CHS[1]][CHS[2]][DTS[1]]['data'], filtdata[0,i,j,1])
+    assert np.array_equal(trainsC.emgdct[0][CHS[1]][CHS[2]][0]['data'], filtdata[0,j,i,0])
@@ -0,0 +1,26 @@
+import numpy as np
+from load_matlab import Trains, CHS, ch2xy
+from gp_full_dt2d import true_vals_dt2d, true_best_dt2d
+from gp_grid import grid_dt2d
+
+DTS = [0, 10, 20, 40, 60, 80, 100]
+
+class FakeTrains(Trains):
+    # a Trains with random objectives (one per synergy), without data
+    def __init__(self):
+        self.chs = CHS
+
+    def synergy_meanmax_grid(self, emg1, emg2, dts=None, **kwargs):
+        rng = np.random.RandomState(hash((emg1, emg2)) % 2**32)
+        grid = rng.rand(len(CHS), len(CHS), len(DTS))
+        return grid[:,:,[DTS.index(dt) for dt in dts]]
+
+def test_true_idx_is_the_argmax_of_true_vals():
+    trainsC = FakeTrains()
+    dts = [20, 40, 60]
+    for emg,syn in [(4, None), (2, None), (0, (0,4)), (0, (1,3))]:
+        true_vals = true_vals_dt2d(trainsC, emg=emg, syn=syn, dts=dts)
+        dtidx,i,j = np.unravel_index(true_vals.argmax(), (len(dts), len(CHS), len(CHS)))
+        chpairdt, idx = true_best_dt2d(trainsC, emg=emg, syn=syn, dts=dts)
+        assert chpairdt == [CHS[i], CHS[j], dts[dtidx]]
+        assert list(grid_dt2d(dts)[idx]) == ch2xy[CHS[i]] + ch2xy[CHS[j]] + [dts[dtidx]]